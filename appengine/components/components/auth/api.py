@@ -15,17 +15,23 @@ generally should not be used outside of Auth components implementation.
 # pylint: disable=E1120
 
 import collections
+import cPickle
+import fnmatch
 import functools
 import logging
 import os
+import re
 import threading
 import time
+import zlib
 
+from google.appengine.api import memcache
 from google.appengine.api import oauth
 from google.appengine.api import users
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import metadata
 from google.appengine.runtime import apiproxy_errors
+from google.net.proto import ProtocolBuffer
 
 from . import config
 from . import ipaddr
@@ -72,6 +78,15 @@ _auth_db_fetching_thread = None
 # Thread local storage for RequestCache (see 'get_request_cache').
 _thread_local = threading.local()
 
+# Memcache namespace of AuthDB snapshots shared between instances.
+_AUTH_DB_MEMCACHE_NAMESPACE = 'auth_db_snapshot'
+# Size of each memcache shard of a serialized AuthDB snapshot. Memcache values
+# are limited to 1mb.
+_AUTH_DB_MEMCACHE_SHARD_SIZE = 1000 * 1000
+# Number of shards fetched in the first memcache get_multi. Snapshots larger
+# than this require a second round trip.
+_AUTH_DB_MEMCACHE_PREFETCH_SHARDS = 4
+
 
 ################################################################################
 ## Exception classes.
@@ -104,6 +119,14 @@ class UninitializedError(Error):
 SecretKey = collections.namedtuple('SecretKey', ['name', 'scope'])
 
 
+# Flattened view of a group and all its nested groups, see AuthDB._get_closure.
+#   groups: frozenset of the names of the known groups in the closure.
+#   glob_matchers: dict identity kind -> match function of all the globs.
+#   has_all: True if the wildcard group is nested.
+_GroupClosure = collections.namedtuple(
+    '_GroupClosure', 'groups, glob_matchers, has_all')
+
+
 class AuthDB(object):
   """A read only in-memory database of auth configuration of a service.
 
@@ -140,6 +163,15 @@ class AuthDB(object):
         ip_whitelist_assignments or model.AuthIPWhitelistAssignments())
     self.entity_group_version = entity_group_version
 
+    # Direct members of each group, for O(1) lookups.
+    self._members = {
+      name: frozenset(g.members) for name, g in self.groups.iteritems()
+    }
+    # Lazily populated cache of _GroupClosure for each group queried. AuthDB is
+    # immutable, so it stays valid for the lifetime of this snapshot. Racing
+    # threads may compute the same closure twice, it is harmless.
+    self._closures = {}
+
     # Split |secrets| into local and global ones based on parent key id.
     for secret in (secrets or []):
       scope = secret.key.parent().string_id()
@@ -147,45 +179,70 @@ class AuthDB(object):
       assert secret.key.string_id() not in self.secrets[scope], secret.key
       self.secrets[scope][secret.key.string_id()] = secret
 
-  def is_group_member(self, group_name, identity):
-    """Returns True if |identity| belongs to group |group_name|.
+  def _get_closure(self, group_name):
+    """Returns _GroupClosure for a known group, computing it if necessary."""
+    closure = self._closures.get(group_name)
+    if closure is not None:
+      return closure
 
-    Unknown groups are considered empty.
-    """
-    # While the code to add groups refuses to add cycle, this code ensures that
-    # it doesn't go in a cycle by keeping track of the groups visited in |seen|.
+    # Walk the nested groups graph. While the code to add groups refuses to add
+    # cycle, this code ensures that it doesn't go in a cycle by keeping track of
+    # the groups visited in |seen|.
     seen = set()
-
-    def is_group_member_internal(group_name, identity):
-      # Wildcard group that matches all identities (including anonymous!).
-      if group_name == model.GROUP_ALL:
-        return True
-
+    has_all = False
+    globs = collections.defaultdict(list)
+    stack = [group_name]
+    while stack:
+      name = stack.pop()
+      if name == model.GROUP_ALL:
+        # Wildcard group that matches all identities (including anonymous!).
+        has_all = True
+        continue
       # An unknown group is empty.
-      group_obj = self.groups.get(group_name)
+      group_obj = self.groups.get(name)
       if not group_obj:
-        return False
+        continue
+      if name in seen:
+        logging.error('Cycle in a group graph\nInfo: %s, %s', name, seen)
+        continue
+      seen.add(name)
+      for glob in group_obj.globs:
+        globs[glob.kind].append(glob.pattern)
+      stack.extend(group_obj.nested)
+
+    matchers = {
+      kind: re.compile(
+          '|'.join('(?:%s)' % fnmatch.translate(p) for p in patterns)).match
+      for kind, patterns in globs.iteritems()
+    }
+    closure = _GroupClosure(frozenset(seen), matchers, has_all)
+    self._closures[group_name] = closure
+    return closure
 
-      # Use |seen| to detect and avoid cycles in group nesting graph.
-      if group_name in seen:
-        logging.error('Cycle in a group graph\nInfo: %s, %s', group_name, seen)
-        return False
-      seen.add(group_name)
+  def is_group_member(self, group_name, identity):
+    """Returns True if |identity| belongs to group |group_name|.
 
-      # Globs first, there's usually a higher chance to find identity there.
-      if any(glob.match(identity) for glob in group_obj.globs):
-        return True
+    Unknown groups are considered empty.
+    """
+    # Wildcard group that matches all identities (including anonymous!).
+    if group_name == model.GROUP_ALL:
+      return True
 
-      # Explicit member list, it's fast.
-      if any(identity == m for m in group_obj.members):
-        return True
+    # An unknown group is empty.
+    if group_name not in self.groups:
+      return False
 
-      # Slowest nested group check last.
-      return any(
-          is_group_member_internal(nested, identity)
-          for nested in group_obj.nested)
+    closure = self._get_closure(group_name)
+    if closure.has_all:
+      return True
 
-    return is_group_member_internal(group_name, identity)
+    # Globs first, there's usually a higher chance to find identity there.
+    matcher = closure.glob_matchers.get(identity.kind)
+    if matcher and matcher(identity.name):
+      return True
+
+    # Explicit member lists, one set lookup per group in the closure.
+    return any(identity in self._members[name] for name in closure.groups)
 
   def list_group(self, group_name, recursive=True):
     """Returns a set of all identities in a group.
@@ -197,32 +254,17 @@ class AuthDB(object):
     Returns:
       Set of Identity objects. Unknown groups are considered empty.
     """
-    if not recursive:
-      group_obj = self.groups.get(group_name)
-      return set(group_obj.members) if group_obj else set()
-
-    # While the code to add groups refuses to add cycle, this code ensures that
-    # it doesn't go in a cycle by keeping track of the groups visited in |seen|.
-    seen = set()
+    # An unknown group is empty.
+    if group_name not in self.groups:
+      return set()
 
-    def list_group_internal(group_name):
-      # An unknown group is empty.
-      group_obj = self.groups.get(group_name)
-      if not group_obj:
-        return set()
-
-      # Use |seen| to detect and avoid cycles in group nesting graph.
-      if group_name in seen:
-        logging.error('Cycle in a group graph\nInfo: %s, %s', group_name, seen)
-        return set()
-      seen.add(group_name)
-
-      members = set(group_obj.members)
-      for nested in group_obj.nested:
-        members.update(list_group_internal(nested))
-      return members
+    if not recursive:
+      return set(self._members[group_name])
 
-    return list_group_internal(group_name)
+    members = set()
+    for name in self._get_closure(group_name).groups:
+      members.update(self._members[name])
+    return members
 
   def get_secret(self, secret_key):
     """Returns list of strings with last known values of a secret.
@@ -482,6 +524,105 @@ def get_request_cache():
   return request_cache
 
 
+def _auth_db_memcache_keys(version, first, last):
+  """Returns the memcache keys of the shards [first, last) of a snapshot."""
+  return ['%s:%d' % (version, i) for i in xrange(first, last)]
+
+
+def _auth_db_snapshot_to_memcache(
+    version, global_config, groups, secrets, ip_whitelists,
+    ip_whitelist_assignments):
+  """Saves AuthDB entities in memcache as a snapshot for |version|.
+
+  The entities are serialized as datastore entity protobufs, pickled, zlib
+  compressed and split in shards to fit memcache values size limit. The first
+  shard also contains the total number of shards.
+  """
+  adapter = ndb.ModelAdapter()
+  def encode(entity):
+    return adapter.entity_to_pb(entity).Encode() if entity else None
+  blob = zlib.compress(cPickle.dumps(
+      (
+        encode(global_config),
+        [encode(e) for e in groups],
+        [encode(e) for e in secrets],
+        [encode(e) for e in ip_whitelists],
+        encode(ip_whitelist_assignments),
+      ),
+      cPickle.HIGHEST_PROTOCOL))
+  chunks = [
+    blob[i:i+_AUTH_DB_MEMCACHE_SHARD_SIZE]
+    for i in xrange(0, len(blob), _AUTH_DB_MEMCACHE_SHARD_SIZE)
+  ]
+  values = [(len(chunks), chunks[0])] + chunks[1:]
+  keys = _auth_db_memcache_keys(version, 0, len(chunks))
+  failed = memcache.set_multi(
+      dict(zip(keys, values)), namespace=_AUTH_DB_MEMCACHE_NAMESPACE)
+  if failed:
+    logging.warning('Failed to save AuthDB snapshot %s in memcache', version)
+
+
+def _auth_db_snapshot_from_memcache(version):
+  """Returns the AuthDB entities saved in memcache for |version| or None.
+
+  A corrupted or incompatible snapshot is deleted from memcache, so the next
+  fetch_auth_db() saves a new one from the datastore.
+
+  Returns:
+    Tuple (global_config, groups, secrets, ip_whitelists,
+    ip_whitelist_assignments) or None if the snapshot is missing, incomplete or
+    corrupted.
+  """
+  values = memcache.get_multi(
+      _auth_db_memcache_keys(version, 0, _AUTH_DB_MEMCACHE_PREFETCH_SHARDS),
+      namespace=_AUTH_DB_MEMCACHE_NAMESPACE)
+  first = values.get('%s:0' % version)
+  if not first:
+    return None
+  count, chunk = first
+  if count > _AUTH_DB_MEMCACHE_PREFETCH_SHARDS:
+    values.update(memcache.get_multi(
+        _auth_db_memcache_keys(
+            version, _AUTH_DB_MEMCACHE_PREFETCH_SHARDS, count),
+        namespace=_AUTH_DB_MEMCACHE_NAMESPACE))
+  chunks = [chunk]
+  for key in _auth_db_memcache_keys(version, 1, count):
+    if key not in values:
+      # One shard was evicted, the whole snapshot is unusable.
+      return None
+    chunks.append(values[key])
+
+  adapter = ndb.ModelAdapter()
+  def decode(serialized):
+    if not serialized:
+      return None
+    return adapter.pb_to_entity(
+        ndb.google_imports.entity_pb.EntityProto(serialized))
+  try:
+    (global_config, groups, secrets, ip_whitelists,
+        ip_whitelist_assignments) = cPickle.loads(
+            zlib.decompress(''.join(chunks)))
+    return (
+        decode(global_config),
+        [decode(e) for e in groups],
+        [decode(e) for e in secrets],
+        [decode(e) for e in ip_whitelists],
+        decode(ip_whitelist_assignments))
+  except (
+      EOFError,
+      ProtocolBuffer.ProtocolBufferDecodeError,
+      TypeError,
+      ValueError,
+      cPickle.UnpicklingError,
+      ndb.KindError,
+      zlib.error) as e:
+    logging.error('Corrupted AuthDB snapshot %s in memcache: %s', version, e)
+    memcache.delete_multi(
+        _auth_db_memcache_keys(version, 0, count),
+        namespace=_AUTH_DB_MEMCACHE_NAMESPACE)
+    return None
+
+
 def fetch_auth_db(known_version=None):
   """Returns instance of AuthDB.
 
@@ -521,10 +662,22 @@ def fetch_auth_db(known_version=None):
     if known_version is not None and current_version == known_version:
       return None
 
-    # TODO(vadimsh): Add memcache keyed at |current_version| so only one
-    # frontend instance have to pay the cost of fetching AuthDB from Datastore
-    # via multiple RPCs. All other instances will fetch it via single
-    # memcache 'get'.
+    # Only one frontend instance has to pay the cost of fetching AuthDB from
+    # Datastore via multiple RPCs. All other instances fetch it from memcache
+    # keyed at |current_version|. Since the entity group version changes on
+    # every modification, a snapshot in memcache is never stale.
+    if current_version is not None:
+      snapshot = _auth_db_snapshot_from_memcache(current_version)
+      if snapshot:
+        (global_config, groups, secrets, ip_whitelists,
+            ip_whitelist_assignments) = snapshot
+        return AuthDB(
+            global_config=global_config,
+            groups=groups,
+            secrets=secrets,
+            ip_whitelists=ip_whitelists,
+            ip_whitelist_assignments=ip_whitelist_assignments,
+            entity_group_version=current_version)
 
     # Fetch all stuff in parallel. Fetch ALL groups and ALL secrets.
     global_config_future = root_key.get_async()
@@ -537,10 +690,17 @@ def fetch_auth_db(known_version=None):
     # Note that get_entity_group_version() uses same entity group (root_key)
     # internally and respects transactions. So all data fetched here does indeed
     # correspond to |current_version|.
+    global_config = global_config_future.get_result()
+    groups = groups_future.get_result()
+    secrets = secrets_future.get_result()
+    if current_version is not None:
+      _auth_db_snapshot_to_memcache(
+          current_version, global_config, groups, secrets, ip_whitelists,
+          ip_whitelist_assignments)
     return AuthDB(
-        global_config=global_config_future.get_result(),
-        groups=groups_future.get_result(),
-        secrets=secrets_future.get_result(),
+        global_config=global_config,
+        groups=groups,
+        secrets=secrets,
         ip_whitelists=ip_whitelists,
         ip_whitelist_assignments=ip_whitelist_assignments,
         entity_group_version=current_version)
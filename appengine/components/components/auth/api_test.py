@@ -10,6 +10,7 @@
 import Queue
 import sys
 import threading
+import time
 import unittest
 
 from test_support import test_env
@@ -127,6 +128,35 @@ class AuthDBTest(test_case.TestCase):
         auth_db.is_group_member('Group1', model.Anonymous))
     self.assertEqual(1, len(errors))
 
+  def test_is_group_member_large(self):
+    # 5 levels of nested groups of 10k members each, 50k members in total.
+    groups = []
+    for level in xrange(5):
+      group = model.AuthGroup(id='Level%d' % level)
+      group.members.extend(
+          model.Identity(model.IDENTITY_USER, 'u%d-%d@example.com' % (level, i))
+          for i in xrange(10000))
+      if level != 4:
+        group.nested.append('Level%d' % (level + 1))
+      groups.append(group)
+    groups[4].globs.append(model.IdentityGlob(model.IDENTITY_BOT, 'vm*'))
+    auth_db = api.AuthDB(groups=groups)
+
+    deepest = model.Identity(model.IDENTITY_USER, 'u4-9999@example.com')
+    bot = model.Identity(model.IDENTITY_BOT, 'vm1-a')
+    stranger = model.Identity(model.IDENTITY_USER, 'joe@example.com')
+    start = time.time()
+    for _ in xrange(1000):
+      self.assertTrue(auth_db.is_group_member('Level0', deepest))
+      self.assertTrue(auth_db.is_group_member('Level0', bot))
+      self.assertFalse(auth_db.is_group_member('Level0', stranger))
+      self.assertFalse(auth_db.is_group_member('Level1', groups[0].members[0]))
+    _duration = time.time() - start
+    self.assertEqual(50000, len(auth_db.list_group('Level0')))
+    self.assertEqual(10000, len(auth_db.list_group('Level0', recursive=False)))
+    # Enable to get actual numbers on your workstation:
+    #print('\n4000 checks: %.4fs' % _duration)
+
   def test_is_allowed_oauth_client_id(self):
     global_config = model.AuthGlobalConfig(
         oauth_client_id='1',
@@ -211,6 +241,56 @@ class AuthDBTest(test_case.TestCase):
         {'bots': bots_ip_whitelist, 'some ip whitelist': some_ip_whitelist},
         auth_db.ip_whitelists)
 
+  def test_fetch_auth_db_memcache(self):
+    self.mock(api.metadata, 'get_entity_group_version', lambda _: 123)
+    # Forces the snapshot to be split in multiple shards and fetched in two
+    # round trips.
+    self.mock(api, '_AUTH_DB_MEMCACHE_SHARD_SIZE', 10)
+    self.mock(api, '_AUTH_DB_MEMCACHE_PREFETCH_SHARDS', 1)
+    ident = model.Identity(model.IDENTITY_USER, 'a@example.com')
+    model.AuthGroup(key=model.group_key('Group A'), members=[ident]).put()
+    model.AuthSecret.bootstrap('local0', 'local')
+    auth_db = api.fetch_auth_db()
+    self.assertEqual(['Group A'], auth_db.groups.keys())
+    self.assertEqual(['local0'], auth_db.secrets['local'].keys())
+
+    # The datastore is not used anymore since the version didn't change.
+    model.group_key('Group A').delete()
+    auth_db = api.fetch_auth_db()
+    self.assertEqual(123, auth_db.entity_group_version)
+    self.assertEqual(['Group A'], auth_db.groups.keys())
+    self.assertEqual([ident], auth_db.groups['Group A'].members)
+    self.assertEqual(['local0'], auth_db.secrets['local'].keys())
+    self.assertEqual(
+        model.root_key(), auth_db.global_config.key)
+
+  def test_fetch_auth_db_memcache_missing_shard(self):
+    self.mock(api.metadata, 'get_entity_group_version', lambda _: 123)
+    self.mock(api, '_AUTH_DB_MEMCACHE_SHARD_SIZE', 10)
+    model.AuthGroup(key=model.group_key('Group A')).put()
+    api.fetch_auth_db()
+    self.assertTrue(
+        api.memcache.delete('123:1', namespace='auth_db_snapshot'))
+
+    # The snapshot is incomplete so the datastore is used.
+    model.group_key('Group A').delete()
+    auth_db = api.fetch_auth_db()
+    self.assertEqual({}, auth_db.groups)
+
+  def test_fetch_auth_db_memcache_corrupted(self):
+    self.mock(api.metadata, 'get_entity_group_version', lambda _: 123)
+    model.AuthGroup(key=model.group_key('Group A')).put()
+    # A snapshot with an undecodable entity protobuf.
+    blob = api.zlib.compress(
+        api.cPickle.dumps(('garbage', [], [], [], None)))
+    api.memcache.set('123:0', (1, blob), namespace='auth_db_snapshot')
+
+    # The datastore is used and the snapshot is replaced.
+    auth_db = api.fetch_auth_db()
+    self.assertEqual(['Group A'], auth_db.groups.keys())
+    self.assertNotEqual(
+        (1, blob), api.memcache.get('123:0', namespace='auth_db_snapshot'))
+
   def test_get_secret(self):
     # Make AuthDB with two secrets.
     local_secret = model.AuthSecret.bootstrap('local_secret', 'local')
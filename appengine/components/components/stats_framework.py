@@ -9,15 +9,22 @@ potential datastore inconsistencies, in a transaction-less and efficient manner.
 
 This framework doesn't gather data by itself. Data harvesting, the actual
 measurements saved and presentations must be supplied by the user.
+
+Entries are either scraped from the logs or, when the user streams them to a
+pull queue with stream_entry(), leased back from this queue. Scanning the logs
+is slow on busy servers so it is then only used as a backfill.
 """
 
 import calendar
 import collections
 import datetime
+import json
 import logging
+import threading
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import logservice
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.runtime import DeadlineExceededError
 
@@ -39,10 +46,28 @@ RESOLUTIONS = ('days', 'hours', 'minutes')
 TOO_RECENT = 5 if not utils.is_local_dev_server() else 1
 
 
+# Maximum number of streamed entries leased or deleted at once.
+_STREAM_LEASE_MAX = 1000
+
+
+# Duration of the lease on the streamed entries, in seconds.
+_STREAM_LEASE_SECS = 10*60
+
+
 # One handled HTTP request and the associated statistics if any.
 StatsEntry = collections.namedtuple('StatsEntry', ('request', 'entries'))
 
 
+# Replaces logservice.RequestLog for the requests counted by StreamMiddleware.
+# Holds the number of requests and of requests that failed with HTTP 5xx.
+StreamedRequests = collections.namedtuple(
+    'StreamedRequests', ('requests', 'failures'))
+
+
+# Entries buffered by StreamMiddleware for the request handled by this thread.
+_stream_buffer = threading.local()
+
+
 class StatisticsFramework(object):
   def __init__(
       self, root_key_id, snapshot_cls, generate_snapshot,
@@ -118,6 +143,7 @@ class StatisticsFramework(object):
     except (
         datastore_errors.TransactionFailedError,
         logservice.Error,
+        taskqueue.Error,
         DeadlineExceededError) as e:
       msg = (
           'Got an error while processing stats.\n'
@@ -543,6 +569,47 @@ def _yield_logs(start_time, end_time):
     yield request
 
 
+def _get_stream_tag(timestamp):
+  """Returns the pull queue tag of the entries streamed at this epoch."""
+  return str(int(timestamp) / 60 * 60)
+
+
+def _stream(queue_name, tag, payload):
+  """Adds payload to the pull queue queue_name with the minute tag."""
+  try:
+    taskqueue.Queue(queue_name).add_async(
+        taskqueue.Task(method='PULL', payload=payload, tag=tag)).get_result()
+  except taskqueue.Error as e:
+    logging.warning('Failed to stream stats entry: %s', e)
+
+
+def _decode_stream_payload(payload):
+  """Returns a StatsEntry out of a task added by stream_entry()."""
+  try:
+    data = json.loads(payload)
+  except ValueError:
+    data = None
+  if isinstance(data, list) and len(data) >= 2:
+    # Added by StreamMiddleware: [requests, failures, entry, entry, ...].
+    return StatsEntry(StreamedRequests(data[0], data[1]), data[2:])
+  # A single entry added outside of StreamMiddleware.
+  return StatsEntry(None, [payload])
+
+
+def _lease_stream_tasks(queue_name, start_time, end_time):
+  """Leases all the tasks added by stream_entry() in [start_time, end_time[."""
+  queue = taskqueue.Queue(queue_name)
+  tasks = []
+  for minute in xrange(int(start_time) / 60 * 60, int(end_time), 60):
+    while True:
+      leased = queue.lease_tasks_by_tag(
+          _STREAM_LEASE_SECS, _STREAM_LEASE_MAX, tag=str(minute))
+      if not leased:
+        break
+      tasks.extend(leased)
+  return tasks
+
+
 def _get_snapshot_as_dict_future(keys):
   """Gets post-processed entities referenced by keys.
 
@@ -602,6 +669,80 @@ def add_entry(message):
   logging.debug(PREFIX + message)
 
 
+def stream_entry(queue_name, message):
+  """Adds an entry to the pull queue queue_name, tagged with the current minute.
+
+  It permits yield_entries() to retrieve the entries without scanning the logs.
+  add_entry() should still be called so the logs can be used as a backfill.
+
+  When the request is handled by a StreamMiddleware for queue_name, the entry is
+  buffered and added along the other entries of the request once it completes.
+
+  Meant to be mocked in tests.
+  """
+  if getattr(_stream_buffer, 'queue_name', None) == queue_name:
+    _stream_buffer.entries.append(message)
+  else:
+    _stream(queue_name, _get_stream_tag(utils.time_time()), message)
+
+
+class StreamMiddleware(object):
+  """WSGI middleware that streams the entries of a request in one task.
+
+  The entries added with stream_entry() while handling a request are added to
+  queue_name in a single task once the request completes. Requests that added
+  no entry don't cost any taskqueue RPC.
+
+  The HTTP requests are counted per instance. The counts are sent along the
+  next task of the same minute, or in a task of their own with the first
+  request of the next minute. The counts of an instance that shuts down before
+  are lost.
+  """
+  def __init__(self, app, queue_name):
+    self._app = app
+    self._queue_name = queue_name
+    self._lock = threading.Lock()
+    # Counts not streamed yet: [minute tag, requests, failures].
+    self._pending = [None, 0, 0]
+
+  def __call__(self, environ, start_response):
+    status = [500]
+    def _start_response(s, headers, exc_info=None):
+      status[0] = int(s.split(' ', 1)[0])
+      return start_response(s, headers, exc_info)
+
+    _stream_buffer.queue_name = self._queue_name
+    _stream_buffer.entries = []
+    try:
+      return self._app(environ, _start_response)
+    finally:
+      entries = _stream_buffer.entries
+      _stream_buffer.queue_name = None
+      _stream_buffer.entries = None
+      self._stream_request(status[0], entries)
+
+  def _stream_request(self, status, entries):
+    """Counts the request and streams its entries if any."""
+    tag = _get_stream_tag(utils.time_time())
+    previous = None
+    current = None
+    with self._lock:
+      if self._pending[0] != tag:
+        if self._pending[1]:
+          previous = self._pending
+        self._pending = [tag, 0, 0]
+      self._pending[1] += 1
+      if status >= 500:
+        self._pending[2] += 1
+      if entries:
+        current = self._pending
+        self._pending = [tag, 0, 0]
+    if previous:
+      _stream(self._queue_name, previous[0], json.dumps(previous[1:]))
+    if current:
+      _stream(self._queue_name, tag, json.dumps(current[1:] + entries))
+
+
 def accumulate(lhs, rhs, skip):
   """Adds the values from rhs into lhs.
 
@@ -658,13 +799,35 @@ def accumulate(lhs, rhs, skip):
           logging.error('Couldn\'t set %s to %s', key, value)
 
 
-def yield_entries(start_time, end_time):
+def yield_entries(start_time, end_time, stream_queue=None):
   """Yields StatsEntry in this time interval.
 
   Look at requests that *ended* between [start_time, end_time[. Ignore the start
   time of the request. This is because the parameters start_time and end_time of
   logserver.fetch() filters on the completion time of the request.
+
+  When stream_queue is specified, the entries added with stream_entry() between
+  [start_time, end_time[ are yielded instead, one StatsEntry per task streamed
+  by StreamMiddleware with request set to a StreamedRequests, or one per entry
+  with request set to None when added outside of StreamMiddleware.
+  They are deleted once all of them were yielded. The logs are only used when
+  no entry was streamed in this time interval, e.g. before streaming was
+  enabled or when a previous run consumed the entries but failed to save the
+  snapshot.
   """
+  if stream_queue:
+    assert start_time and end_time, (start_time, end_time)
+    tasks = _lease_stream_tasks(stream_queue, start_time, end_time)
+    if tasks:
+      for task in tasks:
+        yield _decode_stream_payload(task.payload)
+      # Delete only once all the entries were processed. On failure, they will
+      # be leased again once the lease expires.
+      queue = taskqueue.Queue(stream_queue)
+      for i in xrange(0, len(tasks), _STREAM_LEASE_MAX):
+        queue.delete_tasks(tasks[i:i+_STREAM_LEASE_MAX])
+      return
+
   offset = len(PREFIX)
   for request in _yield_logs(start_time, end_time):
     if not request.finished or not request.end_time:
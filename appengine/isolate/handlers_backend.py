@@ -296,6 +296,7 @@ class InternalTagWorkerHandler(webapp2.RequestHandler):
           to_save.append(item)
       if to_save:
         ndb.put_multi(to_save)
+        model.cache_entries(to_save)
       logging.info(
           'Timestamped %d entries out of %s', len(to_save), len(digests))
     except Exception as e:
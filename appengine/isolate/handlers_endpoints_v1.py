@@ -193,7 +193,7 @@ class IsolateService(remote.Service):
           'Only up to 1000 items can be looked up at once')
 
     # check for existing elements
-    new_digests, existing_digests = self.partition_collection(request)
+    new_digests, existing_digests, to_tag = self.partition_collection(request)
 
     # process all elements; add an upload ticket for cache misses
     for index, digest_element in enumerate(request.items):
@@ -220,9 +220,9 @@ class IsolateService(remote.Service):
 
         response.items.append(status)
 
-    # Tag existing entities and collect stats.
+    # Tag existing entities that are due and collect stats.
     self.tag_existing(DigestCollection(
-        items=list(existing_digests), namespace=request.namespace))
+        items=list(to_tag), namespace=request.namespace))
     stats.add_entry(stats.LOOKUP, len(request.items), len(existing_digests))
     return response
 
@@ -397,36 +397,58 @@ class IsolateService(remote.Service):
   def check_entries_exist(cls, entries):
     """Assess which entities already exist in the datastore.
 
+    Entities recently confirmed to exist are looked up in memcache, the others
+    are fetched from the datastore in a single batch.
+
     Arguments:
       entries: a DigestCollection to be posted
 
     Yields:
-      digest, Boolean pairs, where Boolean indicates existence of the entry
+      digest, Boolean, Boolean tuples, where the first Boolean indicates
+      existence of the entry and the second if its expiration is due to be
+      updated by tag_existing().
 
     Raises:
       BadRequestException if any digest is not a valid hexadecimal number.
     """
-    # Kick off all queries in parallel. Build mapping Future -> digest.
-    futures = {}
+    namespace = entries.namespace.namespace
+    keys = [
+      entry_key_or_error(namespace, digest.digest) for digest in entries.items
+    ]
+    # hash_key -> next_tag_ts timestamp of existing entries.
+    next_tags = model.get_cached_entries(
+        namespace, [digest.digest for digest in entries.items])
+    to_get = [
+      key for digest, key in zip(entries.items, keys)
+      if digest.digest not in next_tags
+    ]
+    if to_get:
+      found = [e for e in ndb.get_multi(to_get, use_cache=False) if e]
+      model.cache_entries(found)
+      for entry in found:
+        next_tags[entry.key.id().rsplit('/', 1)[1]] = (
+            utils.datetime_to_timestamp(entry.next_tag_ts)
+            if entry.next_tag_ts else 0)
+
+    # TODO(maruel): For items that were present, make sure
+    # entry.compressed_size == digest.size.
+    now = utils.datetime_to_timestamp(utils.utcnow())
     for digest in entries.items:
-      # check for error conditions
-      key = entry_key_or_error(entries.namespace.namespace, digest.digest)
-      futures[key.get_async(use_cache=False)] = digest
-
-    # Pick first one that finishes and yield it, rinse, repeat.
-    while futures:
-      future = ndb.Future.wait_any(futures)
-      # TODO(maruel): For items that were present, make sure
-      # future.get_result().compressed_size == digest.size.
-      yield futures.pop(future), bool(future.get_result())
+      next_tag = next_tags.get(digest.digest)
+      yield digest, next_tag is not None, next_tag is not None and next_tag < now
 
   @classmethod
   def partition_collection(cls, entries):
-    """Create sets of existent and new digests."""
-    seen_unseen = [set(), set()]
-    for digest, exists in cls.check_entries_exist(entries):
-      seen_unseen[exists].add(digest)
-    return seen_unseen
+    """Create sets of new digests, existent digests and the ones to tag."""
+    new, existing, to_tag = set(), set(), set()
+    for digest, exists, needs_tag in cls.check_entries_exist(entries):
+      if not exists:
+        new.add(digest)
+        continue
+      existing.add(digest)
+      if needs_tag:
+        to_tag.add(digest)
+    return new, existing, to_tag
 
   @classmethod
   def should_push_to_gs(cls, digest):
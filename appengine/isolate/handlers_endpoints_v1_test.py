@@ -4,6 +4,7 @@
 # found in the LICENSE file.
 
 import base64
+import datetime
 import hashlib
 import json
 import logging
@@ -236,8 +237,11 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     key = model.get_entry_key(
         collection.namespace.namespace, collection.items[0].digest)
 
-    # guarantee that one digest already exists in the datastore
-    model.new_content_entry(key).put()
+    # guarantee that one digest already exists in the datastore and is due to
+    # be tagged
+    entry = model.new_content_entry(key)
+    entry.next_tag_ts = utils.utcnow() - datetime.timedelta(seconds=1)
+    entry.put()
     self.call_api(
         'preupload', self.message_to_dict(collection), 200)
 
@@ -245,6 +249,67 @@ class IsolateServiceTest(test_case.EndpointsTestCase):
     enqueued_tasks = self.execute_tasks()
     self.assertEqual(1, enqueued_tasks)
 
+  def test_check_existing_skips_recently_tagged(self):
+    """Assert that existent entities not due to be tagged are not enqueued."""
+    collection = generate_collection(['some content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    model.new_content_entry(key).put()
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual([], response.json.get('items', []))
+    self.assertEqual(0, self.execute_tasks())
+
+  def test_check_existing_memcache(self):
+    """Assert that existent entities are remembered until deleted."""
+    self.mock(gcs, 'delete_files', lambda *_args, **_kwargs: [])
+    collection = generate_collection(['some content'])
+    key = model.get_entry_key(
+        collection.namespace.namespace, collection.items[0].digest)
+    model.new_content_entry(key).put()
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+
+    # The entity is remembered, even if it was deleted behind the cache's back.
+    key.delete()
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual([], response.json.get('items', []))
+
+    # Deleting the entity through model evicts it.
+    model.delete_entry_and_gs_entry([key])
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(1, len(response.json['items']))
+
+  def test_check_existing_memcache_deleted(self):
+    """Assert that entities deleted after being fetched are not remembered."""
+    self.mock(gcs, 'delete_files', lambda *_args, **_kwargs: [])
+    collection = generate_collection(['some content'])
+    digest = collection.items[0].digest
+    namespace = collection.namespace.namespace
+    key = model.get_entry_key(namespace, digest)
+    model.new_content_entry(key).put()
+
+    # A reader fetched the entity right before it was deleted.
+    entry = key.get()
+    model.delete_entry_and_gs_entry([key])
+    model.cache_entries([entry])
+    self.assertEqual({}, model.get_cached_entries(namespace, [digest]))
+    response = self.call_api(
+        'preupload', self.message_to_dict(collection), 200)
+    self.assertEqual(1, len(response.json['items']))
+
+  def test_check_existing_memcache_expiring(self):
+    """Assert that entities about to expire are not remembered."""
+    collection = generate_collection(['some content'])
+    digest = collection.items[0].digest
+    namespace = collection.namespace.namespace
+    entry = model.new_content_entry(model.get_entry_key(namespace, digest))
+    entry.expiration_ts = utils.utcnow() + datetime.timedelta(minutes=1)
+    entry.put()
+    self.call_api('preupload', self.message_to_dict(collection), 200)
+    self.assertEqual({}, model.get_cached_entries(namespace, [digest]))
+
   def test_store_inline_ok(self):
     """Assert that inline content storage completes successfully."""
     request = self.store_request('sibilance')
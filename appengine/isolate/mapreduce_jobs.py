@@ -15,6 +15,7 @@ from mapreduce import control
 
 import config
 import gcs
+import model
 
 
 # Task queue name to run all map reduce jobs on.
@@ -83,4 +84,5 @@ def delete_broken_entries(entry):
     # to cleanup memcache, otherwise the rest of the isolate service will still
     # think that entity exists.
     entry.key.delete(use_memcache=True)
+    model.evict_cached_entries([entry.key])
     logging.error('MR: deleted bad entry\n%s', entry.key.id())
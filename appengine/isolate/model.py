@@ -32,6 +32,19 @@ MAX_MEMCACHE_ISOLATED = 500*1024
 NAMESPACE_RE = r'[a-z0-9A-Z\-._]+'
 
 
+# Maximum duration in seconds an existing ContentEntry is remembered in
+# memcache, see get_cached_entries(). Entries expiring sooner than that are not
+# remembered, so the cleanup cron job can't delete a remembered entry. Entries
+# deleted otherwise are evicted explicitly.
+EXISTS_MEMCACHE_EXPIRATION = 5*60
+
+
+# Value remembered in memcache for a deleted ContentEntry, for
+# EXISTS_MEMCACHE_EXPIRATION. It prevents a concurrent reader that fetched the
+# entity before its deletion from remembering it as existing.
+_EXISTS_MEMCACHE_DELETED = -1
+
+
 #### Models
 
 
@@ -199,6 +212,60 @@ def new_content_entry(key, **kwargs):
       key=key, expiration_ts=expiration, next_tag_ts=next_tag, **kwargs)
 
 
+def get_cached_entries(namespace, hash_keys):
+  """Returns the entries of |hash_keys| remembered as existing.
+
+  Returns:
+    dict hash_key -> timestamp of the entry's next_tag_ts.
+  """
+  cached = memcache.get_multi(hash_keys, namespace='exists_%s' % namespace)
+  return {
+    k: v for k, v in cached.iteritems() if v != _EXISTS_MEMCACHE_DELETED
+  }
+
+
+def cache_entries(entries):
+  """Remembers that ContentEntry |entries| exist, in a single memcache call.
+
+  memcache.add_multi() is used so an entry evicted by evict_cached_entries()
+  after it was fetched is not remembered. As a side effect, an entry already
+  remembered keeps its previous next_tag_ts until it expires from memcache.
+  """
+  # Do not remember entries that could be deleted by the cleanup cron job
+  # before they expire from memcache.
+  min_expiration = utils.utcnow() + datetime.timedelta(
+      seconds=EXISTS_MEMCACHE_EXPIRATION)
+  per_namespace = {}
+  for entry in entries:
+    if entry.expiration_ts < min_expiration:
+      continue
+    namespace, hash_key = entry.key.id().rsplit('/', 1)
+    per_namespace.setdefault(namespace, {})[hash_key] = (
+        utils.datetime_to_timestamp(entry.next_tag_ts)
+        if entry.next_tag_ts else 0)
+  for namespace, mapping in per_namespace.iteritems():
+    memcache.add_multi(
+        mapping, time=EXISTS_MEMCACHE_EXPIRATION,
+        namespace='exists_%s' % namespace)
+
+
+def evict_cached_entries(keys):
+  """Forgets that the ContentEntry of |keys| exist.
+
+  Must be called after the entities are deleted. They are remembered as deleted
+  for EXISTS_MEMCACHE_EXPIRATION, see cache_entries().
+  """
+  per_namespace = {}
+  for key in keys:
+    namespace, hash_key = key.id().rsplit('/', 1)
+    per_namespace.setdefault(namespace, []).append(hash_key)
+  for namespace, hash_keys in per_namespace.iteritems():
+    memcache.set_multi(
+        dict.fromkeys(hash_keys, _EXISTS_MEMCACHE_DELETED),
+        time=EXISTS_MEMCACHE_EXPIRATION,
+        namespace='exists_%s' % namespace)
+
+
 def delete_entry_and_gs_entry(keys_to_delete):
   """Deletes synchronously a list of ContentEntry and their GS files.
 
@@ -209,6 +276,7 @@ def delete_entry_and_gs_entry(keys_to_delete):
   """
   # Always delete ContentEntry first.
   ndb.delete_multi(keys_to_delete)
+  evict_cached_entries(keys_to_delete)
   # Note that some content entries may NOT have corresponding GS files. That
   # happens for small entries stored inline in the datastore or memcache. Since
   # this function operates only on keys, it can't distinguish "large" entries
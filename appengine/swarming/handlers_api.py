@@ -9,6 +9,7 @@ import datetime
 import json
 import logging
 import textwrap
+import time
 
 import webapp2
 
@@ -74,6 +75,33 @@ def log_unexpected_keys(expected_keys, actual_keys, request, source, name):
       expected_keys, expected_keys, actual_keys, request, source, name)
 
 
+def decode_output_page(output, offset, length=None):
+  """Decodes a page of output read at offset with at most length bytes.
+
+  Returns a tuple (unicode output, next offset, more). more is True when the
+  page is full so there may be more output to read. An incomplete UTF-8
+  sequence at the end is always left for the next page, since the task may
+  still be writing it.
+  """
+  if not output:
+    return output, offset, False
+  limit = task_result.TaskOutput.FETCH_MAX_CONTENT
+  if length is not None:
+    limit = min(length, limit)
+  more = len(output) >= limit
+  for i in xrange(1, min(4, len(output)) + 1):
+    c = ord(output[-i])
+    if c & 0xC0 == 0x80:
+      # Continuation byte.
+      continue
+    if c >= 0xC0 and (2 if c < 0xE0 else 3 if c < 0xF0 else 4) > i:
+      output = output[:-i]
+    break
+  # JSON then reencodes to ascii compatible encoded strings, which explodes
+  # the size.
+  return output.decode('utf-8', 'replace'), offset + len(output), more
+
+
 def process_doc(handler):
   lines = handler.__doc__.rstrip().splitlines()
   rest = textwrap.dedent('\n'.join(lines[1:]))
@@ -178,39 +206,139 @@ class ClientTaskResultRequestHandler(ClientTaskResultBase):
 
 
 class ClientTaskResultOutputHandler(ClientTaskResultBase):
-  """Task's output for a single command"""
+  """Task's output for a single command.
+
+  Arguments:
+    offset: offset in bytes to start reading from, to fetch only new output.
+    length: maximum number of bytes to return. The server may return less.
+  """
 
   @auth.require(acl.is_bot_or_user)
   def get(self, task_id, command_index):
+    try:
+      offset = int(self.request.get('offset', 0))
+      length = self.request.get('length')
+      length = int(length) if length else None
+    except ValueError:
+      self.abort_with_error(400, error='Invalid offset or length')
+    if offset < 0 or (length is not None and length < 0):
+      self.abort_with_error(400, error='Invalid offset or length')
     result = self.get_result_entity(task_id)
-    output = result.get_command_output_async(int(command_index)).get_result()
-    if output:
-      output = output.decode('utf-8', 'replace')
-    # JSON then reencodes to ascii compatible encoded strings, which explodes
-    # the size.
+    output = result.get_command_output_async(
+        int(command_index), offset, length).get_result()
+    output, next_offset, more = decode_output_page(output, offset, length)
     data = {
+      'more': more,
+      'next_offset': next_offset,
       'output': output,
     }
     self.send_response(utils.to_json_encodable(data))
 
 
 class ClientTaskResultOutputAllHandler(ClientTaskResultBase):
-  """All output from all commands in a task"""
+  """All output from all commands in a task.
+
+  Arguments:
+    offsets: comma separated offsets in bytes to start reading from for each
+        command, to fetch only new output.
+  """
 
   @auth.require(acl.is_bot_or_user)
   def get(self, task_id):
+    offsets = self.request.get('offsets')
+    try:
+      offsets = [int(i) for i in offsets.split(',')] if offsets else []
+    except ValueError:
+      self.abort_with_error(400, error='Invalid offsets')
+    if any(i < 0 for i in offsets):
+      self.abort_with_error(400, error='Invalid offsets')
     result = self.get_result_entity(task_id)
-    # JSON then reencodes to ascii compatible encoded strings, which explodes
-    # the size.
+    pages = [
+      decode_output_page(output, offsets[i] if i < len(offsets) else 0)
+      for i, output in enumerate(result.get_outputs(offsets))
+    ]
     data = {
-      'outputs': [
-        i.decode('utf-8', 'replace') if i else i
-        for i in result.get_outputs()
-      ],
+      'more': any(p[2] for p in pages),
+      'next_offsets': [p[1] for p in pages],
+      'outputs': [p[0] for p in pages],
     }
     self.send_response(utils.to_json_encodable(data))
 
 
+class ClientTasksWaitHandler(ClientTaskResultBase):
+  """Waits for any of many tasks to stop running.
+
+  Long-polls until at least one of the tasks is not pending nor running
+  anymore, or the timeout is reached. This permits a client to wait for a large
+  number of tasks with a single connection.
+
+  Request body is a JSON dict:
+    {
+      "task_ids": ["<task_id>", ...],
+      "timeout": <maximum number of seconds to wait>,
+    }
+
+  Response body is a JSON dict:
+    {
+      "results": {
+        "<task_id>": <same as /client/task/<task_id>>, ...
+      },
+    }
+  Only the tasks not running anymore are returned. A task that doesn't exist is
+  returned as null.
+  """
+  # Maximum time to wait, well below the request deadline.
+  MAX_TIMEOUT = 45.
+  # Delay between each lookup of the completion signals.
+  POLL_INTERVAL = 1.
+  # Delay between each read of all the pending tasks, in case a completion
+  # signal was evicted from memcache.
+  READ_INTERVAL = 10.
+  # Maximum number of tasks to wait for in a single request.
+  MAX_TASKS = 1000
+
+  @auth.require(acl.is_bot_or_user)
+  def post(self):
+    request = self.parse_body()
+    task_ids = request.get('task_ids')
+    if (not isinstance(task_ids, list) or not task_ids or
+        len(task_ids) > self.MAX_TASKS):
+      self.abort_with_error(400, error='Invalid task_ids')
+    try:
+      timeout = min(float(request.get('timeout', 0)), self.MAX_TIMEOUT)
+    except (TypeError, ValueError):
+      self.abort_with_error(400, error='Invalid timeout')
+    pending = {
+      task_id: self.get_result_key(task_id)[0] for task_id in task_ids
+    }
+
+    done = {}
+    deadline = utils.time_time() + timeout
+    next_read = 0
+    while True:
+      now = utils.time_time()
+      if now >= next_read:
+        to_read = sorted(pending)
+        next_read = now + self.READ_INTERVAL
+      else:
+        # Only read the tasks signaled as completed.
+        completed = task_result.get_completed_keys(pending.itervalues())
+        to_read = sorted(t for t, k in pending.iteritems() if k in completed)
+      if to_read:
+        # Skip the context cache, the entities are fetched repeatedly.
+        results = ndb.get_multi(
+            [pending[t] for t in to_read], use_cache=False)
+        for task_id, result in zip(to_read, results):
+          if (not result or
+              result.state not in task_result.State.STATES_RUNNING):
+            done[task_id] = result
+            del pending[task_id]
+      if done or utils.time_time() + self.POLL_INTERVAL > deadline:
+        break
+      time.sleep(self.POLL_INTERVAL)
+    self.send_response(utils.to_json_encodable({'results': done}))
+
+
 class ClientApiTasksHandler(auth.ApiHandler):
   """Requests all TaskResultSummary with filters.
 
@@ -457,6 +585,58 @@ class ClientRequestHandler(auth.ApiHandler):
     self.send_response(utils.to_json_encodable(data))
 
 
+class ClientRequestsHandler(auth.ApiHandler):
+  """Creates many new requests at once.
+
+  Request body is a JSON dict:
+    {
+      "requests": [<same as /client/request>, ...],
+    }
+
+  Response body is a JSON dict:
+    {
+      "tasks": [<same as /client/request>, ...],
+    }
+  The tasks are returned in the same order as the requests. The requests are
+  all validated before any is saved, so a single invalid request fails the
+  whole call.
+  """
+  # Maximum number of requests to create in a single call.
+  MAX_REQUESTS = 500
+
+  @auth.require(acl.is_bot_or_user)
+  def post(self):
+    requests_data = self.parse_body().get('requests')
+    if (not isinstance(requests_data, list) or not requests_data or
+        len(requests_data) > self.MAX_REQUESTS):
+      self.abort_with_error(400, error='Invalid requests')
+    is_bot_or_admin = acl.is_bot_or_admin()
+    for request_data in requests_data:
+      if not isinstance(request_data, dict):
+        self.abort_with_error(400, error='Invalid requests')
+      # If the priority is below 100, make the the user has right to do so.
+      if request_data.get('priority', 255) < 100 and not is_bot_or_admin:
+        # Silently drop the priority of normal users.
+        request_data['priority'] = 100
+
+    try:
+      requests = task_request.make_requests(requests_data)
+    except (datastore_errors.BadValueError, TypeError, ValueError) as e:
+      self.abort_with_error(400, error=str(e))
+
+    result_summaries = task_scheduler.schedule_requests(requests)
+    data = {
+      'tasks': [
+        {
+          'request': request.to_dict(),
+          'task_id': task_pack.pack_result_summary_key(result_summary.key),
+        }
+        for request, result_summary in zip(requests, result_summaries)
+      ],
+    }
+    self.send_response(utils.to_json_encodable(data))
+
+
 class ClientCancelHandler(auth.ApiHandler):
   """Cancels a task."""
 
@@ -485,6 +665,7 @@ def get_routes():
       ('/swarming/api/v1/client/handshake', ClientHandshakeHandler),
       ('/swarming/api/v1/client/list', ClientApiListHandler),
       ('/swarming/api/v1/client/request', ClientRequestHandler),
+      ('/swarming/api/v1/client/requests', ClientRequestsHandler),
       ('/swarming/api/v1/client/server', ClientApiServer),
       ('/swarming/api/v1/client/task/<task_id:[0-9a-f]+>',
           ClientTaskResultHandler),
@@ -497,5 +678,6 @@ def get_routes():
           ClientTaskResultOutputAllHandler),
       ('/swarming/api/v1/client/tasks', ClientApiTasksHandler),
       ('/swarming/api/v1/client/tasks/count', ClientApiTasksCountHandler),
+      ('/swarming/api/v1/client/tasks/wait', ClientTasksWaitHandler),
   ]
   return [webapp2.Route(*i) for i in routes]
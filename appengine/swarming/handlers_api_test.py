@@ -15,6 +15,8 @@ import unittest
 # Setups environment.
 import test_env_handlers
 
+from google.appengine.ext import ndb
+
 import webapp2
 import webtest
 
@@ -25,7 +27,10 @@ from components import utils
 from server import config
 from server import bot_code
 from server import bot_management
+from server import task_pack
+from server import task_request
 from server import task_result
+from server import task_scheduler
 
 
 class ClientApiTest(test_env_handlers.AppTestBase):
@@ -212,6 +217,75 @@ class ClientApiTest(test_env_handlers.AppTestBase):
     }
     self.assertEqual(expected, response)
 
+  def test_requests(self):
+    token = self.get_client_token()
+    params = {
+      'requests': [
+        {
+          'name': 'job%d' % i,
+          'priority': priority,
+          'properties': {
+            'commands': [['rm', '-rf', '/']],
+            'data': [],
+            'dimensions': {},
+            'env': {'SHARD': str(i)},
+            'execution_timeout_secs': 30,
+            'io_timeout_secs': 30,
+          },
+          'scheduling_expiration_secs': 30,
+          'tags': ['foo:bar'],
+          'user': 'joe@localhost',
+        }
+        for i, priority in enumerate((200, 10))
+      ],
+    }
+    response = self.post_with_token(
+        '/swarming/api/v1/client/requests', params, token)
+    self.assertEqual(2, len(response['tasks']))
+    # The priority of normal users is silently reset.
+    self.assertEqual(
+        [(u'job0', 200), (u'job1', 100)],
+        [(t['request']['name'], t['request']['priority'])
+          for t in response['tasks']])
+    task_ids = [t['task_id'] for t in response['tasks']]
+    self.assertEqual(2, len(set(task_ids)))
+    for task in response['tasks']:
+      result = self.app.get(
+          '/swarming/api/v1/client/task/' + task['task_id']).json
+      self.assertEqual(task['request']['name'], result['name'])
+      self.assertEqual(task_result.State.PENDING, result['state'])
+
+  def test_requests_invalid(self):
+    token = self.get_client_token()
+    self.post_with_token(
+        '/swarming/api/v1/client/requests', {'requests': []}, token,
+        status=400)
+    # One invalid request fails the whole call, nothing is created.
+    params = {
+      'requests': [
+        {
+          'name': 'job1',
+          'priority': 200,
+          'properties': {
+            'commands': [['rm', '-rf', '/']],
+            'data': [],
+            'dimensions': {},
+            'env': {},
+            'execution_timeout_secs': 30,
+            'io_timeout_secs': 30,
+          },
+          'scheduling_expiration_secs': 30,
+          'tags': [],
+          'user': 'joe@localhost',
+        },
+        {'foo': 'bar'},
+      ],
+    }
+    response = self.post_with_token(
+        '/swarming/api/v1/client/requests', params, token, status=400)
+    self.assertIn('error', response)
+    self.assertEqual(0, task_request.TaskRequest.query().count())
+
   def test_cancel(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     now = datetime.datetime(2010, 1, 2, 3, 4, 5)
@@ -350,17 +424,67 @@ class ClientApiTest(test_env_handlers.AppTestBase):
     run_id = task_id[:-1] + '1'
     response = self.app.get(
         '/swarming/api/v1/client/task/%s/output/0' % task_id).json
-    self.assertEqual({'output': u'rÉsult string'}, response)
+    expected = {'more': False, 'next_offset': 14, 'output': u'rÉsult string'}
+    self.assertEqual(expected, response)
     response = self.app.get(
         '/swarming/api/v1/client/task/%s/output/0' % run_id).json
-    self.assertEqual({'output': u'rÉsult string'}, response)
+    self.assertEqual(expected, response)
 
     response = self.app.get(
         '/swarming/api/v1/client/task/%s/output/1' % task_id).json
-    self.assertEqual({'output': None}, response)
+    expected = {'more': False, 'next_offset': 0, 'output': None}
+    self.assertEqual(expected, response)
     response = self.app.get(
         '/swarming/api/v1/client/task/%s/output/1' % run_id).json
-    self.assertEqual({'output': None}, response)
+    self.assertEqual(expected, response)
+
+  def test_get_task_output_range(self):
+    self.client_create_task()
+
+    self.set_as_bot()
+    task_id = self.bot_run_task()
+
+    self.set_as_privileged_user()
+    response = self.app.get(
+        '/swarming/api/v1/client/task/%s/output/0?offset=3&length=5' %
+        task_id).json
+    expected = {'more': True, 'next_offset': 8, 'output': u'sult '}
+    self.assertEqual(expected, response)
+    # The page ends in the middle of 'É', which is left for the next page.
+    response = self.app.get(
+        '/swarming/api/v1/client/task/%s/output/0?offset=0&length=2' %
+        task_id).json
+    expected = {'more': True, 'next_offset': 1, 'output': u'r'}
+    self.assertEqual(expected, response)
+    response = self.app.get(
+        '/swarming/api/v1/client/task/%s/output/0?offset=14' % task_id).json
+    expected = {'more': False, 'next_offset': 14, 'output': u''}
+    self.assertEqual(expected, response)
+    self.app.get(
+        '/swarming/api/v1/client/task/%s/output/0?offset=-1' % task_id,
+        status=400)
+
+  def test_decode_output_page(self):
+    self.mock(task_result.TaskOutput, 'FETCH_MAX_CONTENT', 3)
+    self.assertEqual(
+        (u'ab', 12, False), handlers_api.decode_output_page('ab', 10))
+    self.assertEqual(
+        (u'a\xc9', 13, True),
+        handlers_api.decode_output_page('a\xc3\x89', 10))
+    # The incomplete UTF-8 sequence is left for the next page.
+    self.assertEqual(
+        (u'ab', 12, True), handlers_api.decode_output_page('ab\xc3', 10))
+    # Even when the page is not full, the task may still be writing it.
+    self.assertEqual(
+        (u'a', 11, False), handlers_api.decode_output_page('a\xc3', 10))
+    self.assertEqual(
+        (u'a', 11, False),
+        handlers_api.decode_output_page('a\xe2\x82', 10, 5))
+    # more is relative to the requested length.
+    self.assertEqual(
+        (u'ab', 12, True), handlers_api.decode_output_page('ab', 10, 2))
+    self.assertEqual(
+        (u'ab', 12, False), handlers_api.decode_output_page('ab', 10, 5))
 
   def test_get_task_output_empty(self):
     _, task_id = self.client_create_task()
@@ -396,7 +520,12 @@ class ClientApiTest(test_env_handlers.AppTestBase):
     # was never executed.
     response = self.app.get(
         '/swarming/api/v1/client/task/%s/output/all' % task_id_2).json
-    self.assertEqual({'outputs': [u'rÉsult string']}, response)
+    expected = {
+      'more': False,
+      'next_offsets': [14],
+      'outputs': [u'rÉsult string'],
+    }
+    self.assertEqual(expected, response)
 
   def test_get_task_output_all(self):
     self.client_create_task()
@@ -422,16 +551,84 @@ class ClientApiTest(test_env_handlers.AppTestBase):
     run_id = task_id[:-1] + '1'
     response = self.app.get(
         '/swarming/api/v1/client/task/%s/output/all' % task_id).json
-    self.assertEqual({'outputs': [u'result string']}, response)
+    expected = {
+      'more': False,
+      'next_offsets': [13],
+      'outputs': [u'result string'],
+    }
+    self.assertEqual(expected, response)
     response = self.app.get(
         '/swarming/api/v1/client/task/%s/output/all' % run_id).json
-    self.assertEqual({'outputs': [u'result string']}, response)
+    self.assertEqual(expected, response)
+    response = self.app.get(
+        '/swarming/api/v1/client/task/%s/output/all?offsets=7' % run_id).json
+    expected = {'more': False, 'next_offsets': [13], 'outputs': [u'string']}
+    self.assertEqual(expected, response)
+
+  def test_tasks_wait(self):
+    self.client_create_task()
+    self.set_as_bot()
+    task_id_1 = self.bot_run_task()
+    self.set_as_user()
+    _, task_id_2 = self.client_create_task(name='second')
+
+    self.set_as_privileged_user()
+    token = self.get_client_token()
+    # Only the task not running anymore is returned.
+    params = {'task_ids': [task_id_1, task_id_2], 'timeout': 0}
+    response = self.post_with_token(
+        '/swarming/api/v1/client/tasks/wait', params, token)
+    self.assertEqual([task_id_1], response['results'].keys())
+    self.assertEqual(
+        self.app.get('/swarming/api/v1/client/task/' + task_id_1).json,
+        response['results'][task_id_1])
+
+    # Times out.
+    params = {'task_ids': [task_id_2], 'timeout': 0}
+    response = self.post_with_token(
+        '/swarming/api/v1/client/tasks/wait', params, token)
+    self.assertEqual({'results': {}}, response)
+
+    params = {'task_ids': [], 'timeout': 0}
+    self.post_with_token(
+        '/swarming/api/v1/client/tasks/wait', params, token, status=400)
+
+  def test_tasks_wait_signal(self):
+    _, task_id_1 = self.client_create_task()
+    _, task_id_2 = self.client_create_task(name='second')
+    self.set_as_privileged_user()
+    token = self.get_client_token()
+
+    now = [1000.]
+    self.mock(utils, 'time_time', lambda: now[0])
+    reads = []
+    old_get_multi = ndb.get_multi
+    def get_multi(keys, **kwargs):
+      if (isinstance(keys, list) and keys and
+          keys[0].kind() == 'TaskResultSummary'):
+        reads.append(len(keys))
+      return old_get_multi(keys, **kwargs)
+    self.mock(ndb, 'get_multi', get_multi)
+    def sleep(delay):
+      now[0] += delay
+      if now[0] == 1002.:
+        task_scheduler.cancel_task(
+            task_pack.unpack_result_summary_key(task_id_2))
+    self.mock(handlers_api.time, 'sleep', sleep)
+
+    params = {'task_ids': [task_id_1, task_id_2], 'timeout': 30}
+    response = self.post_with_token(
+        '/swarming/api/v1/client/tasks/wait', params, token)
+    self.assertEqual([task_id_2], response['results'].keys())
+    # All the tasks are read once, then only the one signaled as completed.
+    self.assertEqual([2, 1], reads)
 
   def test_get_task_output_all_empty(self):
     _, task_id = self.client_create_task()
     response = self.app.get(
         '/swarming/api/v1/client/task/%s/output/all' % task_id).json
-    self.assertEqual({'outputs': []}, response)
+    expected = {'more': False, 'next_offsets': [], 'outputs': []}
+    self.assertEqual(expected, response)
 
     run_id = task_id[:-1] + '1'
     response = self.app.get(
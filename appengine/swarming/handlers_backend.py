@@ -10,6 +10,7 @@ from google.appengine.api import taskqueue
 
 import mapreduce_jobs
 from components import decorators
+from server import bot_management
 from server import stats
 from server import task_scheduler
 
@@ -30,6 +31,30 @@ class CronAbortExpiredShardToRunHandler(webapp2.RequestHandler):
     self.response.out.write('Success.')
 
 
+class CronCompactOutputHandler(webapp2.RequestHandler):
+  @decorators.require_cronjob
+  def get(self):
+    task_scheduler.cron_compact_output()
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class CronFlushBotUpdatesHandler(webapp2.RequestHandler):
+  @decorators.require_cronjob
+  def get(self):
+    task_scheduler.cron_flush_bot_updates()
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
+class CronFlushBotHeartbeatsHandler(webapp2.RequestHandler):
+  @decorators.require_cronjob
+  def get(self):
+    bot_management.cron_flush_bot_heartbeats()
+    self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    self.response.out.write('Success.')
+
+
 class CronTriggerCleanupDataHandler(webapp2.RequestHandler):
   """Triggers task to delete orphaned blobs."""
 
@@ -75,6 +100,9 @@ def get_routes():
     ('/internal/cron/handle_bot_died', CronBotDiedHandler),
     ('/internal/cron/abort_expired_task_to_run',
         CronAbortExpiredShardToRunHandler),
+    ('/internal/cron/compact_output', CronCompactOutputHandler),
+    ('/internal/cron/flush_bot_heartbeats', CronFlushBotHeartbeatsHandler),
+    ('/internal/cron/flush_bot_updates', CronFlushBotUpdatesHandler),
 
     ('/internal/cron/stats/update', stats.InternalStatsUpdateHandler),
     ('/internal/cron/trigger_cleanup_data', CronTriggerCleanupDataHandler),
@@ -8,6 +8,7 @@ import base64
 import json
 import logging
 import textwrap
+import zlib
 
 import webapp2
 
@@ -209,7 +210,7 @@ class _BotBaseHandler(auth.ApiHandler):
       return request, bot_id, version, state, dimensions, quarantined_msg
 
     # Look for admin enforced quarantine.
-    bot_settings = bot_management.get_settings_key(bot_id).get()
+    bot_settings = bot_management.get_bot_settings(bot_id)
     if bool(bot_settings and bot_settings.quarantined):
       return request, bot_id, version, state, dimensions, 'Quarantined by admin'
 
@@ -304,7 +305,7 @@ class BotPollHandler(_BotBaseHandler):
       return
     if quarantined:
       bot_event('request_sleep')
-      self._cmd_sleep(sleep_streak, quarantined)
+      self._cmd_sleep(sleep_streak, quarantined, None)
       return
 
     #
@@ -322,15 +323,19 @@ class BotPollHandler(_BotBaseHandler):
       self._cmd_restart(restart_message)
       return
 
-    # The bot is in good shape. Try to grab a task.
+    # The bot is in good shape. Try to grab a task, unless it is known that
+    # there is none it could run.
+    pending_count = task_to_run.get_pending_count(dimensions)
     try:
-      # This is a fairly complex function call, exceptions are expected.
-      request, run_result = task_scheduler.bot_reap_task(
-          dimensions, bot_id, version)
+      request = None
+      if pending_count != 0:
+        # This is a fairly complex function call, exceptions are expected.
+        request, run_result = task_scheduler.bot_reap_task(
+            dimensions, bot_id, version)
       if not request:
         # No task found, tell it to sleep a bit.
         bot_event('request_sleep')
-        self._cmd_sleep(sleep_streak, quarantined)
+        self._cmd_sleep(sleep_streak, quarantined, pending_count)
         return
 
       try:
@@ -371,10 +376,11 @@ class BotPollHandler(_BotBaseHandler):
     }
     self.send_response(out)
 
-  def _cmd_sleep(self, sleep_streak, quarantined):
+  def _cmd_sleep(self, sleep_streak, quarantined, pending_count):
     out = {
       'cmd': 'sleep',
-      'duration': task_scheduler.exponential_backoff(sleep_streak),
+      'duration': task_scheduler.get_bot_sleep_duration(
+          sleep_streak, pending_count),
       'quarantined': quarantined,
     }
     self.send_response(out)
@@ -461,10 +467,14 @@ class BotTaskUpdateHandler(auth.ApiHandler):
 
   The handler verifies packets are processed in order and will refuse
   out-of-order packets.
+
+  output is base64 encoded. If output_compression is 'zlib', it is also zlib
+  compressed.
   """
   ACCEPTED_KEYS = {
     u'cost_usd', u'duration', u'exit_code', u'hard_timeout',
-    u'id', u'io_timeout', u'output', u'output_chunk_start', u'task_id',
+    u'id', u'io_timeout', u'output', u'output_chunk_start',
+    u'output_compression', u'task_id',
   }
   REQUIRED_KEYS = {u'id', u'task_id'}
 
@@ -489,6 +499,9 @@ class BotTaskUpdateHandler(auth.ApiHandler):
     io_timeout = request.get('io_timeout')
     output = request.get('output')
     output_chunk_start = request.get('output_chunk_start')
+    output_compression = request.get('output_compression')
+    if output_compression not in (None, 'zlib'):
+      self.abort_with_error(400, error='Unsupported output_compression')
 
     run_result_key = task_pack.unpack_run_result_key(task_id)
     if output is not None:
@@ -502,6 +515,12 @@ class BotTaskUpdateHandler(auth.ApiHandler):
         # and returning a HTTP 500 would only force the bot to stay in a retry
         # loop.
         logging.error('Failed to decode output\n%s\n%r', e, output)
+      if output_compression == 'zlib':
+        try:
+          output = zlib.decompress(output)
+        except zlib.error as e:
+          self.abort_with_error(
+              400, error='Failed to decompress output: %s' % e)
 
     try:
       success, completed = task_scheduler.bot_update_task(
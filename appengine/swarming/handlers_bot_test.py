@@ -13,6 +13,7 @@ import StringIO
 import sys
 import unittest
 import zipfile
+import zlib
 
 # Setups environment.
 import test_env_handlers
@@ -415,8 +416,10 @@ class BotApiTest(test_env_handlers.AppTestBase):
     expected = _expected()
     _cycle(params, expected)
 
-    # 3. Task update with some more output.
-    params = _params(output=base64.b64encode('hi'), output_chunk_start=3)
+    # 3. Task update with some more output, compressed.
+    params = _params(
+        output=base64.b64encode(zlib.compress('hi')), output_chunk_start=3,
+        output_compression='zlib')
     expected = _expected()
     _cycle(params, expected)
 
@@ -18,9 +18,11 @@ APP_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, os.path.join(APP_DIR, 'components', 'third_party'))
 
 from components import ereporter2
+from components import stats_framework
 
 import handlers_endpoints
 import handlers_frontend
+from server import stats
 
 
 def create_application():
@@ -29,7 +31,10 @@ def create_application():
   a = handlers_frontend.create_application(False)
   # App that serves new endpoints API.
   api = endpoints.api_server([handlers_endpoints.swarming_api])
-  return a, api
+  # Stream the statistics of each request so the logs don't have to be scanned.
+  return (
+      stats_framework.StreamMiddleware(a, stats.STREAM_QUEUE),
+      stats_framework.StreamMiddleware(api, stats.STREAM_QUEUE))
 
 
 app, endpoints_app = create_application()
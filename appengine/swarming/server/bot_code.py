@@ -16,12 +16,23 @@ from google.appengine.ext import ndb
 
 from components import auth
 from components import datastore_utils
+from components import utils
 from server import bot_archive
 
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+# Number of seconds the bot version is cached in the instance before memcache
+# is checked again. It is the maximum delay for other instances to notice a new
+# bot_config.py.
+_BOT_VERSION_CACHE_SECS = 30
+
+
+# host -> (expiration, bot version) cached in the instance.
+_bot_version_cache = {}
+
+
 ### Models.
 
 
@@ -97,25 +108,33 @@ def store_bot_config(content):
   out = VersionedFile(content=content).store('bot_config.py')
   # Clear the cached version value since it has now changed. This is *super*
   # aggressive to flush all memcache but that's the only safe way to not send
-  # old code by accident.
+  # old code by accident. The other instances will see it once their own cache
+  # expires.
   while not memcache.flush_all():
     pass
+  _bot_version_cache.clear()
   return out
 
 
 def get_bot_version(host):
   """Retrieves the bot version loaded on this server.
 
-  The memcache is first checked for the version, otherwise the value
-  is generated and then stored in the memcache.
+  The instance cache then the memcache are first checked for the version,
+  otherwise the value is generated and then stored in the memcache.
 
   Returns:
     The hash of the current bot version.
   """
+  now = utils.time_time()
+  expiration, bot_version = _bot_version_cache.get(host, (0, None))
+  if now < expiration:
+    return bot_version
+
   namespace = os.environ['CURRENT_VERSION_ID']
   key = 'bot_version' + host
   bot_version = memcache.get(key, namespace=namespace)
   if bot_version:
+    _bot_version_cache[host] = (now + _BOT_VERSION_CACHE_SECS, bot_version)
     return bot_version
 
   # Need to calculate it.
@@ -123,6 +142,7 @@ def get_bot_version(host):
   bot_dir = os.path.join(ROOT_DIR, 'swarming_bot')
   bot_version = bot_archive.get_swarming_bot_version(bot_dir, host, additionals)
   memcache.set(key, bot_version, namespace=namespace)
+  _bot_version_cache[host] = (now + _BOT_VERSION_CACHE_SECS, bot_version)
   return bot_version
 
 
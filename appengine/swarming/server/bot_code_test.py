@@ -4,6 +4,7 @@
 # found in the LICENSE file.
 
 import StringIO
+import datetime
 import logging
 import os
 import re
@@ -32,6 +33,7 @@ class BotManagementTest(test_case.TestCase):
     self.mock(
         auth, 'get_current_identity',
         lambda: auth.Identity(auth.IDENTITY_USER, 'joe@localhost'))
+    self.mock(bot_code, '_bot_version_cache', {})
 
   def test_store_bot_config(self):
     # When a new start bot script is uploaded, we should recalculate the
@@ -48,6 +50,21 @@ class BotManagementTest(test_case.TestCase):
     actual = bot_code.get_bot_version('http://localhost')
     self.assertTrue(re.match(r'^[0-9a-f]{40}$', actual), actual)
 
+  def test_get_bot_version_cached(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    v1 = bot_code.get_bot_version('http://localhost')
+    # Served from the instance cache even if memcache is flushed by another
+    # instance.
+    self.mock(bot_code.memcache, 'get', lambda *_, **_kw: self.fail())
+    self.assertEqual(v1, bot_code.get_bot_version('http://localhost'))
+    self.mock_now(now, 60)
+    self.mock(bot_code.memcache, 'get', lambda *_, **_kw: None)
+    self.mock(
+        bot_code, 'get_bot_config',
+        lambda: bot_code.File('dummy_script', None, None))
+    self.assertNotEqual(v1, bot_code.get_bot_version('http://localhost'))
+
   def test_get_swarming_bot_zip(self):
     zipped_code = bot_code.get_swarming_bot_zip('http://localhost')
     # Ensure the zip is valid and all the expected files are present.
@@ -22,15 +22,21 @@
 - BotInfo is a 'dump-only' entity used for UI, it permits quickly show the
   state of every bots in an single query. It is basically a cache of the last
   BotEvent and additionally updated on poll. It doesn't need to be updated in a
-  transaction.
+  transaction. Polls that do not change anything but last_seen_ts, external_ip
+  and state are buffered in memcache and flushed in batches by
+  cron_flush_bot_heartbeats().
 - BotSettings contains bot-specific settings. It must be updated in a
   transaction and contains admin-provided settings, contrary to the other
   entities which are generated from data provided by the bot itself.
 """
 
 import datetime
+import functools
 import hashlib
+import logging
 
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 from components import datastore_utils
@@ -44,6 +50,41 @@ from server import task_pack
 BOT_REBOOT_PERIOD_RANDOMIZATION_MARGIN = 0.2
 
 
+# Memcache namespace of the bot_id -> heartbeat buffered by bot_event().
+_HEARTBEAT_MEMCACHE_NAMESPACE = 'bot_heartbeat'
+
+
+# Pull queue listing the bots with a buffered heartbeat.
+_HEARTBEAT_QUEUE = 'bot-heartbeat'
+
+
+# Maximum number of tasks leased from _HEARTBEAT_QUEUE at once.
+_HEARTBEAT_LEASE_MAX = 1000
+
+
+# Memcache namespace of the bot_id -> BotSettings cache, including missing ones.
+_SETTINGS_MEMCACHE_NAMESPACE = 'bot_settings'
+
+
+# Number of seconds BotSettings are cached in memcache. The entries are deleted
+# once the modification of the entity is committed, this only bounds a stale
+# entry cached by a reader racing with the modification.
+_SETTINGS_MEMCACHE_SECS = 5*60
+
+
+# Number of seconds BotSettings are cached in the instance before memcache is
+# checked again. It is the maximum delay for an admin change to be noticed.
+_SETTINGS_CACHE_SECS = 30
+
+
+# Maximum number of bots with BotSettings cached in the instance.
+_SETTINGS_CACHE_MAX = 10000
+
+
+# bot_id -> (expiration, BotSettings or None) cached in the instance.
+_bot_settings_cache = {}
+
+
 ### Models.
 
 # There is one BotRoot entity per bot id. Multiple bots could run on a single
@@ -170,6 +211,100 @@ class BotSettings(ndb.Model):
   # broken situation.
   quarantined = ndb.BooleanProperty()
 
+  def _post_put_hook(self, future):
+    super(BotSettings, self)._post_put_hook(future)
+    _clear_bot_settings_cache(self.key)
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    super(BotSettings, cls)._post_delete_hook(key, future)
+    _clear_bot_settings_cache(key)
+
+
+### Private stuff.
+
+
+def _clear_bot_settings_cache(settings_key):
+  """Invalidates the cached BotSettings when it is modified.
+
+  It is done once the transaction commits, otherwise a reader could cache the
+  old entity again.
+  """
+  bot_id = settings_key.parent().string_id()
+  def clear():
+    _bot_settings_cache.pop(bot_id, None)
+    memcache.delete(bot_id, namespace=_SETTINGS_MEMCACHE_NAMESPACE)
+  ndb.get_context().call_on_commit(clear)
+
+
+def _get_bot_info_digest(dimensions, version, quarantined, task_id, task_name):
+  """Returns a digest of the bot_event() arguments that require a BotInfo write.
+  """
+  return hashlib.sha1(utils.encode_to_json(
+      [dimensions, version, quarantined, task_id, task_name])).hexdigest()
+
+
+def _buffer_heartbeat(bot_id, digest, external_ip, state):
+  """Buffers a poll in memcache instead of writing BotInfo, if possible.
+
+  It is only possible when BotInfo was recently written with the same
+  dimensions, version, quarantine and task, as summarized by digest. The first
+  heartbeat buffered since the last write adds the bot to _HEARTBEAT_QUEUE.
+
+  BotInfo is written directly at least every half of bot_death_timeout_secs, so
+  the bot isn't seen as dead even if cron_flush_bot_heartbeats() is not
+  running.
+
+  Returns True if the heartbeat was buffered.
+  """
+  now = utils.utcnow()
+  # Use CAS so a concurrent bot_event() deleting the entry isn't overwritten
+  # with a stale digest.
+  client = memcache.Client()
+  heartbeat = client.gets(bot_id, namespace=_HEARTBEAT_MEMCACHE_NAMESPACE)
+  if not heartbeat or heartbeat['digest'] != digest:
+    return False
+  max_age = config.settings().bot_death_timeout_secs / 2.
+  if (now - heartbeat['written_ts']).total_seconds() >= max_age:
+    return False
+
+  pending = 'last_seen_ts' in heartbeat
+  heartbeat['last_seen_ts'] = now
+  heartbeat['external_ip'] = external_ip
+  heartbeat['state'] = state
+  if not client.cas(
+      bot_id, heartbeat, namespace=_HEARTBEAT_MEMCACHE_NAMESPACE):
+    return False
+  if not pending:
+    try:
+      taskqueue.Queue(_HEARTBEAT_QUEUE).add(
+          taskqueue.Task(method='PULL', payload=bot_id))
+    except taskqueue.Error as e:
+      logging.warning('Failed to buffer heartbeat for %s: %s', bot_id, e)
+      memcache.delete(bot_id, namespace=_HEARTBEAT_MEMCACHE_NAMESPACE)
+      return False
+  return True
+
+
+def _flush_heartbeat(bot_id, heartbeat):
+  """Saves a buffered heartbeat into BotInfo. Must be run in a transaction.
+
+  Returns None if the BotInfo doesn't exist, else 1 if it was updated, 0 if a
+  more recent event was already recorded.
+  """
+  bot_info = get_info_key(bot_id).get()
+  if not bot_info:
+    return None
+  # Do not overwrite a more recent event.
+  if heartbeat['last_seen_ts'] <= bot_info.last_seen_ts:
+    return 0
+  bot_info.last_seen_ts = heartbeat['last_seen_ts']
+  bot_info.external_ip = heartbeat['external_ip']
+  if heartbeat['state']:
+    bot_info.state = heartbeat['state']
+  bot_info.put()
+  return 1
+
 
 ### Public APIs.
 
@@ -186,6 +321,34 @@ def get_info_key(bot_id):
   return ndb.Key(BotInfo, 'info', parent=get_root_key(bot_id))
 
 
+def get_bot_settings(bot_id):
+  """Returns the BotSettings for a known bot or None if it has none.
+
+  The result is cached in the instance for _SETTINGS_CACHE_SECS and in memcache
+  until the entity is modified, so the bot polls do not hit the DB.
+  """
+  now = utils.time_time()
+  expiration, bot_settings = _bot_settings_cache.get(bot_id, (0, None))
+  if now < expiration:
+    return bot_settings
+
+  settings_key = get_settings_key(bot_id)
+  cached = memcache.get(bot_id, namespace=_SETTINGS_MEMCACHE_NAMESPACE)
+  if cached is not None:
+    bot_settings = BotSettings(key=settings_key, **cached) if cached else None
+  else:
+    bot_settings = settings_key.get()
+    # Cache missing entities as an empty dict.
+    memcache.set(
+        bot_id, bot_settings.to_dict() if bot_settings else {},
+        time=_SETTINGS_MEMCACHE_SECS, namespace=_SETTINGS_MEMCACHE_NAMESPACE)
+
+  if len(_bot_settings_cache) >= _SETTINGS_CACHE_MAX:
+    _bot_settings_cache.clear()
+  _bot_settings_cache[bot_id] = (now + _SETTINGS_CACHE_SECS, bot_settings)
+  return bot_settings
+
+
 def get_events_query(bot_id):
   """Returns an ndb.Query for most recent events in reverse chronological order.
   """
@@ -220,6 +383,12 @@ def bot_event(
   if not bot_id:
     return
 
+  if event_type in ('request_sleep', 'task_update'):
+    digest = _get_bot_info_digest(
+        dimensions, version, quarantined, task_id, task_name)
+    if _buffer_heartbeat(bot_id, digest, external_ip, state):
+      return
+
   # Retrieve the previous BotInfo and update it.
   info_key = get_info_key(bot_id)
   bot_info = info_key.get() or BotInfo(key=info_key)
@@ -244,8 +413,14 @@ def bot_event(
     # keep first_seen_ts. It's not necessary to use a transaction here since no
     # BotEvent is being added, only last_seen_ts is really updated.
     bot_info.put()
+    memcache.set(
+        bot_id, {'digest': digest, 'written_ts': bot_info.last_seen_ts},
+        namespace=_HEARTBEAT_MEMCACHE_NAMESPACE)
     return
 
+  # Any buffered heartbeat is now stale.
+  memcache.delete(bot_id, namespace=_HEARTBEAT_MEMCACHE_NAMESPACE)
+
   event = BotEvent(
       parent=get_root_key(bot_id),
       event_type=event_type,
@@ -264,6 +439,67 @@ def bot_event(
   datastore_utils.store_new_version(event, BotRoot, [bot_info])
 
 
+def cron_flush_bot_heartbeats():
+  """Saves the heartbeats buffered by bot_event() into BotInfo.
+
+  The bots are leased in batches from _HEARTBEAT_QUEUE. Each BotInfo is updated
+  in its own transaction, all run in parallel, so a concurrent bot_event()
+  cannot be overwritten with stale values.
+
+  Returns the number of BotInfo updated.
+  """
+  queue = taskqueue.Queue(_HEARTBEAT_QUEUE)
+  client = memcache.Client()
+  updated = 0
+  failed = 0
+  while True:
+    tasks = queue.lease_tasks(60, _HEARTBEAT_LEASE_MAX)
+    if not tasks:
+      break
+    bot_ids = sorted(set(task.payload for task in tasks))
+    heartbeats = client.get_multi(
+        bot_ids, namespace=_HEARTBEAT_MEMCACHE_NAMESPACE, for_cas=True)
+    # Heartbeats that were evicted or invalidated by another event are lost,
+    # the next poll will write BotInfo directly.
+    bot_ids = [b for b in bot_ids if 'last_seen_ts' in heartbeats.get(b, {})]
+    futures = [
+      datastore_utils.transaction_async(
+          functools.partial(_flush_heartbeat, b, heartbeats[b]))
+      for b in bot_ids
+    ]
+    flushed = {}
+    deleted = []
+    # Bots whose tasks are kept, to be retried once the lease expires.
+    retry = set()
+    for bot_id, future in zip(bot_ids, futures):
+      try:
+        result = future.get_result()
+      except datastore_utils.CommitError as e:
+        logging.warning('Failed flushing heartbeat of %s: %s', bot_id, e)
+        failed += 1
+        retry.add(bot_id)
+        continue
+      if result is None:
+        # Do not recreate a deleted bot here, the next poll will do it.
+        deleted.append(bot_id)
+        continue
+      updated += result
+      flushed[bot_id] = {
+        'digest': heartbeats[bot_id]['digest'],
+        'written_ts': heartbeats[bot_id]['last_seen_ts'],
+      }
+    # Compare-and-set, so an entry deleted by a racing event is not restored
+    # and a racing poll is not lost; the latter is flushed on retry.
+    retry.update(
+        client.cas_multi(flushed, namespace=_HEARTBEAT_MEMCACHE_NAMESPACE))
+    memcache.delete_multi(deleted, namespace=_HEARTBEAT_MEMCACHE_NAMESPACE)
+    queue.delete_tasks([t for t in tasks if t.payload not in retry])
+    if len(tasks) < _HEARTBEAT_LEASE_MAX:
+      break
+  logging.info('Flushed %d heartbeats; failed: %d', updated, failed)
+  return updated
+
+
 def get_bot_reboot_period(bot_id, state):
   """Returns how long (in sec) a bot should run before being rebooted.
 
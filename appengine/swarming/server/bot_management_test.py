@@ -13,14 +13,18 @@ import unittest
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from components import datastore_utils
 from test_support import test_case
 
 from server import bot_management
 
 
 class BotManagementTest(test_case.TestCase):
+  APP_DIR = test_env.APP_DIR
+
   def test_all_apis_are_tested(self):
     actual = frozenset(i[5:] for i in dir(self) if i.startswith('test_'))
     # Contains the list of all public APIs.
@@ -150,6 +154,125 @@ class BotManagementTest(test_case.TestCase):
         expected,
         [e.to_dict() for e in bot_management.get_events_query('id1')])
 
+  def _poll_sleep(self, **kwargs):
+    args = dict(
+        event_type='request_sleep', bot_id='id1', external_ip='8.8.4.4',
+        dimensions={'id': ['id1'], 'foo': ['bar']}, state={'ram': 65},
+        version=hashlib.sha1().hexdigest(), quarantined=False, task_id=None,
+        task_name=None)
+    args.update(kwargs)
+    bot_management.bot_event(**args)
+
+  def test_bot_event_poll_sleep_buffered(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self._poll_sleep()
+    info_key = bot_management.get_info_key('id1')
+    self.assertEqual(now, info_key.get().last_seen_ts)
+
+    # Only the heartbeat changed, BotInfo is not written.
+    self.mock_now(now, 10)
+    self._poll_sleep(state={'ram': 66})
+    self.assertEqual(now, info_key.get().last_seen_ts)
+    self.assertEqual({'ram': 65}, info_key.get().state)
+
+    # The dimensions changed, BotInfo is written right away.
+    later = self.mock_now(now, 20)
+    self._poll_sleep(dimensions={'id': ['id1'], 'foo': ['baz']})
+    self.assertEqual(later, info_key.get().last_seen_ts)
+    self.assertEqual({'foo': ['baz'], 'id': ['id1']}, info_key.get().dimensions)
+
+    # BotInfo is written before the bot could be seen as dead.
+    later = self.mock_now(now, 20 + 5*60)
+    self._poll_sleep(dimensions={'id': ['id1'], 'foo': ['baz']})
+    self.assertEqual(later, info_key.get().last_seen_ts)
+
+  def test_bot_event_poll_sleep_buffered_race(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self._poll_sleep()
+
+    # An event deletes the buffered heartbeat while the poll is being buffered.
+    old_cas = memcache.Client.cas
+    def cas(client, *args, **kwargs):
+      self._poll_sleep(event_type='bot_error', message='Oops')
+      return old_cas(client, *args, **kwargs)
+    self.mock(memcache.Client, 'cas', cas)
+    later = self.mock_now(now, 10)
+    self._poll_sleep(state={'ram': 66})
+
+    # The poll wasn't buffered over the deletion, BotInfo was written instead.
+    self.assertEqual(0, bot_management.cron_flush_bot_heartbeats())
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual(later, bot_info.last_seen_ts)
+    self.assertEqual({'ram': 66}, bot_info.state)
+
+  def test_cron_flush_bot_heartbeats(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self._poll_sleep()
+    self.assertEqual(0, bot_management.cron_flush_bot_heartbeats())
+
+    later = self.mock_now(now, 10)
+    self._poll_sleep(external_ip='8.8.8.8', state={'ram': 66})
+    self.mock_now(now, 20)
+    self._poll_sleep(external_ip='8.8.8.8', state={'ram': 66})
+    info_key = bot_management.get_info_key('id1')
+    self.assertEqual(now, info_key.get().last_seen_ts)
+
+    # Both heartbeats are coalesced.
+    self.assertEqual(1, bot_management.cron_flush_bot_heartbeats())
+    bot_info = info_key.get()
+    self.assertEqual(later + datetime.timedelta(seconds=10),
+                     bot_info.last_seen_ts)
+    self.assertEqual('8.8.8.8', bot_info.external_ip)
+    self.assertEqual({'ram': 66}, bot_info.state)
+    self.assertEqual(0, bot_management.cron_flush_bot_heartbeats())
+    # No BotEvent is registered.
+    self.assertEqual([], bot_management.get_events_query('id1').fetch())
+
+  def test_cron_flush_bot_heartbeats_stale(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self._poll_sleep()
+    self.mock_now(now, 10)
+    self._poll_sleep(state={'ram': 66})
+    # A more recent event invalidates the buffered heartbeat.
+    later = self.mock_now(now, 20)
+    self._poll_sleep(event_type='bot_error', message='Oops')
+    self.assertEqual(0, bot_management.cron_flush_bot_heartbeats())
+    self.assertEqual(
+        later, bot_management.get_info_key('id1').get().last_seen_ts)
+
+  def test_cron_flush_bot_heartbeats_race(self):
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self._poll_sleep()
+    self.mock_now(now, 10)
+    self._poll_sleep(state={'ram': 66})
+
+    # An event is recorded while the heartbeats are being flushed.
+    old_transaction_async = datastore_utils.transaction_async
+    def transaction_async(callback):
+      self.mock_now(now, 5)
+      self._poll_sleep(
+          event_type='bot_connected',
+          dimensions={'id': ['id1'], 'foo': ['baz']})
+      return old_transaction_async(callback)
+    self.mock(datastore_utils, 'transaction_async', transaction_async)
+    self.assertEqual(1, bot_management.cron_flush_bot_heartbeats())
+
+    # The new dimensions are kept and the heartbeat invalidated by the event is
+    # not restored in memcache.
+    bot_info = bot_management.get_info_key('id1').get()
+    self.assertEqual({'foo': ['baz'], 'id': ['id1']}, bot_info.dimensions)
+    self.assertEqual(
+        now + datetime.timedelta(seconds=10), bot_info.last_seen_ts)
+    self.assertEqual(
+        None,
+        memcache.get(
+            'id1', namespace=bot_management._HEARTBEAT_MEMCACHE_NAMESPACE))
+
   def test_should_restart_bot_not_set(self):
     state = {
       'running_time': 0,
@@ -202,6 +325,45 @@ class BotManagementTest(test_case.TestCase):
     # relies on number of iterations above to be high enough).
     self.assertEqual(200, len(periods))
 
+  def test_get_bot_settings(self):
+    self.mock(bot_management, '_bot_settings_cache', {})
+    now = datetime.datetime(2010, 1, 2, 3, 4, 5, 6)
+    self.mock_now(now)
+    self.assertEqual(None, bot_management.get_bot_settings('id1'))
+
+    # The missing entity is cached in the instance then in memcache.
+    self.mock(ndb.Key, 'get', lambda *_: self.fail('Unexpected DB access'))
+    self.assertEqual(None, bot_management.get_bot_settings('id1'))
+    self.mock_now(now, 60)
+    self.assertEqual(None, bot_management.get_bot_settings('id1'))
+
+  def test_get_bot_settings_modified(self):
+    self.mock(bot_management, '_bot_settings_cache', {})
+    self.assertEqual(None, bot_management.get_bot_settings('id1'))
+    # Modifying the entity invalidates the cache.
+    settings_key = bot_management.get_settings_key('id1')
+    bot_management.BotSettings(key=settings_key, quarantined=True).put()
+    self.assertEqual(True, bot_management.get_bot_settings('id1').quarantined)
+    # Served from memcache.
+    self.mock(bot_management, '_bot_settings_cache', {})
+    self.assertEqual(True, bot_management.get_bot_settings('id1').quarantined)
+    settings_key.delete()
+    self.assertEqual(None, bot_management.get_bot_settings('id1'))
+
+  def test_get_bot_settings_modified_transaction(self):
+    self.mock(bot_management, '_bot_settings_cache', {})
+    self.assertEqual(None, bot_management.get_bot_settings('id1'))
+    settings_key = bot_management.get_settings_key('id1')
+    def run():
+      bot_management.BotSettings(key=settings_key, quarantined=True).put()
+      # The cache is only invalidated once the transaction commits.
+      self.assertEqual(
+          {},
+          memcache.get(
+              'id1', namespace=bot_management._SETTINGS_MEMCACHE_NAMESPACE))
+    ndb.transaction(run)
+    self.assertEqual(True, bot_management.get_bot_settings('id1').quarantined)
+
   def test_get_info_key(self):
     self.assertEqual(
         ndb.Key(bot_management.BotRoot, 'foo', bot_management.BotInfo, 'info'),
@@ -6,6 +6,11 @@
 
 It's important to keep logs concise for general performance concerns. Each http
 handler should strive to do only one stats log entry per request.
+
+The entries are also streamed to the STREAM_QUEUE pull queue, one task per
+request along the HTTP requests counts when the app is wrapped in
+stats_framework.StreamMiddleware, which is used instead of the logs to generate
+the snapshots. The logs are only used as a backfill.
 """
 
 import json
@@ -18,7 +23,6 @@ from components import decorators
 from components import stats_framework
 from components import utils
 from server import task_pack
-from server import task_to_run
 
 
 ### Models
@@ -134,6 +138,10 @@ class _Snapshot(ndb.Model):
   http_requests = ndb.IntegerProperty(default=0)
   http_failures = ndb.IntegerProperty(default=0)
 
+  # Lookups of results to reuse for idempotent tasks found, or not, in memcache.
+  dedupe_cache_hits = ndb.IntegerProperty(default=0)
+  dedupe_cache_misses = ndb.IntegerProperty(default=0)
+
   # TODO(maruel): This will become large (thousands). Something like a
   # bloomfilter + number could help. On the other hand, it's highly compressible
   # and this instance is zlib compressed. Run an NN thousands bots load tests
@@ -285,6 +293,8 @@ class _Snapshot(ndb.Model):
     return {
       'bots_active': self.bots_active,
       'bots_inactive': self.bots_inactive,
+      'dedupe_cache_hits': self.dedupe_cache_hits,
+      'dedupe_cache_misses': self.dedupe_cache_misses,
       'http_failures': self.http_failures,
       'http_requests': self.http_requests,
       'tasks_active': self.tasks_active,
@@ -325,6 +335,7 @@ _VALID_ACTIONS = frozenset(
 _KEY_MAPPING = {
   'action': 'a',
   'bot_id': 'bid',
+  'dedupe': 'dd',
   'dimensions': 'd',
   'pending_ms': 'pms',
   'run_id': 'rid',
@@ -469,7 +480,15 @@ def _parse_line(line, values, bots_active, bots_inactive, tasks_active):
       return True
 
     if action == 'task_enqueued':
+      # 'dedupe' is only set for idempotent tasks.
+      dedupe = extras.pop('dedupe', None)
       _assert_list(extras, ['dimensions', 'task_id', 'user'])
+      if dedupe == 'hit':
+        values.dedupe_cache_hits += 1
+      elif dedupe == 'miss':
+        values.dedupe_cache_misses += 1
+      elif dedupe is not None:
+        raise ValueError(dedupe)
       _mark_task_as_active(extras, tasks_active)
       d.tasks_enqueued += 1
       u.tasks_enqueued += 1
@@ -488,6 +507,41 @@ def _parse_line(line, values, bots_active, bots_inactive, tasks_active):
     return False
 
 
+def _get_bots_per_dimension(bots):
+  """Returns the inverted index of the bots dimensions.
+
+  Arguments:
+    bots: dict of bot_id -> bot dimensions.
+
+  Returns:
+    dict of (key, value) -> set of the bot_id having this dimension value. A
+    bot with a list of values for a key is indexed once for each value.
+  """
+  index = {}
+  for bot_id, dimensions in bots.iteritems():
+    for key, values in dimensions.iteritems():
+      if not isinstance(values, (list, tuple)):
+        values = (values,)
+      for value in values:
+        index.setdefault((key, value), set()).add(bot_id)
+  return index
+
+
+def _match_bots(request_dimensions, bots, index):
+  """Returns the set of the bot_id in bots matching request_dimensions.
+
+  It is equivalent to calling task_to_run.match_dimensions() for each bot but
+  uses the index returned by _get_bots_per_dimension(bots).
+  """
+  # Intersect the smallest sets first.
+  matches = sorted(
+      (index.get(i, frozenset()) for i in request_dimensions.iteritems()),
+      key=len)
+  if not matches:
+    return set(bots)
+  return matches[0].intersection(*matches[1:])
+
+
 def _post_process(snapshot, bots_active, bots_inactive, tasks_active):
   """Completes the _Snapshot instance with additional data."""
   for dimensions_json, tasks in tasks_active.iteritems():
@@ -495,33 +549,25 @@ def _post_process(snapshot, bots_active, bots_inactive, tasks_active):
 
   snapshot.bot_ids = sorted(bots_active)
   snapshot.bot_ids_bad = sorted(bots_inactive)
-  for bot_id, dimensions in bots_active.iteritems():
-    # Looks at the current buckets, do not create one.
-    for bucket in snapshot.buckets:
-      # If this bot matches these dimensions, mark it as a member of this group.
-      if task_to_run.match_dimensions(
-          json.loads(bucket.dimensions), dimensions):
-        # This bot could be used for requests on this dimensions filter.
-        if not bot_id in bucket.bot_ids:
-          bucket.bot_ids.append(bot_id)
-          bucket.bot_ids.sort()
-
-  for bot_id, dimensions in bots_inactive.iteritems():
-    # Looks at the current buckets, do not create one.
-    for bucket in snapshot.buckets:
-      # If this bot matches these dimensions, mark it as a member of this group.
-      if task_to_run.match_dimensions(
-          json.loads(bucket.dimensions), dimensions):
-        # This bot could be used for requests on this dimensions filter.
-        if not bot_id in bucket.bot_ids_bad:
-          bucket.bot_ids_bad.append(bot_id)
-          bucket.bot_ids_bad.sort()
-
-
-def _extract_snapshot_from_logs(start_time, end_time):
-  """Returns a _Snapshot from the processed logs for the specified interval.
-
-  The data is retrieved from logservice via stats_framework.
+  active_index = _get_bots_per_dimension(bots_active)
+  inactive_index = _get_bots_per_dimension(bots_inactive)
+  # Looks at the current buckets, do not create one.
+  for bucket in snapshot.buckets:
+    # The bots matching these dimensions could be used for requests on this
+    # dimensions filter, mark them as members of this group.
+    dimensions = json.loads(bucket.dimensions)
+    bot_ids = _match_bots(dimensions, bots_active, active_index)
+    bucket.bot_ids = sorted(bot_ids.union(bucket.bot_ids))
+    bot_ids = _match_bots(dimensions, bots_inactive, inactive_index)
+    bucket.bot_ids_bad = sorted(bot_ids.union(bucket.bot_ids_bad))
+
+
+def _extract_snapshot(start_time, end_time):
+  """Returns a _Snapshot from the processed entries for the specified interval.
+
+  The data is retrieved from STREAM_QUEUE or from logservice via
+  stats_framework. Entries streamed outside of StreamMiddleware carry no request
+  so they are not counted in http_requests and http_failures.
   """
   snapshot = _Snapshot()
   total_lines = 0
@@ -530,10 +576,15 @@ def _extract_snapshot_from_logs(start_time, end_time):
   bots_inactive = {}
   tasks_active = {}
 
-  for entry in stats_framework.yield_entries(start_time, end_time):
-    snapshot.http_requests += 1
-    if entry.request.status >= 500:
-      snapshot.http_failures += 1
+  for entry in stats_framework.yield_entries(
+      start_time, end_time, STREAM_QUEUE):
+    if isinstance(entry.request, stats_framework.StreamedRequests):
+      snapshot.http_requests += entry.request.requests
+      snapshot.http_failures += entry.request.failures
+    elif entry.request:
+      snapshot.http_requests += 1
+      if entry.request.status >= 500:
+        snapshot.http_failures += 1
 
     for l in entry.entries:
       if _parse_line(l, snapshot, bots_active, bots_inactive, tasks_active):
@@ -543,7 +594,7 @@ def _extract_snapshot_from_logs(start_time, end_time):
 
   _post_process(snapshot, bots_active, bots_inactive, tasks_active)
   logging.debug(
-      '_extract_snapshot_from_logs(%s, %s): %d lines, %d errors',
+      '_extract_snapshot(%s, %s): %d lines, %d errors',
       start_time, end_time, total_lines, parse_errors)
   return snapshot
 
@@ -551,13 +602,19 @@ def _extract_snapshot_from_logs(start_time, end_time):
 ### Public API
 
 
+# Pull queue the statistics entries are streamed to.
+STREAM_QUEUE = 'stats-stream'
+
+
 STATS_HANDLER = stats_framework.StatisticsFramework(
-    'global_stats', _Snapshot, _extract_snapshot_from_logs)
+    'global_stats', _Snapshot, _extract_snapshot)
 
 
 def add_entry(**kwargs):
   """Formatted statistics log entry so it can be processed for statistics."""
-  stats_framework.add_entry(_pack_entry(**kwargs))
+  message = _pack_entry(**kwargs)
+  stats_framework.add_entry(message)
+  stats_framework.stream_entry(STREAM_QUEUE, message)
 
 
 def add_run_entry(action, run_result_key, **kwargs):
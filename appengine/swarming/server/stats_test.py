@@ -3,6 +3,7 @@
 # Use of this source code is governed by the Apache v2.0 license that can be
 # found in the LICENSE file.
 
+import json
 import logging
 import os
 import sys
@@ -11,15 +12,23 @@ import unittest
 import test_env
 test_env.setup_test_env()
 
+import webapp2
+import webtest
+
+from components import stats_framework
+from components import utils
 from test_support import test_case
 
 from server import stats
+from server import task_to_run
 
 
 # pylint: disable=W0212
 
 
 class StatsPrivateTest(test_case.TestCase):
+  APP_DIR = test_env.APP_DIR
+
   def _gen_data(self):
     dimensions = {'os': 'Amiga', 'hostname': 'host3'}
     # Description of the log entries:
@@ -78,6 +87,8 @@ class StatsPrivateTest(test_case.TestCase):
     expected = {
       'bots_active': 3,
       'bots_inactive': 1,
+      'dedupe_cache_hits': 0,
+      'dedupe_cache_misses': 0,
       'http_failures': 0,
       'http_requests': 0,
       'tasks_active': 2,
@@ -218,6 +229,135 @@ class StatsPrivateTest(test_case.TestCase):
     self.assertEqual(expected, [i.dimensions for i in snapshot.buckets])
     self.assertEqual(0, len(snapshot.users))
 
+  def test_parse_dedupe(self):
+    data = (
+      stats._pack_entry(
+          action='task_enqueued', task_id='100', dimensions={}, user='me',
+          dedupe='hit'),
+      stats._pack_entry(
+          action='task_enqueued', task_id='200', dimensions={}, user='me',
+          dedupe='miss'),
+      stats._pack_entry(
+          action='task_enqueued', task_id='300', dimensions={}, user='me',
+          dedupe='hit'),
+      stats._pack_entry(
+          action='task_enqueued', task_id='400', dimensions={}, user='me'),
+    )
+    snapshot = stats._Snapshot()
+    for line in data:
+      self.assertEqual(True, stats._parse_line(line, snapshot, {}, {}, {}))
+    self.assertEqual(2, snapshot.dedupe_cache_hits)
+    self.assertEqual(1, snapshot.dedupe_cache_misses)
+    self.assertEqual(4, snapshot.tasks_enqueued)
+
+  def test_post_process_bots(self):
+    bots_active = {
+      'linux1': {'os': ['Linux', 'Linux-12.04'], 'pool': 'a'},
+      'linux2': {'os': ['Linux', 'Linux-14.04'], 'pool': 'b'},
+      'mac': {'os': 'Mac', 'pool': 'a'},
+      'nopool': {'os': ['Linux', 'Linux-14.04']},
+    }
+    bots_inactive = {
+      'bad': {'os': ['Linux', 'Linux-12.04'], 'pool': 'b'},
+    }
+    snapshot = stats._Snapshot()
+    buckets = (
+      {},
+      {'os': 'Linux'},
+      {'os': 'Linux-14.04', 'pool': 'b'},
+      {'os': 'Mac'},
+      {'pool': 'a'},
+      {'os': 'Windows'},
+      {'gpu': 'none'},
+    )
+    for dimensions in buckets:
+      snapshot.get_dimensions(utils.encode_to_json(dimensions))
+    stats._post_process(snapshot, bots_active, bots_inactive, {})
+
+    for bucket in snapshot.buckets:
+      dimensions = json.loads(bucket.dimensions)
+      expected = sorted(
+          b for b, d in bots_active.iteritems()
+          if task_to_run.match_dimensions(dimensions, d))
+      self.assertEqual(expected, bucket.bot_ids)
+      expected = sorted(
+          b for b, d in bots_inactive.iteritems()
+          if task_to_run.match_dimensions(dimensions, d))
+      self.assertEqual(expected, bucket.bot_ids_bad)
+    expected = {
+      '{"os":"Linux"}': ['linux1', 'linux2', 'nopool'],
+      '{"os":"Linux-14.04","pool":"b"}': ['linux2'],
+      '{"pool":"a"}': ['linux1', 'mac'],
+      '{"os":"Windows"}': [],
+    }
+    actual = {
+      b.dimensions: b.bot_ids for b in snapshot.buckets
+      if b.dimensions in expected
+    }
+    self.assertEqual(expected, actual)
+    self.assertEqual(
+        ['bad'], snapshot.get_dimensions('{"os":"Linux"}').bot_ids_bad)
+
+  def test_extract_snapshot_streamed(self):
+    # 2010-01-02 03:04:05
+    now = 1262401445.
+    self.mock(utils, 'time_time', lambda: now)
+    stats.add_entry(action='bot_active', bot_id='host3', dimensions={})
+    stats.add_entry(
+        action='task_enqueued', task_id='100', dimensions={}, user='me')
+    self.assertEqual(
+        2, len(self._taskqueue_stub.GetTasks(stats.STREAM_QUEUE)))
+
+    start = int(now) / 60 * 60
+    snapshot = stats._extract_snapshot(start, start + 60)
+    self.assertEqual(['host3'], snapshot.bot_ids)
+    self.assertEqual(1, snapshot.tasks_enqueued)
+    # Only the logs know about the HTTP requests.
+    self.assertEqual(0, snapshot.http_requests)
+    # The streamed entries were consumed.
+    self.assertEqual([], self._taskqueue_stub.GetTasks(stats.STREAM_QUEUE))
+
+  def test_extract_snapshot_streamed_requests(self):
+    # 2010-01-02 03:04:05
+    now = [1262401445.]
+    self.mock(utils, 'time_time', lambda: now[0])
+
+    # pylint: disable=E0213
+    class Handler(webapp2.RequestHandler):
+      def get(self2):
+        stats.add_entry(action='bot_active', bot_id='host3', dimensions={})
+        stats.add_entry(
+            action='task_enqueued', task_id='100', dimensions={}, user='me')
+        self2.response.write('Yay')
+
+      def post(self2):
+        self2.abort(500)
+
+    app = webtest.TestApp(
+        stats_framework.StreamMiddleware(
+            webapp2.WSGIApplication([('/', Handler)]), stats.STREAM_QUEUE),
+        extra_environ={'REMOTE_ADDR': 'fake-ip'})
+    self.assertEqual('Yay', app.get('/').body)
+    # One task for both entries.
+    self.assertEqual(
+        1, len(self._taskqueue_stub.GetTasks(stats.STREAM_QUEUE)))
+    # A request without entry is only counted.
+    app.post('/', status=500)
+    self.assertEqual(
+        1, len(self._taskqueue_stub.GetTasks(stats.STREAM_QUEUE)))
+    # The counts are streamed with the first request of the next minute.
+    now[0] += 60
+    app.post('/', status=500)
+    self.assertEqual(
+        2, len(self._taskqueue_stub.GetTasks(stats.STREAM_QUEUE)))
+
+    start = int(now[0] - 60) / 60 * 60
+    snapshot = stats._extract_snapshot(start, start + 60)
+    self.assertEqual(['host3'], snapshot.bot_ids)
+    self.assertEqual(1, snapshot.tasks_enqueued)
+    self.assertEqual(2, snapshot.http_requests)
+    self.assertEqual(1, snapshot.http_failures)
+    self.assertEqual([], self._taskqueue_stub.GetTasks(stats.STREAM_QUEUE))
 
 if __name__ == '__main__':
   logging.basicConfig(
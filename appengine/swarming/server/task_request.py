@@ -409,6 +409,41 @@ def _put_request(request):
   return datastore_utils.insert(request, _new_request_key)
 
 
+def _put_requests(requests):
+  """Puts multiple new TaskRequest in the DB.
+
+  Like _put_request(), each TaskRequest is inserted in its own transaction but
+  the transactions are run in parallel. The rare ones that fail, e.g. on a key
+  collision, are then retried one at a time.
+  """
+  keys = set()
+  for request in requests:
+    assert not request.key
+    key = _new_request_key()
+    while key in keys:
+      key = _new_request_key()
+    keys.add(key)
+    request.key = key
+
+  @ndb.tasklet
+  def insert_async(request):
+    def run():
+      if request.key.get():
+        return False
+      request.put()
+      return True
+    try:
+      inserted = yield datastore_utils.transaction_async(run, retries=0)
+    except datastore_utils.CommitError:
+      inserted = False
+    raise ndb.Return(inserted)
+
+  futures = [insert_async(request) for request in requests]
+  for request, future in zip(requests, futures):
+    if not future.get_result():
+      datastore_utils.insert(request, _new_request_key)
+
+
 def _assert_keys(expected_keys, minimum_keys, actual_keys, name):
   """Raise an exception if expected keys are not present."""
   actual_keys = frozenset(actual_keys)
@@ -497,7 +532,7 @@ def validate_request_key(request_key):
             root_entity_shard_id))
 
 
-def make_request(data):
+def _new_request(data):
   """Constructs a TaskRequest out of a yet-to-be-specified API.
 
   Argument:
@@ -525,7 +560,7 @@ def make_request(data):
   - user: overriden by parent.user
 
   Returns:
-    The newly created TaskRequest.
+    The new TaskRequest, not saved yet.
   """
   # Save ourself headaches with typos and refuses unexpected values.
   _assert_keys(_EXPECTED_DATA_KEYS, _REQUIRED_DATA_KEYS, data, 'request keys')
@@ -579,10 +614,36 @@ def make_request(data):
       properties=properties,
       tags=data['tags'],
       user=data['user'] or '')
+  return request
+
+
+def make_request(data):
+  """Constructs a TaskRequest out of a yet-to-be-specified API and saves it.
+
+  See _new_request() for the format of data.
+
+  Returns:
+    The newly created TaskRequest.
+  """
+  request = _new_request(data)
   _put_request(request)
   return request
 
 
+def make_requests(data_list):
+  """Constructs multiple TaskRequest and saves them.
+
+  All the requests are validated before any is saved. See _new_request() for
+  the format of each item of data_list.
+
+  Returns:
+    The list of newly created TaskRequest, in the same order.
+  """
+  requests = [_new_request(data) for data in data_list]
+  _put_requests(requests)
+  return requests
+
+
 def make_request_clone(original_request):
   """Makes a new TaskRequest from a previous one.
 
@@ -223,6 +223,30 @@ class TaskRequestApiTest(TestCase):
     with self.assertRaises(ValueError):
       task_request.make_request(data)
 
+  def test_make_requests(self):
+    self.mock_now(datetime.datetime(2010, 1, 2, 3, 4, 5))
+    # The first two keys collide, the second request gets a new one.
+    bits = iter([0x88, 0x88, 0x89])
+    self.mock(random, 'getrandbits', lambda _: next(bits))
+    requests = task_request.make_requests(
+        [_gen_request_data(name='job%d' % i) for i in xrange(2)])
+    self.assertEqual(['job0', 'job1'], [r.name for r in requests])
+    self.assertEqual(2, len(set(r.key for r in requests)))
+    # All the random values were used.
+    self.assertEqual(None, next(bits, None))
+    self.assertEqual(
+        ['job0', 'job1'], [r.key.get().name for r in requests])
+
+  def test_make_requests_invalid(self):
+    # A single invalid request fails the whole call, nothing is saved.
+    data = [
+      _gen_request_data(),
+      _gen_request_data(parent_task_id='1d69b9f088008810'),
+    ]
+    with self.assertRaises(ValueError):
+      task_request.make_requests(data)
+    self.assertEqual(0, task_request.TaskRequest.query().count())
+
   def test_make_request_idempotent(self):
     request = task_request.make_request(
         _gen_request_data(properties=dict(idempotent=True)))
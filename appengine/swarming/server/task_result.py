@@ -14,6 +14,8 @@ store tasks results.
 - The stdout of each command in TaskResult.properties.commands is saved inside
   TaskOutput.
 - It is chunked in TaskOutputChunk to fit the entity size limit.
+- Bot updates are saved as TaskOutputRecord, which are compacted into
+  TaskOutputChunk by a cron job.
 
 Graph of schema:
 
@@ -47,9 +49,9 @@ Graph of schema:
                  ^      ^        ...
                  |      |
     +---------------+  +---------------+
-    |TaskOutputChunk|  |TaskOutputChunk| ...
-    |id=1           |  |id=2           |
-    +---------------+  +---------------+
+    |TaskOutputChunk|  |TaskOutputRecord| ...
+    |id=1           |  |id=<offset+1>   |
+    +---------------+  +----------------+
 """
 
 import datetime
@@ -57,10 +59,12 @@ import logging
 import random
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api import search
 from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
+from components import datastore_utils
 from components import utils
 from server import task_pack
 from server import task_request
@@ -70,6 +74,16 @@ from server import task_request
 BOT_PING_TOLERANCE = datetime.timedelta(seconds=5*60)
 
 
+# Memcache namespace of the markers set once a TaskResultSummary or a
+# TaskRunResult stops running, see get_completed_keys(). Memcache is lossy so
+# the markers are only a hint.
+_COMPLETED_MEMCACHE_NAMESPACE = 'task_completed'
+
+
+# Expiration of the markers in _COMPLETED_MEMCACHE_NAMESPACE.
+_COMPLETED_MEMCACHE_SECS = 10*60
+
+
 class State(object):
   """States in which a task can be.
 
@@ -137,23 +151,22 @@ def _calculate_failure(result_common):
 
 
 class TaskOutput(ndb.Model):
-  """Phantom entity to represent a command output stored as small chunks.
+  """Index of a command output stored as small chunks.
 
   Parent is TaskRunResult. Key id is the command's index + 1, because id 0 is
   invalid.
 
-  Child entities TaskOutputChunk are aggregated for the whole output.
-
-  This entity doesn't actually exist in the DB. It only exists to make
-  categories.
+  Output is first appended as immutable TaskOutputRecord child entities, so a
+  bot update doesn't need to read anything. They are later folded into the
+  TaskOutputChunk child entities by compact_output(), which also saves this
+  entity. It only exists once the output was compacted at least once.
   """
-  # The maximum size for each TaskOutputChunk.chunk. The rationale is that
-  # appending data to an entity requires reading it first, so it must not be too
-  # big. On the other hand, having thousands of small entities is pure overhead.
+  # The default size for each TaskOutputChunk.chunk. The rationale is that
+  # compacting data into an entity requires reading it first, so it must not be
+  # too big. On the other hand, having thousands of small entities is pure
+  # overhead.
   # TODO(maruel): This value was selected from guts feeling. Do proper load
   # testing to find the best value.
-  # TODO(maruel): This value should be stored in the entity for future-proofing.
-  # It can't be changed until then.
   CHUNK_SIZE = 100*1024
 
   # Maximum content saved in a TaskOutput.
@@ -165,26 +178,66 @@ class TaskOutput(ndb.Model):
   PUT_MAX_CHUNKS = PUT_MAX_CONTENT / CHUNK_SIZE
 
   # Hard limit on the amount of data returned by get_output_async() at once.
-  # Eventually, we'll want to add support for chunked fetch, if desired. Because
-  # CHUNK_SIZE is hardcoded, it's not exactly 16Mb.
+  # Eventually, we'll want to add support for chunked fetch, if desired.
   FETCH_MAX_CONTENT = 16*1000*1024
 
   # Maximum number of chunks to fetch at once.
   FETCH_MAX_CHUNKS = FETCH_MAX_CONTENT / CHUNK_SIZE
 
+  # Maximum number of TaskOutputRecord folded in a single transaction. Each is
+  # at most CHUNK_SIZE so this keeps the transaction well below 10Mb.
+  COMPACT_MAX_RECORDS = 50
+
   # It is easier if there is no remainder for efficiency.
   assert (PUT_MAX_CONTENT % CHUNK_SIZE) == 0
   assert (FETCH_MAX_CONTENT % CHUNK_SIZE) == 0
 
+  # Number of bytes folded into TaskOutputChunk, including the gaps.
+  size = ndb.IntegerProperty(default=0, indexed=False)
+  # gaps is a series of 2 integer pairs, which specifies the part that are
+  # invalid, i.e. were never written to. All values are absolute offsets in the
+  # output.
+  gaps = ndb.IntegerProperty(repeated=True, indexed=False)
+
   @classmethod
   @ndb.tasklet
-  def get_output_async(cls, output_key, number_chunks):
-    """Returns the stdout for a single command as a ndb.Future."""
-    # TODO(maruel): Save number_chunks locally in this entity.
+  def get_output_async(cls, output_key, number_chunks, offset=0, length=None):
+    """Returns the stdout for a single command as a ndb.Future.
+
+    number_chunks is the upper bound of the number of chunks of CHUNK_SIZE, as
+    saved in TaskRunResult.stdout_chunks.
+
+    Only the range [offset, offset+length) of the output is returned, at most
+    FETCH_MAX_CONTENT bytes. The result is shorter than length when the end of
+    the output is reached.
+    """
     if not number_chunks:
       raise ndb.Return(None)
-
-    number_chunks = min(number_chunks, cls.FETCH_MAX_CHUNKS)
+    assert offset >= 0, offset
+    if length is None or length > cls.FETCH_MAX_CONTENT:
+      length = cls.FETCH_MAX_CONTENT
+    end = offset + length
+
+    # Fetch the index and the records not compacted yet in parallel with the
+    # chunks. A record never crosses a CHUNK_SIZE boundary.
+    index_future = output_key.get_async()
+    records_future = TaskOutputRecord.query(ancestor=output_key).filter(
+        TaskOutputRecord.key >=
+            _output_key_to_output_record_key(
+                output_key, offset / cls.CHUNK_SIZE * cls.CHUNK_SIZE)).filter(
+        TaskOutputRecord.key <
+            _output_key_to_output_record_key(output_key, end)).order(
+        TaskOutputRecord.key).fetch_async()
+
+    index = yield index_future
+    chunk_size = cls.CHUNK_SIZE
+    if index:
+      size = index.size
+    else:
+      # Not compacted yet or saved before TaskOutput existed.
+      size = number_chunks * chunk_size
+    first = offset / chunk_size
+    last = (min(end, size) + chunk_size - 1) / chunk_size
 
     # TODO(maruel): Always get one more than necessary, in case number_chunks
     # is invalid. If there's an unexpected TaskOutputChunk entity present,
@@ -192,20 +245,33 @@ class TaskOutput(ndb.Model):
     parts = []
     for f in ndb.get_multi_async(
         _output_key_to_output_chunk_key(output_key, i)
-        for i in xrange(number_chunks)):
+        for i in xrange(first, last)):
       chunk = yield f
       parts.append(chunk.chunk if chunk else None)
 
-    # Trim ending empty chunks.
-    while parts and not parts[-1]:
-      parts.pop()
-
-    # parts is now guaranteed to not end with an empty chunk.
-    # Replace any missing chunk.
-    for i in xrange(len(parts)):
-      if not parts[i]:
-        parts[i] = '\x00' * cls.CHUNK_SIZE
-    raise ndb.Return(''.join(parts))
+    if not index:
+      # number_chunks is only an upper bound. Trim ending empty chunks.
+      while parts and not parts[-1]:
+        parts.pop()
+
+    # Replace any missing chunk and pad the incomplete ones.
+    for i in xrange(len(parts) - 1):
+      parts[i] = (parts[i] or '').ljust(chunk_size, '\x00')
+    out = bytearray(''.join(p or '' for p in parts))
+
+    # Overlay the output not compacted yet, in write order so a range written
+    # again by a retried update overwrites the older data.
+    base = first * chunk_size
+    records = yield records_future
+    records.sort(key=lambda r: (r.created_ts, r.offset))
+    for record in records:
+      start = record.offset - base
+      data = record.data
+      if start < 0:
+        data = data[-start:]
+        start = 0
+      _overlay(out, start, data)
+    raise ndb.Return(str(out[offset-base:end-base]))
 
 
 class TaskOutputChunk(ndb.Model):
@@ -215,12 +281,11 @@ class TaskOutputChunk(ndb.Model):
   since 0 is not a valid id.
 
   Each entity except the last one must have exactly
-  len(self.chunk) == self.CHUNK_SIZE.
+  len(self.chunk) == TaskOutput.CHUNK_SIZE.
   """
   chunk = ndb.BlobProperty(default='', compressed=True)
-  # gaps is a series of 2 integer pairs, which specifies the part that are
-  # invalid. Normally it should be empty. All values are relative to the start
-  # of this chunk offset.
+  # Only set on entities saved before the gaps were tracked in TaskOutput.
+  # All values are relative to the start of this chunk offset.
   gaps = ndb.IntegerProperty(repeated=True, indexed=False)
 
   @property
@@ -228,6 +293,25 @@ class TaskOutputChunk(ndb.Model):
     return self.key.integer_id() - 1
 
 
+class TaskOutputRecord(ndb.Model):
+  """Represents output appended by a bot update and not compacted yet.
+
+  Parent is TaskOutput. Key id is the offset of the data in the output + 1,
+  since 0 is not a valid id, so a retried update overwrites the same entity.
+
+  It is immutable and at most TaskOutput.CHUNK_SIZE long. compact_output()
+  folds it into TaskOutputChunk entities and deletes it.
+  """
+  data = ndb.BlobProperty(default='', compressed=True)
+  # Records are overlaid in write order. Only None for entities saved before
+  # this property existed.
+  created_ts = ndb.DateTimeProperty(auto_now_add=True)
+
+  @property
+  def offset(self):
+    return self.key.integer_id() - 1
+
+
 class _TaskResultCommon(ndb.Model):
   """Contains properties that is common to both TaskRunResult and
   TaskResultSummary.
@@ -257,9 +341,9 @@ class _TaskResultCommon(ndb.Model):
   # automatically if possible.
   internal_failure = ndb.BooleanProperty(default=False)
 
-  # Number of TaskOutputChunk entities for each output for each command. Set to
-  # 0 when no output has been collected for a specific index. Ordered by
-  # command.
+  # Upper bound of the number of TaskOutputChunk entities of
+  # TaskOutput.CHUNK_SIZE for each output for each command. Set to 0 when no
+  # output has been collected for a specific index. Ordered by command.
   stdout_chunks = ndb.IntegerProperty(repeated=True, indexed=False)
 
   # Aggregated exit codes. Ordered by command.
@@ -380,26 +464,33 @@ class _TaskResultCommon(ndb.Model):
     if not self.server_versions or self.server_versions[-1] != server_version:
       self.server_versions.append(server_version)
 
-  def get_outputs(self):
-    """Yields the actual outputs as a generator of strings."""
+  def get_outputs(self, offsets=None):
+    """Yields the actual outputs as a generator of strings.
+
+    offsets is an optional list of the offset to start reading from for each
+    command, so only the new output is fetched.
+    """
     # TODO(maruel): Make this function async.
     if not self.run_result_key or not self.stdout_chunks:
       # The task was not reaped or no output was streamed yet.
       return []
 
     # Fetch everything in parallel.
+    offsets = offsets or []
     futures = [
-      self.get_command_output_async(command_index)
+      self.get_command_output_async(
+          command_index,
+          offsets[command_index] if command_index < len(offsets) else 0)
       for command_index in xrange(len(self.stdout_chunks))
     ]
     return (future.get_result() for future in futures)
 
   @ndb.tasklet
-  def get_command_output_async(self, command_index):
+  def get_command_output_async(self, command_index, offset=0, length=None):
     """Returns the stdout for a single command as a ndb.Future.
 
     Use out.get_result() to get the data as a str or None if no output is
-    present.
+    present. See TaskOutput.get_output_async() for offset and length.
     """
     assert isinstance(command_index, int), command_index
     if (not self.run_result_key or
@@ -413,7 +504,8 @@ class _TaskResultCommon(ndb.Model):
 
     output_key = _run_result_key_to_output_key(
         self.run_result_key, command_index)
-    out = yield TaskOutput.get_output_async(output_key, number_chunks)
+    out = yield TaskOutput.get_output_async(
+        output_key, number_chunks, offset, length)
     raise ndb.Return(out)
 
   def _pre_put_hook(self):
@@ -437,6 +529,18 @@ class _TaskResultCommon(ndb.Model):
     self.children_task_ids = sorted(
         set(self.children_task_ids), key=lambda x: int(x, 16))
 
+  def _post_put_hook(self, future):
+    """Signals the waiters once the task stops running."""
+    super(_TaskResultCommon, self)._post_put_hook(future)
+    if self.state not in State.STATES_RUNNING:
+      key = self.key.urlsafe()
+      # Do not signal before the transaction commits, the waiter would read the
+      # old entity.
+      ndb.get_context().call_on_commit(
+          lambda: memcache.set(
+              key, True, time=_COMPLETED_MEMCACHE_SECS,
+              namespace=_COMPLETED_MEMCACHE_NAMESPACE))
+
 
 class TaskRunResult(_TaskResultCommon):
   """Contains the results for a TaskToRun scheduled on a bot.
@@ -520,6 +624,14 @@ class TaskRunResult(_TaskResultCommon):
     assert self.stdout_chunks[command_index] <= TaskOutput.PUT_MAX_CHUNKS
     return entities
 
+  def get_output_keys(self):
+    """Returns the TaskOutput keys of the commands that have output."""
+    return [
+      _run_result_key_to_output_key(self.key, command_index)
+      for command_index, number_chunks in enumerate(self.stdout_chunks)
+      if number_chunks
+    ]
+
   def to_dict(self):
     out = super(TaskRunResult, self).to_dict()
     out['try_number'] = self.try_number
@@ -699,113 +811,181 @@ def _output_key_to_output_chunk_key(output_key, chunk_number):
   return ndb.Key(TaskOutputChunk, chunk_number+1, parent=output_key)
 
 
+def _output_key_to_output_record_key(output_key, offset):
+  """Returns a ndb.key to a TaskOutputRecord. offset is zero-indexed."""
+  assert output_key.kind() == 'TaskOutput', output_key
+  assert offset >= 0, offset
+  return ndb.Key(TaskOutputRecord, offset+1, parent=output_key)
+
+
+def _overlay(buf, start, data):
+  """Writes data in the bytearray buf at offset start, padding with zeros."""
+  if len(buf) < start:
+    buf.extend('\x00' * (start - len(buf)))
+  buf[start:start+len(data)] = data
+
+
+def _strip_gaps(gaps, start, end):
+  """Returns the gaps with the range [start, end) removed from them.
+
+  gaps is a series of 2 integer pairs.
+  """
+  new_gaps = []
+  for i in xrange(0, len(gaps), 2):
+    gap_start = gaps[i]
+    gap_end = gaps[i+1]
+    # If the gap overlaps the chunk being written, strip it. Cases:
+    #   Gap:     |   |
+    #   Chunk: |   |
+    if start <= gap_start <= end and end <= gap_end:
+      gap_start = end
+
+    #   Gap:     |   |
+    #   Chunk:     |   |
+    if gap_start <= start and start <= gap_end <= end:
+      gap_end = start
+
+    #   Gap:       |  |
+    #   Chunk:   |      |
+    if start <= gap_start <= end and start <= gap_end <= end:
+      continue
+
+    #   Gap:     |      |
+    #   Chunk:     |  |
+    if gap_start < start < gap_end and gap_start <= end <= gap_end:
+      # Create a hole.
+      new_gaps.extend((gap_start, start))
+      new_gaps.extend((end, gap_end))
+    else:
+      new_gaps.extend((gap_start, gap_end))
+  return new_gaps
+
+
 def _output_append(output_key, number_chunks, output, output_chunk_start):
-  """Appends output to a TaskOutput in TaskOutputChunk entities.
+  """Appends output to a TaskOutput as TaskOutputRecord entities.
 
-  Creates new TaskOutputChunk entities as necessary as children of
-  TaskRunResult/TaskOutput.
+  The records are split on TaskOutput.CHUNK_SIZE boundaries. They are later
+  folded into TaskOutputChunk entities by compact_output().
 
-  It silently drops saving the output if it goes over ~16Mb. The hard limit is
-  32Mb but HTML escaping can expand the raw data a bit, so just store half of
-  the limit to be on the safe side.
+  It silently drops saving the output if it goes over PUT_MAX_CONTENT.
 
   TODO(maruel): This is because AppEngine can't do response over 32Mb and at
   this point, it's probably just a ton of junk. Figure out a way to better
   implement this if necessary.
 
-  Does one DB read by key and no puts. It's the responsibility of the caller to
-  save the entities.
+  Does no DB operation. It's the responsibility of the caller to save the
+  entities.
 
   Arguments:
-    output_key: ndb.Key to TaskOutput that is the parent of TaskOutputChunk.
-    number_chunks: Current number of TaskOutputChunk instances. If 0, this means
-        there is not data yet.
+    output_key: ndb.Key to TaskOutput that is the parent of TaskOutputRecord.
+    number_chunks: Current upper bound of the number of TaskOutputChunk of
+        TaskOutput.CHUNK_SIZE. If 0, this means there is not data yet.
     output: Actual content to append.
     output_chunk_start: Index of the data to be written to.
 
   Returns:
-    A tuple of (list of entities to save, number_chunks). The number_chunks is
-    the number of TaskOutputChunk instances for this output.
+    A tuple of (list of entities to save, number_chunks).
   """
   assert output and isinstance(output, str), output
   assert output_key.kind() == 'TaskOutput', output_key
 
-  # Split everything in small bits.
-  chunks = []
+  entities = []
   while output:
     chunk_number = output_chunk_start / TaskOutput.CHUNK_SIZE
     if chunk_number >= TaskOutput.PUT_MAX_CHUNKS:
       # TODO(maruel): Log into TaskOutput that data was dropped.
       logging.error('Dropping output\n%d bytes were lost', len(output))
       break
-    key = _output_key_to_output_chunk_key(output_key, chunk_number)
-    start = output_chunk_start % TaskOutput.CHUNK_SIZE
-    next_start = TaskOutput.CHUNK_SIZE - start
-    chunks.append((key, start, output[:next_start]))
-    output = output[next_start:]
+    next_start = (chunk_number+1)*TaskOutput.CHUNK_SIZE
+    size = next_start - output_chunk_start
+    entities.append(
+        TaskOutputRecord(
+            key=_output_key_to_output_record_key(
+                output_key, output_chunk_start),
+            data=output[:size]))
+    output = output[size:]
     number_chunks = max(number_chunks, chunk_number + 1)
-    output_chunk_start = (chunk_number+1)*TaskOutput.CHUNK_SIZE
+    output_chunk_start = next_start
+  return entities, number_chunks
 
-  if not chunks:
-    return [], number_chunks
 
-  # Get the TaskOutputChunk from the DB. Normally it would be only one entity
-  # (the last incomplete one) but this code supports arbitrary overwrite.
-  #
-  # number_chunks should normally be used to skip entities that are assumed to
-  # not be present but we don't assume the number_chunks is valid for safety.
-  #
-  # This means an unneeded get() is done on the missing chunk.
-  entities = ndb.get_multi(i[0] for i in chunks)
-
-  # Update the entities.
-  for i in xrange(len(chunks)):
-    key, start, output = chunks[i]
-    if not entities[i]:
-      # Fill up for missing entities.
-      entities[i] = TaskOutputChunk(key=key)
-    chunk = entities[i]
-    # Magically combine everything.
-    end = start + len(output)
-    if len(chunk.chunk) < start:
-      # Insert blank data automatically.
-      chunk.gaps.extend((len(chunk.chunk), start))
-      chunk.chunk = chunk.chunk + '\x00' * (start-len(chunk.chunk))
-
-    # Strip gaps that are being written to.
-    new_gaps = []
-    for i in xrange(0, len(chunk.gaps), 2):
-      # All values are relative to the starting offset of the chunk itself.
-      gap_start = chunk.gaps[i]
-      gap_end = chunk.gaps[i+1]
-      # If the gap overlaps the chunk being written, strip it. Cases:
-      #   Gap:     |   |
-      #   Chunk: |   |
-      if start <= gap_start <= end and end <= gap_end:
-        gap_start = end
-
-      #   Gap:     |   |
-      #   Chunk:     |   |
-      if gap_start <= start and start <= gap_end <= end:
-        gap_end = start
-
-      #   Gap:       |  |
-      #   Chunk:   |      |
-      if start <= gap_start <= end and start <= gap_end <= end:
-        continue
+@ndb.tasklet
+def _output_compact_async(output_key):
+  """Folds up to TaskOutput.COMPACT_MAX_RECORDS TaskOutputRecord entities.
 
-      #   Gap:     |      |
-      #   Chunk:     |  |
-      if gap_start < start < gap_end and gap_start <= end <= gap_end:
-        # Create a hole.
-        new_gaps.extend((gap_start, start))
-        new_gaps.extend((end, gap_end))
-      else:
-        new_gaps.extend((gap_start, gap_end))
-
-    chunk.gaps = new_gaps
-    chunk.chunk = chunk.chunk[:start] + output + chunk.chunk[end:]
-  return entities, number_chunks
+  The records are folded in write order, like get_output_async() overlays
+  them.
+
+  Must be run inside a transaction. Returns the number of records folded.
+  """
+  records = yield TaskOutputRecord.query(ancestor=output_key).order(
+      TaskOutputRecord.key).fetch_async(TaskOutput.COMPACT_MAX_RECORDS)
+  legacy = [r for r in records if not r.created_ts]
+  if legacy:
+    # Saved before TaskOutputRecord.created_ts existed, so before the others.
+    records = legacy
+  elif len(records) == TaskOutput.COMPACT_MAX_RECORDS:
+    # There may be more records, fold the oldest ones first.
+    records = yield TaskOutputRecord.query(ancestor=output_key).order(
+        TaskOutputRecord.created_ts).fetch_async(
+            TaskOutput.COMPACT_MAX_RECORDS)
+  if not records:
+    raise ndb.Return(0)
+  records.sort(key=lambda r: (r.created_ts, r.offset))
+
+  index = yield output_key.get_async()
+  if not index:
+    index = TaskOutput(key=output_key)
+    # Take in account the chunks saved before TaskOutput existed.
+    keys = yield TaskOutputChunk.query(ancestor=output_key).fetch_async(
+        keys_only=True)
+    last = (yield keys[-1].get_async()) if keys else None
+    if last:
+      index.size = last.chunk_number * TaskOutput.CHUNK_SIZE + len(last.chunk)
+  chunk_size = TaskOutput.CHUNK_SIZE
+
+  # Split everything in chunk sized bits, in write order.
+  parts = []
+  for record in records:
+    start = record.offset
+    end = start + len(record.data)
+    if index.size < start:
+      index.gaps.extend((index.size, start))
+    index.gaps = _strip_gaps(index.gaps, start, end)
+    index.size = max(index.size, end)
+    data = record.data
+    while data:
+      chunk_number = start / chunk_size
+      offset = start % chunk_size
+      parts.append((chunk_number, offset, data[:chunk_size-offset]))
+      data = data[chunk_size-offset:]
+      start = (chunk_number+1)*chunk_size
+
+  # Get the TaskOutputChunk from the DB. Normally it would be only the last
+  # incomplete one but this code supports arbitrary overwrite.
+  numbers = sorted(set(p[0] for p in parts))
+  existing = yield ndb.get_multi_async(
+      _output_key_to_output_chunk_key(output_key, n) for n in numbers)
+  chunks = {}
+  for number, chunk in zip(numbers, existing):
+    chunks[number] = bytearray(chunk.chunk) if chunk else bytearray()
+  for chunk_number, offset, data in parts:
+    _overlay(chunks[chunk_number], offset, data)
+
+  entities = [index]
+  for chunk_number in numbers:
+    chunk = chunks[chunk_number]
+    if chunk_number != index.size / chunk_size:
+      # Chunks before the last one must be full.
+      chunk.extend('\x00' * (chunk_size - len(chunk)))
+    entities.append(
+        TaskOutputChunk(
+            key=_output_key_to_output_chunk_key(output_key, chunk_number),
+            chunk=str(chunk)))
+  yield (
+      ndb.put_multi_async(entities),
+      ndb.delete_multi_async(r.key for r in records))
+  raise ndb.Return(len(records))
 
 
 def _sort_property(sort):
@@ -866,6 +1046,44 @@ def new_run_result(request, try_number, bot_id, bot_version):
       server_versions=[utils.get_app_version()])
 
 
+@ndb.tasklet
+def compact_output_async(output_key):
+  """Folds the TaskOutputRecord of a TaskOutput into TaskOutputChunk entities.
+
+  Processes the records in write order in batches of
+  TaskOutput.COMPACT_MAX_RECORDS, each in its own transaction.
+
+  Returns the number of records folded as a ndb.Future. The future raises
+  datastore_utils.CommitError if a transaction failed.
+  """
+  assert output_key.kind() == 'TaskOutput', output_key
+  total = 0
+  while True:
+    count = yield datastore_utils.transaction_async(
+        lambda: _output_compact_async(output_key))
+    if not count:
+      raise ndb.Return(total)
+    total += count
+
+
+def compact_output(output_key):
+  """Synchronous version of compact_output_async()."""
+  return compact_output_async(output_key).get_result()
+
+
+def get_completed_keys(keys):
+  """Returns the subset of TaskResultSummary or TaskRunResult keys that were
+  recently saved as not running anymore.
+
+  It only reads memcache so it is cheap but lossy; a key not returned may still
+  be completed.
+  """
+  keys = list(keys)
+  found = memcache.get_multi(
+      [k.urlsafe() for k in keys], namespace=_COMPLETED_MEMCACHE_NAMESPACE)
+  return set(k for k in keys if k.urlsafe() in found)
+
+
 def yield_run_result_keys_with_dead_bot():
   """Yields all the TaskRunResult ndb.Key where the bot died recently.
 
@@ -330,6 +330,20 @@ class TaskResultApiTest(TestCase):
         run_result.key_packed)
     self.assertEqual(complete_ts, run_result.ended_ts)
 
+  def test_get_completed_keys(self):
+    request = task_request.make_request(_gen_request_data())
+    result_summary = task_result.new_result_summary(request)
+    result_summary.modified_ts = utils.utcnow()
+    ndb.transaction(result_summary.put)
+    self.assertEqual(
+        set(), task_result.get_completed_keys([result_summary.key]))
+
+    result_summary.state = task_result.State.EXPIRED
+    ndb.transaction(result_summary.put)
+    self.assertEqual(
+        set([result_summary.key]),
+        task_result.get_completed_keys([result_summary.key]))
+
   def test_yield_run_result_keys_with_dead_bot(self):
     request = task_request.make_request(_gen_request_data())
     result_summary = task_result.new_result_summary(request)
@@ -350,6 +364,32 @@ class TaskResultApiTest(TestCase):
         [run_result.key],
         list(task_result.yield_run_result_keys_with_dead_bot()))
 
+  def test_compact_output_async(self):
+    request = task_request.make_request(_gen_request_data())
+    run_result = task_result.new_run_result(request, 1, 'localhost', 'abc')
+    ndb.put_multi(run_result.append_output(0, 'Foo', 0))
+    ndb.put_multi(run_result.append_output(1, 'Bar', 0))
+    futures = [
+      task_result.compact_output_async(
+          task_result._run_result_key_to_output_key(run_result.key, i))
+      for i in (0, 1)
+    ]
+    self.assertEqual([1, 1], [f.get_result() for f in futures])
+    self.assertEqual(0, task_result.TaskOutputRecord.query().count())
+    self.assertEqual(['Foo', 'Bar'], list(run_result.get_outputs()))
+
+  def test_compact_output(self):
+    request = task_request.make_request(_gen_request_data())
+    run_result = task_result.new_run_result(request, 1, 'localhost', 'abc')
+    ndb.put_multi(run_result.append_output(0, 'Foo', 0))
+    ndb.put_multi(run_result.append_output(0, 'Bar', 3))
+    output_key = task_result._run_result_key_to_output_key(run_result.key, 0)
+    self.assertEqual(2, task_result.compact_output(output_key))
+    self.assertEqual(0, task_result.compact_output(output_key))
+    self.assertEqual(0, task_result.TaskOutputRecord.query().count())
+    self.assertEqual(
+        ['FooBar'], [t.chunk for t in task_result.TaskOutputChunk.query()])
+
   def test_set_from_run_result(self):
     request = task_request.make_request(_gen_request_data())
     result_summary = task_result.new_result_summary(request)
@@ -481,10 +521,25 @@ class TestOutput(TestCase):
     ndb.transaction(lambda: ndb.put_multi((result_summary, self.run_result)))
     self.run_result = self.run_result.key.get()
 
-  def assertTaskOutputChunk(self, expected):
+  def assertTaskOutputChunk(self, expected, gaps):
+    # Compacts the records first.
+    output_key = task_result._run_result_key_to_output_key(
+        self.run_result.key, 0)
+    self.assertTrue(task_result.compact_output(output_key))
+    self.assertEqual(0, task_result.TaskOutputRecord.query().count())
     q = task_result.TaskOutputChunk.query().order(
         task_result.TaskOutputChunk.key)
-    self.assertEqual(expected, [t.to_dict() for t in q.fetch()])
+    self.assertEqual(expected, [t.chunk for t in q.fetch()])
+    self.assertEqual(gaps, output_key.get().gaps)
+
+  def test_append_output_write_order(self):
+    # A record saved later overwrites an older one even if its offset is lower.
+    ndb.put_multi(self.run_result.append_output(0, 'Bar', 1))
+    self.mock_now(self.now, 1)
+    ndb.put_multi(self.run_result.append_output(0, 'Foo', 0))
+    self.assertEqual(['Foor'], list(self.run_result.get_outputs()))
+    self.assertTaskOutputChunk(['Foor'], [])
+    self.assertEqual(['Foor'], list(self.run_result.get_outputs()))
 
   def test_append_output(self):
     # Test that one can stream output and it is returned fine.
@@ -558,7 +613,7 @@ class TestOutput(TestCase):
     self.assertEqual(
         expected_output,
         self.run_result.get_command_output_async(0).get_result())
-    self.assertTaskOutputChunk([{'chunk': expected_output, 'gaps': [0, 10]}])
+    self.assertTaskOutputChunk([expected_output], [0, 10])
 
   def test_append_output_partial_hole(self):
     ndb.put_multi(self.run_result.append_output(0, 'Foo', 0))
@@ -567,7 +622,7 @@ class TestOutput(TestCase):
     self.assertEqual(
         expected_output,
         self.run_result.get_command_output_async(0).get_result())
-    self.assertTaskOutputChunk([{'chunk': expected_output, 'gaps': [3, 10]}])
+    self.assertTaskOutputChunk([expected_output], [3, 10])
 
   def test_append_output_partial_far(self):
     ndb.put_multi(self.run_result.append_output(
@@ -575,10 +630,9 @@ class TestOutput(TestCase):
     self.assertEqual(
         '\x00' * (task_result.TaskOutput.CHUNK_SIZE + 10) + 'Foo',
         self.run_result.get_command_output_async(0).get_result())
-    expected = [
-      {'chunk': '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Foo', 'gaps': [0, 10]},
-    ]
-    self.assertTaskOutputChunk(expected)
+    expected = ['\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Foo']
+    self.assertTaskOutputChunk(
+        expected, [0, task_result.TaskOutput.CHUNK_SIZE + 10])
 
   def test_append_output_partial_far_split(self):
     # Missing, writing happens on two different TaskOutputChunk entities.
@@ -588,13 +642,11 @@ class TestOutput(TestCase):
         '\x00' * (task_result.TaskOutput.CHUNK_SIZE * 2 - 3) + 'FooBar',
         self.run_result.get_command_output_async(0).get_result())
     expected = [
-      {
-        'chunk': '\x00' * (task_result.TaskOutput.CHUNK_SIZE - 3) + 'Foo',
-        'gaps': [0, 102397],
-      },
-      {'chunk': 'Bar', 'gaps': []},
+      '\x00' * (task_result.TaskOutput.CHUNK_SIZE - 3) + 'Foo',
+      'Bar',
     ]
-    self.assertTaskOutputChunk(expected)
+    self.assertTaskOutputChunk(
+        expected, [0, 2 * task_result.TaskOutput.CHUNK_SIZE - 3])
 
   def test_append_output_overwrite(self):
     # Overwrite previously written data.
@@ -602,7 +654,7 @@ class TestOutput(TestCase):
     ndb.put_multi(self.run_result.append_output(0, 'X', 3))
     self.assertEqual(
         'FooXar', self.run_result.get_command_output_async(0).get_result())
-    self.assertTaskOutputChunk([{'chunk': 'FooXar', 'gaps': []}])
+    self.assertTaskOutputChunk(['FooXar'], [])
 
   def test_append_output_reverse_order(self):
     # Write the data in reverse order in multiple calls.
@@ -614,8 +666,7 @@ class TestOutput(TestCase):
     self.assertEqual(
         expected_output,
         self.run_result.get_command_output_async(0).get_result())
-    self.assertTaskOutputChunk(
-        [{'chunk': expected_output, 'gaps': [3, 4, 7, 8]}])
+    self.assertTaskOutputChunk([expected_output], [3, 4, 7, 8])
 
   def test_append_output_reverse_order_second_chunk(self):
     # Write the data in reverse order in multiple calls.
@@ -630,8 +681,39 @@ class TestOutput(TestCase):
     self.assertEqual(
         task_result.TaskOutput.CHUNK_SIZE * '\x00' + 'Baz\x00Bar\x00FooWow',
         self.run_result.get_command_output_async(0).get_result())
+    size = task_result.TaskOutput.CHUNK_SIZE
     self.assertTaskOutputChunk(
-        [{'chunk': 'Baz\x00Bar\x00FooWow', 'gaps': [3, 4, 7, 8]}])
+        ['Baz\x00Bar\x00FooWow'],
+        [0, size, size + 3, size + 4, size + 7, size + 8])
+
+  def test_append_output_compacted(self):
+    # Output is read from both the compacted chunks and the records.
+    ndb.put_multi(self.run_result.append_output(0, 'FooBar', 0))
+    self.assertTaskOutputChunk(['FooBar'], [])
+    ndb.put_multi(self.run_result.append_output(0, 'Baz', 6))
+    ndb.put_multi(self.run_result.append_output(0, 'X', 1))
+    self.assertEqual(
+        'FXoBarBaz', self.run_result.get_command_output_async(0).get_result())
+    self.assertTaskOutputChunk(['FXoBarBaz'], [])
+    self.assertEqual(
+        'FXoBarBaz', self.run_result.get_command_output_async(0).get_result())
+
+  def test_append_output_range(self):
+    # Output can be read by range, both from the records and the chunks.
+    size = task_result.TaskOutput.CHUNK_SIZE
+    ndb.put_multi(self.run_result.append_output(0, 'Foo', size - 1))
+    ndb.put_multi(self.run_result.append_output(0, 'Bar', 2 * size))
+    for _ in xrange(2):
+      get = lambda *args: self.run_result.get_command_output_async(
+          0, *args).get_result()
+      self.assertEqual('Foo', get(size - 1, 3))
+      self.assertEqual('Ba', get(2 * size, 2))
+      self.assertEqual('r', get(2 * size + 2))
+      self.assertEqual('', get(2 * size + 3))
+      self.assertEqual(2 * size + 3, len(get(0, 4 * size)))
+      output_key = task_result._run_result_key_to_output_key(
+          self.run_result.key, 0)
+      task_result.compact_output(output_key)
 
 
 if __name__ == '__main__':
@@ -9,12 +9,16 @@ This is the interface closest to the HTTP handlers.
 
 import contextlib
 import datetime
+import functools
+import json
 import logging
 import math
 import random
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api import search
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.runtime import apiproxy_errors
 
@@ -34,6 +38,39 @@ from server import task_to_run
 _PROBABILITY_OF_QUICK_COMEBACK = 0.05
 
 
+# Pull queue buffering the non-final bot updates, see bot_update_task().
+_BOT_UPDATE_QUEUE = 'bot-update'
+
+
+# A non-final bot update is buffered in _BOT_UPDATE_QUEUE only if the
+# TaskRunResult was saved less than this amount of time ago. This bounds how
+# stale TaskRunResult.modified_ts can get if cron_flush_bot_updates() falls
+# behind, well below task_result.BOT_PING_TOLERANCE.
+_BOT_UPDATE_COALESCE_WINDOW = datetime.timedelta(seconds=60)
+
+
+# Maximum number of buffered updates leased at once by cron_flush_bot_updates().
+_BOT_UPDATE_LEASE_MAX = 1000
+
+
+# Pull queue listing the TaskOutput with TaskOutputRecord to compact, see
+# cron_compact_output(). The payload is the urlsafe TaskOutput key.
+_OUTPUT_COMPACT_QUEUE = 'output-compact'
+
+
+# Maximum number of TaskOutput leased at once by cron_compact_output().
+_OUTPUT_COMPACT_LEASE_MAX = 1000
+
+
+# Maximum number of documents saved in a single search.Index.put() call.
+_SEARCH_PUT_MAX = 200
+
+
+# Memcache namespace of the properties_hash -> packed TaskRunResult key cache of
+# the results that can be reused by idempotent requests.
+_DEDUPE_MEMCACHE_NAMESPACE = 'task_dedupe'
+
+
 def _secs_to_ms(value):
   """Converts a seconds value in float to the number of ms as an integer."""
   return int(round(value * 1000.))
@@ -85,6 +122,7 @@ def _expire_task(to_run_key, request):
     success = False
   if success:
     task_to_run.set_lookup_cache(to_run_key, False)
+    task_to_run.update_pending_counts({to_run_key.integer_id(): -1})
     logging.info(
         'Expired %s', task_pack.pack_result_summary_key(result_summary_key))
   return success
@@ -131,6 +169,7 @@ def _reap_task(to_run_key, request, bot_id, bot_version):
     run_result = None
   if run_result:
     task_to_run.set_lookup_cache(to_run_key, False)
+    task_to_run.update_pending_counts({to_run_key.integer_id(): -1})
   return run_result
 
 
@@ -156,6 +195,185 @@ def _update_stats(run_result, bot_id, request, completed):
         dimensions=request.properties.dimensions)
 
 
+def _set_dedupe_cache(result_summary, now):
+  """Caches result_summary as the results to reuse for its properties_hash.
+
+  The entry expires once the results are older than reusable_task_age_secs.
+  """
+  max_age = datetime.timedelta(
+      seconds=config.settings().reusable_task_age_secs)
+  expiration = int((result_summary.created_ts + max_age - now).total_seconds())
+  if expiration <= 0:
+    return
+  memcache.set(
+      result_summary.properties_hash.encode('hex'),
+      task_pack.pack_run_result_key(result_summary.run_result_key),
+      time=expiration,
+      namespace=_DEDUPE_MEMCACHE_NAMESPACE)
+
+
+def _get_dedupe_result_summaries(properties_hashes, now):
+  """Returns the TaskResultSummary whose results can be reused, if any, for
+  each properties_hash.
+
+  First looks up the memcache populated by _set_dedupe_cache() with a single
+  call, then falls back to parallel queries on TaskResultSummary.properties_hash
+  for the ones not found.
+
+  Returns:
+    dict(properties_hash: tuple(TaskResultSummary or None, True if it was found
+    in memcache)).
+  """
+  # Refuse tasks older than X days. This is due to the isolate server dropping
+  # files. https://code.google.com/p/swarming/issues/detail?id=197
+  oldest = now - datetime.timedelta(
+      seconds=config.settings().reusable_task_age_secs)
+  properties_hashes = sorted(set(properties_hashes))
+  if not properties_hashes:
+    return {}
+  cached = memcache.get_multi(
+      [h.encode('hex') for h in properties_hashes],
+      namespace=_DEDUPE_MEMCACHE_NAMESPACE)
+  hits = [h for h in properties_hashes if cached.get(h.encode('hex'))]
+  summaries = ndb.get_multi(
+      task_pack.run_result_key_to_result_summary_key(
+          task_pack.unpack_run_result_key(cached[h.encode('hex')]))
+      for h in hits)
+  out = {}
+  for properties_hash, dupe_summary in zip(hits, summaries):
+    if (dupe_summary and
+        dupe_summary.properties_hash == properties_hash and
+        dupe_summary.created_ts > oldest):
+      out[properties_hash] = (dupe_summary, True)
+
+  # Find a previously run task that is also idempotent and completed. See the
+  # comment for this property for more details.
+  #
+  # Do not use "cls.created_ts > oldest" here because this would require a
+  # composite index. It's unnecessary because TaskRequest.key is mostly
+  # equivalent to decreasing TaskRequest.created_ts, ordering by key works as
+  # well and doesn't require a composite index.
+  cls = task_result.TaskResultSummary
+  futures = [
+    (h, cls.query(cls.properties_hash==h).order(cls.key).get_async())
+    for h in properties_hashes if h not in out
+  ]
+  for properties_hash, future in futures:
+    dupe_summary = future.get_result()
+    if not dupe_summary or dupe_summary.created_ts <= oldest:
+      out[properties_hash] = (None, False)
+      continue
+    _set_dedupe_cache(dupe_summary, now)
+    out[properties_hash] = (dupe_summary, False)
+  return out
+
+
+def _update_result_summary(run_result, result_summary, request, now):
+  """Updates result_summary from run_result after a bot update."""
+  if (result_summary.try_number and
+      result_summary.try_number > run_result.try_number):
+    # The situation where a shard is retried but the bot running the previous
+    # try somehow reappears and reports success, the result must still show
+    # the last try's result. We still need to update cost_usd manually.
+    result_summary.costs_usd[run_result.try_number-1] = run_result.cost_usd
+    result_summary.modified_ts = now
+  else:
+    result_summary.set_from_run_result(run_result, request)
+
+
+def _buffer_bot_update(
+    run_result_key, bot_id, output, output_chunk_start, cost_usd, request,
+    server_version, now):
+  """Saves a non-final bot update without a transaction, if possible.
+
+  The output is saved right away as TaskOutputRecord entities, which are
+  immutable and keyed by their offset, so the ordering guarantees are the same
+  as in a transaction. The new cost_usd and modified_ts are added to
+  _BOT_UPDATE_QUEUE and coalesced per TaskRunResult by
+  cron_flush_bot_updates(). The output is not added to _OUTPUT_COMPACT_QUEUE;
+  it is compacted once the output grows into a new chunk or the command
+  completes, which are both saved in a transaction.
+
+  Returns False if the update must instead be saved in a transaction, e.g. the
+  TaskRunResult is not running anymore, server_version is not signaled yet or
+  TaskRunResult.stdout_chunks grows.
+  """
+  # Do not use the context cache, append_output() modifies the entity.
+  run_result = run_result_key.get(use_cache=False)
+  if (not run_result or
+      run_result.bot_id != bot_id or
+      run_result.state != task_result.State.RUNNING or
+      run_result.server_versions[-1:] != [server_version] or
+      not run_result.modified_ts or
+      now - run_result.modified_ts >= _BOT_UPDATE_COALESCE_WINDOW):
+    return False
+
+  entities = []
+  if output:
+    stdout_chunks = run_result.stdout_chunks[:]
+    entities = run_result.append_output(0, output, output_chunk_start or 0)
+    if run_result.stdout_chunks != stdout_chunks:
+      return False
+
+  packed = task_pack.pack_run_result_key(run_result_key)
+  payload = {
+    'cost_usd': cost_usd,
+    'modified_ts': utils.datetime_to_timestamp(now),
+  }
+  try:
+    futures = ndb.put_multi_async(entities)
+    rpc = taskqueue.Queue(_BOT_UPDATE_QUEUE).add_async(
+        taskqueue.Task(method='PULL', payload=json.dumps(payload), tag=packed))
+    for f in futures:
+      f.get_result()
+    rpc.get_result()
+  except (datastore_errors.Error, taskqueue.Error) as e:
+    # Saving the output again in the transaction is harmless.
+    logging.warning('Failed to buffer update for %s: %s', packed, e)
+    return False
+  _update_stats(run_result, bot_id, request, False)
+  return True
+
+
+def _enqueue_output_compaction_async(output_keys, transactional=False):
+  """Adds the TaskOutput keys to _OUTPUT_COMPACT_QUEUE.
+
+  Returns a taskqueue RPC.
+  """
+  output_keys = sorted(set(k.urlsafe() for k in output_keys))
+  return taskqueue.Queue(_OUTPUT_COMPACT_QUEUE).add_async(
+      [taskqueue.Task(method='PULL', payload=k) for k in output_keys],
+      transactional=transactional)
+
+
+def _flush_bot_updates(run_result_key, cost_usd, modified_ts):
+  """Saves the buffered updates of a TaskRunResult in a transaction.
+
+  Returns True if the entities were modified.
+  """
+  result_summary_key = task_pack.run_result_key_to_result_summary_key(
+      run_result_key)
+
+  def run():
+    run_result, result_summary = ndb.get_multi(
+        (run_result_key, result_summary_key))
+    # Once the task is not running anymore, the final update carried the
+    # latest values.
+    if not run_result or run_result.state != task_result.State.RUNNING:
+      return False
+    if (cost_usd <= (run_result.cost_usd or 0.) and
+        modified_ts <= run_result.modified_ts):
+      return False
+    run_result.cost_usd = max(cost_usd, run_result.cost_usd or 0.)
+    run_result.modified_ts = max(modified_ts, run_result.modified_ts)
+    _update_result_summary(
+        run_result, result_summary, None, run_result.modified_ts)
+    ndb.put_multi((run_result, result_summary))
+    return True
+
+  return datastore_utils.transaction(run)
+
+
 def _handle_dead_bot(run_result_key):
   """Handles TaskRunResult where its bot has stopped showing sign of life.
 
@@ -225,6 +443,9 @@ def _handle_dead_bot(run_result_key):
     success, bot_id = None, None
   if success is not None:
     task_to_run.set_lookup_cache(to_run_key, success)
+    if success:
+      # The task is retried.
+      task_to_run.update_pending_counts({to_run_key.integer_id(): 1})
     if not success:
       stats.add_run_entry(
           'run_bot_died', run_result_key,
@@ -267,6 +488,25 @@ def exponential_backoff(attempt_num):
   return min(max_wait, math.pow(1.5, min(attempt_num, 10) + 1))
 
 
+def get_bot_sleep_duration(sleep_streak, pending_count):
+  """Returns how long an idle bot should sleep before polling again, in seconds.
+
+  Arguments:
+  - sleep_streak: number of consecutive sleeps of the bot.
+  - pending_count: number of pending tasks the bot could run as returned by
+      task_to_run.get_pending_count(), None if unknown.
+
+  When there is nothing to run, the bot backs off exponentially. When tasks are
+  pending but were reaped by other bots first, it comes back sooner the deeper
+  the queue is. The duration is jittered so the fleet doesn't poll in lockstep.
+  """
+  if pending_count is None:
+    return exponential_backoff(sleep_streak)
+  duration = exponential_backoff(sleep_streak) / (1. + pending_count)
+  max_wait = 3. if utils.is_canary() else 60.
+  return min(max_wait, max(1., duration * random.uniform(0.75, 1.25)))
+
+
 def schedule_request(request):
   """Creates and stores all the entities to schedule a new task request.
 
@@ -283,29 +523,31 @@ def schedule_request(request):
   Returns:
     TaskResultSummary. TaskToRun is not returned.
   """
-  dupe_future = None
-  if request.properties.idempotent:
-    # Find a previously run task that is also idempotent and completed. Start a
-    # query to fetch items that can be used to dedupe the task. See the comment
-    # for this property for more details.
-    #
-    # Do not use "cls.created_ts > oldest" here because this would require a
-    # composite index. It's unnecessary because TaskRequest.key is mostly
-    # equivalent to decreasing TaskRequest.created_ts, ordering by key works as
-    # well and doesn't require a composite index.
-    cls = task_result.TaskResultSummary
-    h = request.properties.properties_hash
-    dupe_future = cls.query(cls.properties_hash==h).order(cls.key).get_async()
-
-  # At this point, the request is now in the DB but not yet in a mode where it
-  # can be triggered or visible. Index it right away so it is searchable. If any
-  # of remaining calls in this function fail, the TaskRequest and Search
-  # Document will simply point to an incomplete task, which will be ignored.
+  return schedule_requests([request])[0]
+
+
+def schedule_requests(requests):
+  """Same as schedule_request() for multiple TaskRequest at once.
+
+  The Search documents are saved in batches of _SEARCH_PUT_MAX. The
+  TaskResultSummary and TaskToRun of each request are saved in their own
+  transaction, all run in parallel, along a single transaction per parent task.
+
+  Returns:
+    List of TaskResultSummary, in the same order as requests.
+  """
+  # At this point, the requests are now in the DB but not yet in a mode where
+  # they can be triggered or visible. Index them right away so they are
+  # searchable. If any of remaining calls in this function fail, the
+  # TaskRequest and Search Document will simply point to an incomplete task,
+  # which will be ignored.
   #
   # Creates the entities TaskToRun and TaskResultSummary but do not save them
   # yet. TaskRunResult will be created once a bot starts it.
-  task = task_to_run.new_task_to_run(request)
-  result_summary = task_result.new_result_summary(request)
+  tasks = [task_to_run.new_task_to_run(request) for request in requests]
+  result_summaries = [
+    task_result.new_result_summary(request) for request in requests
+  ]
 
   # Do not specify a doc_id, as they are guaranteed to be monotonically
   # increasing and searches are done in reverse order, which fits exactly the
@@ -313,84 +555,118 @@ def schedule_request(request):
   # (!) and NumberField is signed 32 bits so the best it could do with EPOCH is
   # second resolution up to year 2038.
   index = search.Index(name='requests')
-  packed = task_pack.pack_result_summary_key(result_summary.key)
-  doc = search.Document(
-      fields=[
-        search.TextField(name='name', value=request.name),
-        search.AtomField(name='id', value=packed),
-      ])
+  docs = [
+    search.Document(
+        fields=[
+          search.TextField(name='name', value=request.name),
+          search.AtomField(
+              name='id',
+              value=task_pack.pack_result_summary_key(result_summary.key)),
+        ])
+    for request, result_summary in zip(requests, result_summaries)
+  ]
   # Even if it fails here, we're still fine, as the task is not "alive" yet.
-  search_future = index.put_async([doc])
+  search_futures = [
+    index.put_async(docs[i:i+_SEARCH_PUT_MAX])
+    for i in xrange(0, len(docs), _SEARCH_PUT_MAX)
+  ]
 
   now = utils.utcnow()
 
-  if dupe_future:
-    # Reuse the results!
-    dupe_summary = dupe_future.get_result()
-    # Refuse tasks older than X days. This is due to the isolate server dropping
-    # files. https://code.google.com/p/swarming/issues/detail?id=197
-    oldest = now - datetime.timedelta(
-        seconds=config.settings().reusable_task_age_secs)
-    if dupe_summary and dupe_summary.created_ts > oldest:
-      # If there's a bug, commenting out this block is sufficient to disable the
-      # functionality.
-      # Setting task.queue_number to None removes it from the scheduling.
-      task.queue_number = None
-      _copy_entity(dupe_summary, result_summary, ('created_ts', 'name', 'user'))
-      result_summary.properties_hash = None
-      result_summary.try_number = 0
-      result_summary.cost_saved_usd = result_summary.cost_usd
-      # Only zap after.
-      result_summary.costs_usd = []
-      result_summary.deduped_from = task_pack.pack_run_result_key(
-          dupe_summary.run_result_key)
-
-  # Get parent task details if applicable.
-  parent_task_keys = None
-  if request.parent_task_id:
-    parent_run_key = task_pack.unpack_run_result_key(request.parent_task_id)
-    parent_task_keys = [
-      parent_run_key,
-      task_pack.run_result_key_to_result_summary_key(parent_run_key),
-    ]
+  dupes = _get_dedupe_result_summaries(
+      [
+        r.properties.properties_hash for r in requests
+        if r.properties.idempotent
+      ],
+      now)
+
+  stats_kwargs = []
+  # Packed TaskRunResult key of the parent task -> list of children task ids.
+  children = {}
+  for request, task, result_summary in zip(requests, tasks, result_summaries):
+    kwargs = {}
+    if request.properties.idempotent:
+      # Reuse the results!
+      dupe_summary, cache_hit = dupes[request.properties.properties_hash]
+      kwargs['dedupe'] = 'hit' if cache_hit else 'miss'
+      if dupe_summary:
+        # If there's a bug, commenting out this block is sufficient to disable
+        # the functionality.
+        # Setting task.queue_number to None removes it from the scheduling.
+        task.queue_number = None
+        _copy_entity(
+            dupe_summary, result_summary, ('created_ts', 'name', 'user'))
+        result_summary.properties_hash = None
+        result_summary.try_number = 0
+        result_summary.cost_saved_usd = result_summary.cost_usd
+        # Only zap after.
+        result_summary.costs_usd = []
+        result_summary.deduped_from = task_pack.pack_run_result_key(
+            dupe_summary.run_result_key)
+    stats_kwargs.append(kwargs)
+
+    # Get parent task details if applicable.
+    if request.parent_task_id:
+      children.setdefault(request.parent_task_id, []).append(
+          result_summary.key_packed)
 
-  result_summary.modified_ts = now
+    result_summary.modified_ts = now
 
   # Storing these entities makes this task live. It is important at this point
   # that the HTTP handler returns as fast as possible, otherwise the task will
   # be run but the client will not know about it.
-  def run():
+  def run(result_summary, task):
     ndb.put_multi([result_summary, task])
 
-  def run_parent():
+  def run_parent(parent_task_id, children_task_ids):
     # This one is slower.
-    items = ndb.get_multi(parent_task_keys)
-    k = result_summary.key_packed
+    parent_run_key = task_pack.unpack_run_result_key(parent_task_id)
+    items = ndb.get_multi([
+      parent_run_key,
+      task_pack.run_result_key_to_result_summary_key(parent_run_key),
+    ])
     for item in items:
-      item.children_task_ids.append(k)
+      item.children_task_ids.extend(children_task_ids)
       item.modified_ts = now
     ndb.put_multi(items)
 
   # Raising will abort to the caller.
-  futures = [datastore_utils.transaction_async(run)]
-  if parent_task_keys:
-    futures.append(datastore_utils.transaction_async(run_parent))
-
-  try:
-    search_future.get_result()
-  except search.Error:
-    # Do not abort the task, for now search is best effort.
-    logging.exception('Put failed')
+  futures = [
+    datastore_utils.transaction_async(
+        functools.partial(run, result_summary, task))
+    for result_summary, task in zip(result_summaries, tasks)
+  ]
+  futures.extend(
+      datastore_utils.transaction_async(
+          functools.partial(run_parent, parent_task_id, children_task_ids))
+      for parent_task_id, children_task_ids in children.iteritems())
+
+  for search_future in search_futures:
+    try:
+      search_future.get_result()
+    except search.Error:
+      # Do not abort the task, for now search is best effort.
+      logging.exception('Put failed')
 
   for future in futures:
     # Check for failures, it would raise in this case, aborting the call.
     future.get_result()
 
-  stats.add_task_entry(
-      'task_enqueued', result_summary.key,
-      dimensions=request.properties.dimensions,
-      user=request.user)
-  return result_summary
+  pending = {}
+  for task in tasks:
+    if task.queue_number:
+      h = task.key.integer_id()
+      pending[h] = pending.get(h, 0) + 1
+  task_to_run.update_pending_counts(pending)
+
+  for request, result_summary, kwargs in zip(
+      requests, result_summaries, stats_kwargs):
+    stats.add_task_entry(
+        'task_enqueued', result_summary.key,
+        dimensions=request.properties.dimensions,
+        user=request.user,
+        **kwargs)
+  return result_summaries
 
 
 def bot_reap_task(dimensions, bot_id, bot_version):
@@ -471,6 +747,10 @@ def bot_update_task(
   Invalid states, these are flat out refused:
   - A command is updated after it had an exit code assigned to.
 
+  Updates that do not complete a command are buffered when possible: the output
+  is saved right away but cost_usd and modified_ts are only saved by
+  cron_flush_bot_updates(). State transitions are always saved synchronously.
+
   Returns:
     tuple(bool, bool); first is if the update succeeded, second is if the task
     completed.
@@ -489,6 +769,15 @@ def bot_update_task(
   request = request_future.get_result()
   now = utils.utcnow()
 
+  # Updates that could be refused, e.g. a duration without exit_code, are
+  # validated in the transaction.
+  if (exit_code is None and duration is None and not hard_timeout and
+      not io_timeout and
+      _buffer_bot_update(
+          run_result_key, bot_id, output, output_chunk_start, cost_usd, request,
+          server_version, now)):
+    return True, False
+
   def run():
     # 2 consecutive GETs, one PUT.
     run_result_future = run_result_key.get_async()
@@ -496,24 +785,26 @@ def bot_update_task(
     run_result = run_result_future.get_result()
     if not run_result:
       result_summary_future.wait()
-      return None, False, 'is missing'
+      return None, None, False, 'is missing'
 
     if run_result.bot_id != bot_id:
       result_summary_future.wait()
-      return None, False, 'expected bot (%s) but had update from bot %s' % (
-          run_result.bot_id, bot_id)
+      return (
+          None, None, False,
+          'expected bot (%s) but had update from bot %s' % (
+              run_result.bot_id, bot_id))
 
     # This happens as an HTTP request is retried when the DB write succeeded but
     # it still returned HTTP 500.
     if len(run_result.exit_codes) and exit_code is not None:
       if run_result.exit_codes[0] != exit_code:
         result_summary_future.wait()
-        return None, False, 'got 2 different exit_codes; %d then %d' % (
+        return None, None, False, 'got 2 different exit_codes; %d then %d' % (
             run_result.exit_codes[0], exit_code)
 
     if (duration is None) != (exit_code is None):
       result_summary_future.wait()
-      return None, False, (
+      return None, None, False, (
           'had unexpected duration; expected iff a command completes; index %d'
           % len(run_result.exit_codes))
 
@@ -534,37 +825,45 @@ def bot_update_task(
 
     run_result.signal_server_version(server_version)
     to_put = [run_result]
+    compaction_rpc = None
+    stdout_chunks = run_result.stdout_chunks[:]
     if output:
       # This does 1 multi GETs. This also modifies run_result in place.
       to_put.extend(
           run_result.append_output(0, output, output_chunk_start or 0))
+    # Compact the output once per chunk, when it grows into a new one, instead
+    # of once per update. Compact it again once the command completed so the
+    # last chunk is folded too.
+    if (run_result.stdout_chunks != stdout_chunks or exit_code is not None or
+        run_result.state not in task_result.State.STATES_RUNNING):
+      output_keys = run_result.get_output_keys()
+      if output_keys:
+        compaction_rpc = _enqueue_output_compaction_async(
+            output_keys, transactional=True)
 
     run_result.cost_usd = max(cost_usd, run_result.cost_usd or 0.)
     run_result.modified_ts = now
 
     result_summary = result_summary_future.get_result()
-    if (result_summary.try_number and
-        result_summary.try_number > run_result.try_number):
-      # The situation where a shard is retried but the bot running the previous
-      # try somehow reappears and reports success, the result must still show
-      # the last try's result. We still need to update cost_usd manually.
-      result_summary.costs_usd[run_result.try_number-1] = run_result.cost_usd
-      result_summary.modified_ts = now
-    else:
-      result_summary.set_from_run_result(run_result, request)
-
+    _update_result_summary(run_result, result_summary, request, now)
     to_put.append(result_summary)
     ndb.put_multi(to_put)
-    return run_result, task_completed, None
+    if compaction_rpc:
+      compaction_rpc.get_result()
+    return run_result, result_summary, task_completed, None
 
   try:
-    run_result, task_completed, error = datastore_utils.transaction(run)
+    run_result, result_summary, task_completed, error = (
+        datastore_utils.transaction(run))
   except datastore_utils.CommitError:
     # It is important that the caller correctly surface this error.
     return False, False
 
   if run_result:
     _update_stats(run_result, bot_id, request, task_completed)
+  if result_summary and result_summary.properties_hash:
+    # The results can now be reused by new idempotent requests.
+    _set_dedupe_cache(result_summary, now)
   if error:
       logging.error('Task %s %s', packed, error)
   return True, task_completed
@@ -646,6 +945,8 @@ def cancel_task(result_summary_key):
     return 'Failed killing task %s: %s' % (packed, e)
   # Add it to the negative cache.
   task_to_run.set_lookup_cache(to_run_key, False)
+  if ok:
+    task_to_run.update_pending_counts({to_run_key.integer_id(): -1})
   # TODO(maruel): Add stats.
   return ok, was_running
 
@@ -670,8 +971,13 @@ def cron_abort_expired_task_to_run():
   """
   killed = 0
   skipped = 0
+  # The whole queue is scanned anyway, use it to refresh the pending counts and
+  # to backfill the TaskToRun missing from the dimensions_hash index.
+  pending_counts = {}
+  unindexed = []
   try:
-    for to_run in task_to_run.yield_expired_task_to_run():
+    for to_run in task_to_run.yield_expired_task_to_run(
+        pending_counts, unindexed):
       request = to_run.request_key.get()
       if _expire_task(to_run.key, request):
         killed += 1
@@ -683,6 +989,8 @@ def cron_abort_expired_task_to_run():
       else:
         # It's not a big deal, the bot will continue running.
         skipped += 1
+    task_to_run.set_pending_counts(pending_counts)
+    task_to_run.set_dimensions_hash(unindexed)
   finally:
     # TODO(maruel): Use stats_framework.
     logging.info('Killed %d task, skipped %d', killed, skipped)
@@ -711,3 +1019,94 @@ def cron_handle_bot_died():
     # TODO(maruel): Use stats_framework.
     logging.info('Killed %d; retried %d; ignored: %d', killed, retried, ignored)
   return killed, retried, ignored
+
+
+def cron_compact_output():
+  """Folds the TaskOutputRecord saved by bot updates into TaskOutputChunk.
+
+  The TaskOutput listed in _OUTPUT_COMPACT_QUEUE are leased in batches and
+  compacted in parallel. The ones that fail to be compacted are retried once
+  their lease expires.
+
+  Returns the number of records folded.
+  """
+  queue = taskqueue.Queue(_OUTPUT_COMPACT_QUEUE)
+  compacted = 0
+  failed = 0
+  try:
+    while True:
+      tasks = queue.lease_tasks(60, _OUTPUT_COMPACT_LEASE_MAX)
+      if not tasks:
+        break
+      # urlsafe TaskOutput key -> tasks.
+      outputs = {}
+      for task in tasks:
+        outputs.setdefault(task.payload, []).append(task)
+      futures = [
+        (k, task_result.compact_output_async(ndb.Key(urlsafe=k)))
+        for k in outputs
+      ]
+      done = []
+      for output_key, future in futures:
+        try:
+          compacted += future.get_result()
+          done.extend(outputs[output_key])
+        except datastore_utils.CommitError as e:
+          # It'll be retried once the lease expires.
+          logging.warning('Failed compacting %s: %s', output_key, e)
+          failed += 1
+      if done:
+        queue.delete_tasks(done)
+      if len(tasks) < _OUTPUT_COMPACT_LEASE_MAX:
+        break
+  finally:
+    # TODO(maruel): Use stats_framework.
+    logging.info('Compacted %d records; failed: %d', compacted, failed)
+  return compacted
+
+
+def cron_flush_bot_updates():
+  """Saves the non-final bot updates buffered by bot_update_task().
+
+  The updates are leased in batches and coalesced per TaskRunResult, so a
+  running task gets at most one transaction per batch. Updates that fail to be
+  saved are retried once their lease expires.
+
+  Returns the number of TaskRunResult updated.
+  """
+  queue = taskqueue.Queue(_BOT_UPDATE_QUEUE)
+  updated = 0
+  failed = 0
+  try:
+    while True:
+      tasks = queue.lease_tasks(60, _BOT_UPDATE_LEASE_MAX)
+      if not tasks:
+        break
+      # packed run_result_key -> [cost_usd, modified_ts, tasks].
+      runs = {}
+      for task in tasks:
+        payload = json.loads(task.payload)
+        modified_ts = utils.timestamp_to_datetime(payload['modified_ts'])
+        run = runs.setdefault(task.tag, [0., modified_ts, []])
+        run[0] = max(run[0], payload['cost_usd'] or 0.)
+        run[1] = max(run[1], modified_ts)
+        run[2].append(task)
+      done = []
+      for packed, (cost_usd, modified_ts, run_tasks) in runs.iteritems():
+        try:
+          if _flush_bot_updates(
+              task_pack.unpack_run_result_key(packed), cost_usd, modified_ts):
+            updated += 1
+          done.extend(run_tasks)
+        except datastore_utils.CommitError as e:
+          # It'll be retried once the lease expires.
+          logging.warning('Failed flushing %s: %s', packed, e)
+          failed += 1
+      if done:
+        queue.delete_tasks(done)
+      if len(tasks) < _BOT_UPDATE_LEASE_MAX:
+        break
+  finally:
+    # TODO(maruel): Use stats_framework.
+    logging.info('Flushed %d; failed: %d', updated, failed)
+  return updated
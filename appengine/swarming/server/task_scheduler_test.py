@@ -15,6 +15,7 @@ import test_env
 test_env.setup_test_env()
 
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api import search
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
@@ -168,6 +169,49 @@ class TaskSchedulerApiTest(test_case.TestCase):
         lambda: task_scheduler._PROBABILITY_OF_QUICK_COMEBACK - 0.01)
     self.assertEqual(1.0, task_scheduler.exponential_backoff(235))
 
+  def test_get_bot_sleep_duration(self):
+    self.mock(
+        task_scheduler.random, 'random',
+        lambda: task_scheduler._PROBABILITY_OF_QUICK_COMEBACK)
+    self.mock(task_scheduler.random, 'uniform', lambda a, b: b)
+    self.mock(utils, 'is_canary', lambda: False)
+    # Unknown queue depth, plain exponential backoff.
+    self.assertEqual(
+        task_scheduler.exponential_backoff(8),
+        task_scheduler.get_bot_sleep_duration(8, None))
+    # Nothing to run, jittered exponential backoff.
+    self.assertEqual(
+        60., task_scheduler.get_bot_sleep_duration(10, 0))
+    self.assertEqual(
+        round(1.5**9 * 1.25, 3),
+        round(task_scheduler.get_bot_sleep_duration(8, 0), 3))
+    # The deeper the queue, the sooner the bot comes back.
+    self.assertEqual(
+        round(1.5**9 * 1.25 / 3, 3),
+        round(task_scheduler.get_bot_sleep_duration(8, 2), 3))
+    self.assertEqual(1., task_scheduler.get_bot_sleep_duration(8, 1000))
+
+  def test_bot_reap_task_pending_counts(self):
+    task_to_run.set_pending_counts({})
+    data = _gen_request_data(
+        properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+    task_scheduler.schedule_request(task_request.make_request(data))
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    # Just scheduled, the count is not trusted yet.
+    self.assertEqual(None, task_to_run.get_pending_count(bot_dimensions))
+
+    # Simulate the new task markers expiring.
+    h = task_to_run.request_to_task_to_run_key(
+        task_request.TaskRequest.query().get()).integer_id()
+    memcache.delete_multi(
+        ['new', 'new:%d' % h], namespace='task_to_run_pending')
+    task_scheduler.cron_abort_expired_task_to_run()
+    self.assertEqual(1, task_to_run.get_pending_count(bot_dimensions))
+    _request, run_result = task_scheduler.bot_reap_task(
+        bot_dimensions, 'localhost', 'abc')
+    self.assertTrue(run_result)
+    self.assertEqual(0, task_to_run.get_pending_count(bot_dimensions))
+
   def _task_ran_successfully(self):
     """Runs a task successfully and returns the task_id."""
     data = _gen_request_data(
@@ -250,6 +294,24 @@ class TaskSchedulerApiTest(test_case.TestCase):
     new_ts = self.mock_now(self.now, config.settings().reusable_task_age_secs-1)
     self._task_deduped(new_ts, task_id)
 
+  def test_task_idempotent_memcache(self):
+    self.mock(random, 'getrandbits', lambda _: 0x88)
+    # The results are cached once the first task completes.
+    task_id = self._task_ran_successfully()
+    h = task_request.TaskRequest.query().get().properties.properties_hash
+    self.assertEqual(
+        task_id,
+        memcache.get(
+            h.encode('hex'),
+            namespace=task_scheduler._DEDUPE_MEMCACHE_NAMESPACE))
+
+    # Second task is deduped against first task without a query.
+    def query(*_args, **_kwargs):
+      self.fail('Unexpected query')
+    self.mock(task_result.TaskResultSummary, 'query', query)
+    new_ts = self.mock_now(self.now, config.settings().reusable_task_age_secs-1)
+    self._task_deduped(new_ts, task_id)
+
   def test_task_idempotent_old(self):
     self.mock(random, 'getrandbits', lambda _: 0x88)
     # First task is idempotent.
@@ -331,6 +393,33 @@ class TaskSchedulerApiTest(test_case.TestCase):
     self.assertEqual(expected, parent_run_result_key.get().children_task_ids)
     self.assertEqual(expected, parent_res_summary_key.get().children_task_ids)
 
+  def test_schedule_requests_parent_children(self):
+    # Parent task creates many child tasks at once.
+    parent_id = self._task_ran_successfully()
+    # Each request needs its own key.
+    bits = iter(xrange(0x100, 0x200))
+    self.mock(random, 'getrandbits', lambda _: next(bits))
+    requests = task_request.make_requests([
+      _gen_request_data(
+          name='child%d' % i,
+          parent_task_id=parent_id,
+          properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+      for i in xrange(3)
+    ])
+    self.assertEqual(3, len(set(r.key for r in requests)))
+    result_summaries = task_scheduler.schedule_requests(requests)
+    self.assertEqual(
+        ['child0', 'child1', 'child2'], [r.name for r in result_summaries])
+
+    parent_run_result_key = task_pack.unpack_run_result_key(parent_id)
+    parent_res_summary_key = task_pack.run_result_key_to_result_summary_key(
+        parent_run_result_key)
+    expected = [r.key_packed for r in result_summaries]
+    self.assertEqual(expected, parent_run_result_key.get().children_task_ids)
+    self.assertEqual(expected, parent_res_summary_key.get().children_task_ids)
+    # The parent's TaskToRun plus the 3 children.
+    self.assertEqual(4, task_to_run.TaskToRun.query().count())
+
   def test_get_results(self):
     # TODO(maruel): Split in more focused tests.
     self.mock(random, 'getrandbits', lambda _: 0x88)
@@ -560,6 +649,20 @@ class TaskSchedulerApiTest(test_case.TestCase):
     request = task_request.make_request(data)
     self.assertTrue(task_scheduler.schedule_request(request))
 
+  def test_schedule_requests(self):
+    requests = task_request.make_requests([
+      _gen_request_data(
+          name='job%d' % i,
+          properties=dict(dimensions={u'OS': u'Windows-3.1.1'}))
+      for i in xrange(2)
+    ])
+    result_summaries = task_scheduler.schedule_requests(requests)
+    self.assertEqual(['job0', 'job1'], [r.name for r in result_summaries])
+    self.assertEqual(
+        [State.PENDING, State.PENDING],
+        [r.key.get().state for r in result_summaries])
+    self.assertEqual(2, task_to_run.TaskToRun.query().count())
+
   def test_bot_update_task(self):
     run_result = _quick_reap()
     self.assertEqual(
@@ -587,6 +690,145 @@ class TaskSchedulerApiTest(test_case.TestCase):
             0.1))
     self.assertEqual(['hhey'], list(run_result.key.get().get_outputs()))
 
+  def test_cron_compact_output(self):
+    run_result = _quick_reap()
+    task_scheduler.bot_update_task(
+        run_result.key, 'localhost', 'hi', 0, None, None, False, False, 0.1)
+    task_scheduler.bot_update_task(
+        run_result.key, 'localhost', 'hey', 2, None, None, False, False, 0.1)
+    self.assertEqual(2, task_scheduler.cron_compact_output())
+    self.assertEqual(0, task_scheduler.cron_compact_output())
+    self.assertEqual(['hihey'], list(run_result.key.get().get_outputs()))
+
+  def test_bot_update_task_compact_output_enqueued(self):
+    # The output is enqueued for compaction when it grows into a new chunk and
+    # when the command completes, not on every update.
+    def count():
+      return len(self._taskqueue_stub.GetTasks('output-compact'))
+    run_result = _quick_reap()
+    task_scheduler.bot_update_task(
+        run_result.key, 'localhost', 'hi', 0, None, None, False, False, 0.1)
+    self.assertEqual(1, count())
+    self.mock_now(self.now, 10)
+    task_scheduler.bot_update_task(
+        run_result.key, 'localhost', 'hey', 2, None, None, False, False, 0.1)
+    task_scheduler.bot_update_task(
+        run_result.key, 'localhost', 'yo', 5, None, None, False, False, 0.1)
+    self.assertEqual(1, count())
+    task_scheduler.bot_update_task(
+        run_result.key, 'localhost', None, None, 0, 0.1, False, False, 0.1)
+    self.assertEqual(2, count())
+    self.assertEqual(3, task_scheduler.cron_compact_output())
+    self.assertEqual(0, count())
+    self.assertEqual(['hiheyyo'], list(run_result.key.get().get_outputs()))
+
+  def test_bot_update_task_buffered(self):
+    run_result = _quick_reap()
+    # The first output grows stdout_chunks so it is saved synchronously.
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', 'hi', 0, None, None, False, False,
+            0.1))
+    self.assertEqual(0.1, run_result.key.get().cost_usd)
+    now = self.mock_now(self.now, 10)
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', 'hey', 2, None, None, False, False,
+            0.2))
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', None, None, None, None, False, False,
+            0.3))
+    # The output is visible right away, cost_usd once flushed.
+    run_result = run_result.key.get()
+    self.assertEqual(['hihey'], list(run_result.get_outputs()))
+    self.assertEqual(0.1, run_result.cost_usd)
+    self.assertEqual(self.now, run_result.modified_ts)
+
+    self.assertEqual(1, task_scheduler.cron_flush_bot_updates())
+    self.assertEqual(0, task_scheduler.cron_flush_bot_updates())
+    run_result = run_result.key.get()
+    self.assertEqual(0.3, run_result.cost_usd)
+    self.assertEqual(now, run_result.modified_ts)
+    result_summary = task_pack.run_result_key_to_result_summary_key(
+        run_result.key).get()
+    self.assertEqual([0.3], result_summary.costs_usd)
+    self.assertEqual(now, result_summary.modified_ts)
+
+  def test_bot_update_task_buffered_stale(self):
+    run_result = _quick_reap()
+    # TaskRunResult wasn't saved recently, the update is saved synchronously.
+    now = self.mock_now(self.now, 60)
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', None, None, None, None, False, False,
+            0.1))
+    run_result = run_result.key.get()
+    self.assertEqual(0.1, run_result.cost_usd)
+    self.assertEqual(now, run_result.modified_ts)
+    self.assertEqual(0, task_scheduler.cron_flush_bot_updates())
+
+  def test_bot_update_task_buffered_server_version(self):
+    run_result = _quick_reap()
+    # The new server version is saved synchronously.
+    self.mock(utils, 'get_app_version', lambda: 'new-version')
+    now = self.mock_now(self.now, 10)
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', None, None, None, None, False, False,
+            0.1))
+    run_result = run_result.key.get()
+    self.assertEqual('new-version', run_result.server_versions[-1])
+    self.assertEqual(now, run_result.modified_ts)
+    self.assertEqual(0, task_scheduler.cron_flush_bot_updates())
+
+  def test_bot_update_task_buffered_duration(self):
+    run_result = _quick_reap()
+    # A duration without exit_code is refused, not buffered.
+    self.mock(logging, 'error', lambda *_: None)
+    self.mock_now(self.now, 10)
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', None, None, None, 0.1, False, False,
+            0.1))
+    run_result = run_result.key.get()
+    self.assertEqual([], run_result.durations)
+    self.assertEqual(self.now, run_result.modified_ts)
+    self.assertEqual(0, task_scheduler.cron_flush_bot_updates())
+
+  def test_cron_flush_bot_updates(self):
+    self.assertEqual(0, task_scheduler.cron_flush_bot_updates())
+    run_result = _quick_reap()
+    now = self.mock_now(self.now, 10)
+    self.assertEqual(
+        (True, False),
+        task_scheduler.bot_update_task(
+            run_result.key, 'localhost', None, None, None, None, False, False,
+            0.1))
+    self.assertEqual(1, task_scheduler.cron_flush_bot_updates())
+    run_result = run_result.key.get()
+    self.assertEqual(0.1, run_result.cost_usd)
+    self.assertEqual(now, run_result.modified_ts)
+
+  def test_cron_flush_bot_updates_completed(self):
+    run_result = _quick_reap()
+    self.mock_now(self.now, 10)
+    task_scheduler.bot_update_task(
+        run_result.key, 'localhost', None, None, None, None, False, False, 0.1)
+    # The final update is saved synchronously, the buffered one is ignored.
+    task_scheduler.bot_update_task(
+        run_result.key, 'localhost', None, None, 0, 0.1, False, False, 0.2)
+    self.assertEqual(0, task_scheduler.cron_flush_bot_updates())
+    run_result = run_result.key.get()
+    self.assertEqual(State.COMPLETED, run_result.state)
+    self.assertEqual(0.2, run_result.cost_usd)
+
   def test_bot_update_exception(self):
     run_result = _quick_reap()
     def r(*_):
@@ -25,15 +25,21 @@ Graph of the schema:
     +-----------------------+
 """
 
+import collections
 import datetime
+import functools
 import hashlib
+import heapq
 import itertools
 import logging
 import struct
+import threading
+import time
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from components import datastore_utils
 from components import utils
 from server import task_request
 
@@ -42,6 +48,62 @@ from server import task_request
 MAX_DIMENSIONS = 16384
 
 
+# Number of TaskToRun keys fetched per page in
+# yield_next_available_task_to_dispatch().
+_PAGE_SIZE = 50
+
+
+# Maximum number of dimensions hashes a bot can accept for it to use one query
+# per dimensions hash instead of scanning the whole queue. Each query costs at
+# least one datastore operation even when empty, so scanning the global queue is
+# cheaper for bots accepting a very large number of dimensions hashes.
+_MAX_INDEXED_QUERIES = 64
+
+
+# Maximum total number of dimensions hashes kept in the process cache of
+# accepted dimensions hashes. Each hash costs roughly 60 bytes of memory, so the
+# cache is bounded at ~8mb.
+_ACCEPTED_HASHES_CACHE_SIZE = 131072
+
+
+# Minimum powerset size for the accepted dimensions hashes to be saved in
+# memcache. Smaller sets are faster to recompute than to fetch.
+_ACCEPTED_HASHES_MEMCACHE_MIN = 512
+
+
+# Memcache namespace of the number of pending TaskToRun per dimensions hash. See
+# get_pending_count() for details.
+_PENDING_MEMCACHE_NAMESPACE = 'task_to_run_pending'
+
+
+# Number of seconds the pending counts are trusted after set_pending_counts().
+# If the cron job stops refreshing them, the bots go back to query the DB.
+_PENDING_COUNTS_SECS = 5*60
+
+
+# Number of seconds a dimensions hash is flagged as having new pending tasks, so
+# they can't be hidden by a concurrent set_pending_counts() that missed them. It
+# must be larger than the period of the cron job calling set_pending_counts().
+_PENDING_NEW_SECS = 2*60
+
+
+# Memcache key in the namespace 'task_to_run' set by set_dimensions_hash() when
+# no pending TaskToRun lacks TaskToRun.dimensions_hash, i.e. when all of them
+# are in the (dimensions_hash, queue_number) index. Until then, the bots scan
+# the global queue. It must outlive the period of the cron job calling
+# set_dimensions_hash().
+_INDEXED_MEMCACHE_KEY = 'dimensions_hash_indexed'
+_INDEXED_MEMCACHE_SECS = 5*60
+
+
+# In-process LRU cache of canonical bot dimensions json to the frozenset of
+# accepted dimensions hashes, and the sum of the frozenset sizes. Protected by
+# _accepted_hashes_lock.
+_accepted_hashes_cache = collections.OrderedDict()
+_accepted_hashes_cache_size = 0
+_accepted_hashes_lock = threading.Lock()
+
+
 class TaskToRun(ndb.Model):
   """Defines a TaskRequest ready to be scheduled on a bot.
 
@@ -62,6 +124,12 @@ class TaskToRun(ndb.Model):
   # TaskRequest.expiration_ts to enable queries when cleaning up stale jobs.
   expiration_ts = ndb.DateTimeProperty(required=True)
 
+  # Copy of the key id, i.e. the hash of the TaskRequest dimensions, so it can
+  # be used in the composite index (dimensions_hash, queue_number). This permits
+  # a bot to only look at the tasks with dimensions it can match. See
+  # yield_next_available_task_to_dispatch() for details.
+  dimensions_hash = ndb.IntegerProperty()
+
   # Everything above is immutable, everything below is mutable.
 
   # priority and request creation timestamp are mixed together to allow queries
@@ -174,6 +242,60 @@ def _hash_dimensions(dimensions_json):
   return int(struct.unpack('<L', digest[:4])[0]) or 1
 
 
+def _canonical_dimensions_json(dimensions):
+  """Returns the bot dimensions as json, independent of the list values order.
+  """
+  return utils.encode_to_json({
+    k: sorted(v) if isinstance(v, (list, tuple)) else v
+    for k, v in dimensions.iteritems()
+  })
+
+
+def _get_accepted_dimensions_hash(bot_dimensions):
+  """Returns the frozenset of the dimensions hashes bot_dimensions can match.
+
+  Computing it is 2**N json encoding and md5, so it is cached in the process
+  with a LRU policy. Large sets are also saved in memcache so a cold instance
+  doesn't have to recompute it.
+  """
+  dimensions_json = _canonical_dimensions_json(bot_dimensions)
+  with _accepted_hashes_lock:
+    value = _accepted_hashes_cache.pop(dimensions_json, None)
+    if value is not None:
+      # Mark it as the most recently used.
+      _accepted_hashes_cache[dimensions_json] = value
+      return value
+
+  use_memcache = (
+      dimensions_powerset_count(bot_dimensions) >=
+      _ACCEPTED_HASHES_MEMCACHE_MIN)
+  memcache_key = hashlib.md5(dimensions_json).hexdigest()
+  packed = None
+  if use_memcache:
+    packed = memcache.get(memcache_key, namespace='task_to_run_hashes')
+  if packed:
+    value = frozenset(struct.unpack('<%dL' % (len(packed) / 4), packed))
+  else:
+    value = frozenset(
+        _hash_dimensions(utils.encode_to_json(i))
+        for i in _powerset(bot_dimensions))
+    if use_memcache:
+      packed = struct.pack('<%dL' % len(value), *sorted(value))
+      memcache.set(memcache_key, packed, namespace='task_to_run_hashes')
+
+  global _accepted_hashes_cache_size
+  with _accepted_hashes_lock:
+    if dimensions_json not in _accepted_hashes_cache:
+      _accepted_hashes_cache[dimensions_json] = value
+      _accepted_hashes_cache_size += len(value)
+      # Always keep the most recent one, even if it is larger than the limit.
+      while (_accepted_hashes_cache_size > _ACCEPTED_HASHES_CACHE_SIZE and
+          len(_accepted_hashes_cache) > 1):
+        _, evicted = _accepted_hashes_cache.popitem(last=False)
+        _accepted_hashes_cache_size -= len(evicted)
+  return value
+
+
 def _memcache_to_run_key(task_key):
   """Functional equivalent of task_result.pack_result_summary_key()."""
   request_key = task_to_run_key_to_request_key(task_key)
@@ -187,6 +309,114 @@ def _lookup_cache_is_taken(task_key):
   return bool(memcache.get(key, namespace='task_to_run'))
 
 
+@ndb.tasklet
+def _lookup_cache_is_taken_multi_async(task_keys):
+  """Queries the quick lookup cache for multiple keys at once.
+
+  The ndb context batches the memcache lookups into a single get_multi RPC.
+
+  Returns:
+    ndb.Future that returns a list of bool, one per task_keys item.
+  """
+  assert not ndb.in_transaction()
+  ctx = ndb.get_context()
+  values = yield [
+    ctx.memcache_get(_memcache_to_run_key(k), namespace='task_to_run')
+    for k in task_keys
+  ]
+  raise ndb.Return([bool(v) for v in values])
+
+
+def _yield_pages_async(q, size):
+  """Yields the results of the query q, page by page.
+
+  The fetch of the next page is started as soon as the current page is
+  retrieved, so it happens concurrently with the processing of the current page
+  by the caller.
+  """
+  future = q.fetch_page_async(size)
+  while future:
+    results, cursor, more = future.get_result()
+    future = None
+    if more and cursor:
+      future = q.fetch_page_async(size, start_cursor=cursor)
+    yield results
+
+
+def _yield_merged_pages(queries, size):
+  """Yields the keys returned by multiple queries, merged by queue_number.
+
+  Each query must be a projection query on TaskToRun.queue_number sorted by
+  TaskToRun.queue_number. The first page of every queries is fetched
+  concurrently, then each query is paged independently as the k-way merge
+  consumes its results.
+
+  Yields:
+    list of TaskToRun ndb.Key of at most size items.
+  """
+  counter = itertools.count()
+  def iter_query(q, future):
+    while future:
+      results, cursor, more = future.get_result()
+      future = None
+      if more and cursor:
+        future = q.fetch_page_async(size, start_cursor=cursor)
+      for i in results:
+        # The counter ensures ndb.Key are never compared.
+        yield i.queue_number, next(counter), i.key
+
+  iterators = [iter_query(q, q.fetch_page_async(size)) for q in queries]
+  page = []
+  for _, _, key in heapq.merge(*iterators):
+    page.append(key)
+    if len(page) == size:
+      yield page
+      page = []
+  if page:
+    yield page
+
+
+def _yield_candidate_pages(accepted_dimensions_hash):
+  """Yields pages of TaskToRun keys that are potentially reapable, in
+  queue_number order.
+
+  When the bot accepts few enough dimensions hashes, runs one query per
+  dimensions hash on the (dimensions_hash, queue_number) index so only the
+  matching tasks are looked at. Otherwise, or when some pending TaskToRun may
+  not be in this index yet, scans the global queue.
+  """
+  # Note that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
+  # returned. It's handled specifically by fetching the entities afterward.
+  if (len(accepted_dimensions_hash) <= _MAX_INDEXED_QUERIES and
+      memcache.get(_INDEXED_MEMCACHE_KEY, namespace='task_to_run')):
+    queries = [
+      TaskToRun.query(
+          TaskToRun.dimensions_hash == h, TaskToRun.queue_number > 0,
+          projection=[TaskToRun.queue_number]).order(TaskToRun.queue_number)
+      for h in sorted(accepted_dimensions_hash)
+    ]
+    return _yield_merged_pages(queries, _PAGE_SIZE)
+
+  # Interestingly, the filter on .queue_number>0 is required otherwise all the
+  # None items are returned first.
+  opts = ndb.QueryOptions(keys_only=True)
+  q = TaskToRun.query(default_options=opts).order(
+      TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
+  return _yield_pages_async(q, _PAGE_SIZE)
+
+
+def _is_too_late(start):
+  """Returns True if yield_next_available_task_to_dispatch() ran for too long.
+
+  Stop searching after too long, since the odds of the request blowing up right
+  after succeeding in reaping a task is not worth the dangling task request that
+  will stay in limbo until the cron job reaps it and retry it. The current
+  handlers are given 60s to complete. By using 40s, it gives 20s to complete the
+  reaping and complete the HTTP request.
+  """
+  return (utils.utcnow() - start).total_seconds() > 40.
+
+
 ### Public API.
 
 
@@ -216,8 +446,10 @@ def new_task_to_run(request):
   Returns:
     Unsaved TaskToRun entity.
   """
+  key = request_to_task_to_run_key(request)
   return TaskToRun(
-      key=request_to_task_to_run_key(request),
+      key=key,
+      dimensions_hash=key.integer_id(),
       queue_number=gen_queue_number(request),
       expiration_ts=request.expiration_ts)
 
@@ -289,6 +521,71 @@ def set_lookup_cache(task_key, is_available_to_schedule):
     memcache.set(key, True, time=cache_lifetime, namespace='task_to_run')
 
 
+def get_pending_count(bot_dimensions):
+  """Returns the number of pending tasks bot_dimensions can match.
+
+  The counts are kept in memcache per dimensions hash by update_pending_counts()
+  and periodically rebuilt from the DB by set_pending_counts(). When the bot
+  accepts too many dimensions hashes, the total number of pending tasks is
+  returned instead.
+
+  Returns:
+    int or None if it is unknown, in which case the DB must be queried.
+  """
+  accepted_dimensions_hash = _get_accepted_dimensions_hash(bot_dimensions)
+  if len(accepted_dimensions_hash) <= _MAX_INDEXED_QUERIES:
+    keys = [str(h) for h in accepted_dimensions_hash]
+    new_keys = ['new:%d' % h for h in accepted_dimensions_hash]
+  else:
+    keys = ['total']
+    new_keys = ['new']
+  values = memcache.get_multi(
+      ['epoch'] + keys + new_keys, namespace=_PENDING_MEMCACHE_NAMESPACE)
+  if not values.get('epoch') or any(k in values for k in new_keys):
+    return None
+  return sum(values.get(k, 0) for k in keys)
+
+
+def update_pending_counts(deltas):
+  """Updates the number of pending tasks per dimensions hash.
+
+  Arguments:
+  - deltas: dict of dimensions hash to the change in the number of pending
+      TaskToRun, e.g. -1 when a task is reaped.
+  """
+  deltas = {h: d for h, d in deltas.iteritems() if d}
+  if not deltas:
+    return
+  offsets = {str(h): d for h, d in deltas.iteritems()}
+  offsets['total'] = sum(deltas.itervalues())
+  memcache.offset_multi(
+      offsets, namespace=_PENDING_MEMCACHE_NAMESPACE, initial_value=0)
+  new = ['new:%d' % h for h, d in deltas.iteritems() if d > 0]
+  if new:
+    new.append('new')
+    memcache.set_multi(
+        dict.fromkeys(new, True), time=_PENDING_NEW_SECS,
+        namespace=_PENDING_MEMCACHE_NAMESPACE)
+
+
+def set_pending_counts(counts):
+  """Overwrites the number of pending tasks per dimensions hash.
+
+  Arguments:
+  - counts: dict of dimensions hash to the number of pending TaskToRun, as
+      counted in the DB.
+  """
+  previous = memcache.get('hashes', namespace=_PENDING_MEMCACHE_NAMESPACE)
+  mapping = {str(h): 0 for h in previous or []}
+  mapping.update((str(h), c) for h, c in counts.iteritems())
+  mapping['total'] = sum(counts.itervalues())
+  mapping['hashes'] = sorted(counts)
+  memcache.set_multi(mapping, namespace=_PENDING_MEMCACHE_NAMESPACE)
+  memcache.set(
+      'epoch', True, time=_PENDING_COUNTS_SECS,
+      namespace=_PENDING_MEMCACHE_NAMESPACE)
+
+
 def yield_next_available_task_to_dispatch(bot_dimensions):
   """Yields next available (TaskRequest, TaskToRun) in decreasing order of
   priority.
@@ -296,16 +593,24 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
   Once the caller determines the task is suitable to execute, it must use
   reap_task_to_run(task.key) to mark that it is not to be scheduled anymore.
 
-  Performance is the top most priority here.
+  Performance is the top most priority here. When the bot accepts a small number
+  of dimensions hashes, one query per dimensions hash is run and the results are
+  merged by queue_number, so the work done scales with the number of matching
+  tasks instead of the total number of pending tasks. Otherwise the whole queue
+  is scanned.
+
+  The processing is pipelined: the queries are fetched page by page with
+  fetch_page_async(), the next page being fetched while the current one is
+  being processed. For each page, the negative lookup cache is queried for all
+  the keys at once, then the surviving TaskToRun and their parent TaskRequest
+  are fetched together with ndb.get_multi_async().
 
   Arguments:
   - bot_dimensions: dimensions (as a dict) defined by the bot that can be
       matched.
   """
   # List of all the valid dimensions hashed.
-  accepted_dimensions_hash = frozenset(
-      _hash_dimensions(utils.encode_to_json(i))
-      for i in _powerset(bot_dimensions))
+  accepted_dimensions_hash = _get_accepted_dimensions_hash(bot_dimensions)
   now = utils.utcnow()
   broken = 0
   cache_lookup = 0
@@ -315,102 +620,124 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
   no_queue = 0
   real_mismatch = 0
   total = 0
-  # Be very aggressive in fetching the largest amount of items as possible. Note
-  # that we use the default ndb.EVENTUAL_CONSISTENCY so stale items may be
-  # returned. It's handled specifically.
-  # - 100/200 gives 2s~40s of query time for 1275 items.
-  # - 250/500 gives 2s~50s of query time for 1275 items.
-  # - 50/500 gives 3s~20s of query time for 1275 items. (Slower but less
-  #   variance). Spikes in 20s~40s are rarer.
-  # The problem here are:
-  # - Outliers, some shards are simply slower at executing the query.
-  # - Median time, which we should optimize.
-  # - Abusing batching will slow down this query.
+  # Time spent waiting on each stage of the pipeline, in seconds.
+  timings = {
+    'query': 0.,
+    'memcache': 0.,
+    'task_to_run': 0.,
+    'request': 0.,
+  }
+  # The pages are kept relatively small so the first candidates are yielded
+  # quickly; the latency of the following pages is hidden behind the
+  # processing of the current one.
   #
   # TODO(maruel): Measure query performance with stats_framework!!
-  # TODO(maruel): Use fetch_page_async() + ndb.get_multi_async() +
-  # memcache.get_multi_async() to do pipelined processing. Should greatly reduce
-  # the effect of latency on the total duration of this function. I also suspect
-  # using ndb.get_multi() will return fresher objects than what is returned by
-  # the query.
-  opts = ndb.QueryOptions(batch_size=50, prefetch_size=500, keys_only=True)
+  indexed = len(accepted_dimensions_hash) <= _MAX_INDEXED_QUERIES
   try:
-    # Interestingly, the filter on .queue_number>0 is required otherwise all the
-    # None items are returned first.
-    q = TaskToRun.query(default_options=opts).order(
-        TaskToRun.queue_number).filter(TaskToRun.queue_number > 0)
-    for task_key in q:
-      duration = (utils.utcnow() - now).total_seconds()
-      if duration > 40.:
-        # Stop searching after too long, since the odds of the request blowing
-        # up right after succeeding in reaping a task is not worth the dangling
-        # task request that will stay in limbo until the cron job reaps it and
-        # retry it. The current handlers are given 60s to complete. By using
-        # 40s, it gives 20s to complete the reaping and complete the HTTP
-        # request.
+    pages = _yield_candidate_pages(accepted_dimensions_hash)
+    while True:
+      start = time.time()
+      task_keys = next(pages, None)
+      timings['query'] += time.time() - start
+      if task_keys is None:
+        return
+      if _is_too_late(now):
         return
 
-      total += 1
-      # Verify TaskToRun is what is expected. Play defensive here.
-      try:
-        validate_to_run_key(task_key)
-      except ValueError as e:
-        logging.error(str(e))
-        broken += 1
-        continue
-
-      # integer_id() == dimensions_hash.
-      if task_key.integer_id() not in accepted_dimensions_hash:
-        hash_mismatch += 1
-        continue
-
-      # Do this after the basic weeding out but before fetching TaskRequest.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
-        continue
-
-      # Ok, it's now worth taking a real look at the entity.
-      task = task_key.get(use_cache=False)
-
-      # DB operations are slow, double check memcache again.
-      if _lookup_cache_is_taken(task_key):
-        cache_lookup += 1
+      total += len(task_keys)
+      # Weed out the keys that can be rejected without any RPC.
+      candidates = []
+      for task_key in task_keys:
+        # Verify TaskToRun is what is expected. Play defensive here.
+        try:
+          validate_to_run_key(task_key)
+        except ValueError as e:
+          logging.error(str(e))
+          broken += 1
+          continue
+
+        # integer_id() == dimensions_hash.
+        if task_key.integer_id() not in accepted_dimensions_hash:
+          hash_mismatch += 1
+          continue
+        candidates.append(task_key)
+      if not candidates:
         continue
 
-      # It is possible for the index to be inconsistent since it is not executed
-      # in a transaction, no problem.
-      if not task.queue_number:
-        no_queue += 1
+      # Do this after the basic weeding out but before fetching TaskToRun.
+      start = time.time()
+      taken = _lookup_cache_is_taken_multi_async(candidates).get_result()
+      timings['memcache'] += time.time() - start
+      cache_lookup += sum(taken)
+      candidates = [k for k, t in zip(candidates, taken) if not t]
+      if not candidates:
         continue
 
-      # It expired. A cron job will cancel it eventually. Since 'now' is saved
-      # before the query, an expired task may still be reaped even if
-      # technically expired if the query is very slow. This is on purpose so
-      # slow queries do not cause exagerate expirations.
-      if task.expiration_ts < now:
-        expired += 1
+      # Ok, it's now worth taking a real look at the entities. The TaskRequest
+      # key is the parent of the TaskToRun key so both can be fetched in the
+      # same batch. The reason use_cache=False is otherwise it'll create a
+      # buffer bloat.
+      start = time.time()
+      task_futures = ndb.get_multi_async(candidates, use_cache=False)
+      request_futures = ndb.get_multi_async(
+          [task_to_run_key_to_request_key(k) for k in candidates],
+          use_cache=False)
+      tasks = [f.get_result() for f in task_futures]
+      timings['task_to_run'] += time.time() - start
+      valid = []
+      for task, request_future in zip(tasks, request_futures):
+        # It is possible for the index to be inconsistent since it is not
+        # executed in a transaction, no problem.
+        if not task or not task.queue_number:
+          no_queue += 1
+          continue
+
+        # It expired. A cron job will cancel it eventually. Since 'now' is
+        # saved before the query, an expired task may still be reaped even if
+        # technically expired if the query is very slow. This is on purpose so
+        # slow queries do not cause exagerate expirations.
+        if task.expiration_ts < now:
+          expired += 1
+          continue
+        valid.append((task, request_future))
+      if not valid:
         continue
 
       # The hash may have conflicts. Ensure the dimensions actually match by
-      # verifying the TaskRequest. There's a probability of 2**-31 of conflicts,
-      # which is low enough for our purpose. The reason use_cache=False is
-      # otherwise it'll create a buffer bloat.
-      request = task.request_key.get(use_cache=False)
-      if not match_dimensions(request.properties.dimensions, bot_dimensions):
-        real_mismatch += 1
-        continue
-
-      # It's a valid task! Note that in the meantime, another bot may have
-      # reaped it.
-      yield request, task
-      ignored += 1
+      # verifying the TaskRequest. There's a probability of 2**-31 of
+      # conflicts, which is low enough for our purpose.
+      start = time.time()
+      requests = [f.get_result() for _, f in valid]
+      timings['request'] += time.time() - start
+      for request, (task, _) in zip(requests, valid):
+        if not match_dimensions(request.properties.dimensions, bot_dimensions):
+          real_mismatch += 1
+          continue
+
+        if _is_too_late(now):
+          return
+
+        # DB operations are slow and the caller likely tried to reap the
+        # previous candidates in the meantime, double check memcache again.
+        start = time.time()
+        is_taken = _lookup_cache_is_taken(task.key)
+        timings['memcache'] += time.time() - start
+        if is_taken:
+          cache_lookup += 1
+          continue
+
+        # It's a valid task! Note that in the meantime, another bot may have
+        # reaped it.
+        yield request, task
+        ignored += 1
   finally:
     duration = (utils.utcnow() - now).total_seconds()
     logging.info(
-        '%d/%s in %5.2fs: %d total, %d exp %d no_queue, %d hash mismatch, '
-        '%d cache negative, %d dimensions mismatch, %d ignored, %d broken',
-        opts.batch_size,
-        opts.prefetch_size,
+        '%d%s in %5.2fs: %d total, %d exp %d no_queue, %d hash mismatch, '
+        '%d cache negative, %d dimensions mismatch, %d ignored, %d broken; '
+        'query %.2fs, memcache %.2fs, task_to_run %.2fs, request %.2fs',
+        _PAGE_SIZE,
+        (' x%d indexed' % len(accepted_dimensions_hash)) if indexed else '',
         duration,
         total,
         expired,
@@ -419,12 +746,67 @@ def yield_next_available_task_to_dispatch(bot_dimensions):
         cache_lookup,
         real_mismatch,
         ignored,
-        broken)
+        broken,
+        timings['query'],
+        timings['memcache'],
+        timings['task_to_run'],
+        timings['request'])
 
 
-def yield_expired_task_to_run():
-  """Yields all the expired TaskToRun still marked as available."""
+def yield_expired_task_to_run(pending_counts=None, unindexed=None):
+  """Yields all the expired TaskToRun still marked as available.
+
+  Arguments:
+  - pending_counts: optional dict filled with the number of TaskToRun not
+      expired per dimensions hash, as a side effect of scanning the queue.
+  - unindexed: optional list filled with the keys of the TaskToRun not expired
+      that lack TaskToRun.dimensions_hash, to be passed to
+      set_dimensions_hash().
+  """
   now = utils.utcnow()
   for task in TaskToRun.query().filter(TaskToRun.queue_number > 0):
     if task.expiration_ts < now:
       yield task
+      continue
+    if pending_counts is not None:
+      h = task.key.integer_id()
+      pending_counts[h] = pending_counts.get(h, 0) + 1
+    if unindexed is not None and task.dimensions_hash is None:
+      unindexed.append(task.key)
+
+
+def set_dimensions_hash(task_keys):
+  """Backfills TaskToRun.dimensions_hash on TaskToRun created before it existed.
+
+  Each TaskToRun is updated in its own transaction, all run in parallel, so a
+  concurrent reap is not reverted. Once all of them succeeded, the bots are
+  allowed to only query the (dimensions_hash, queue_number) index.
+
+  Arguments:
+  - task_keys: all the pending TaskToRun keys lacking dimensions_hash, as
+      returned by yield_expired_task_to_run().
+  """
+  def run(task_key):
+    task = task_key.get()
+    if task and task.dimensions_hash is None:
+      task.dimensions_hash = task_key.integer_id()
+      task.put()
+
+  futures = [
+    datastore_utils.transaction_async(functools.partial(run, k))
+    for k in task_keys
+  ]
+  failed = 0
+  for future in futures:
+    try:
+      future.get_result()
+    except datastore_utils.CommitError as e:
+      logging.warning('Failed to set dimensions_hash: %s', e)
+      failed += 1
+  if task_keys:
+    logging.info(
+        'Set dimensions_hash on %d TaskToRun', len(task_keys) - failed)
+  if not failed:
+    memcache.set(
+        _INDEXED_MEMCACHE_KEY, True, time=_INDEXED_MEMCACHE_SECS,
+        namespace='task_to_run')
@@ -3,6 +3,7 @@
 # Use of this source code is governed by the Apache v2.0 license that can be
 # found in the LICENSE file.
 
+import collections
 import datetime
 import hashlib
 import os
@@ -14,6 +15,7 @@ import unittest
 import test_env
 test_env.setup_test_env()
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from components import auth_testing
@@ -81,6 +83,10 @@ class TestCase(test_case.TestCase):
   def setUp(self):
     super(TestCase, self).setUp()
     auth_testing.mock_get_current_identity(self)
+    self.mock(task_to_run, '_accepted_hashes_cache', collections.OrderedDict())
+    self.mock(task_to_run, '_accepted_hashes_cache_size', 0)
+    # No TaskToRun lacks dimensions_hash, so the index can be used.
+    task_to_run.set_dimensions_hash([])
 
 
 class TaskToRunPrivateTest(TestCase):
@@ -201,6 +207,94 @@ class TaskToRunPrivateTest(TestCase):
     # Enable to get actual numbers on your workstation:
     #print('\ntuple: %.4fs  frozenset: %.4fs' % (perf_tuple, perf_frozenset))
 
+  def test_yield_pages_async(self):
+    for i in xrange(5):
+      task_to_run.TaskToRun(
+          id=i+1, expiration_ts=utils.utcnow(), queue_number=i+1).put()
+    q = task_to_run.TaskToRun.query().order(task_to_run.TaskToRun.queue_number)
+    actual = [
+      [t.queue_number for t in page]
+      for page in task_to_run._yield_pages_async(q, 2)
+    ]
+    self.assertEqual([[1, 2], [3, 4], [5]], actual)
+
+  def test_lookup_cache_is_taken_multi_async(self):
+    keys = [
+      ndb.Key('TaskRequest', 0x7e296460f77ff77e - i, 'TaskToRun', 1)
+      for i in xrange(3)
+    ]
+    task_to_run.set_lookup_cache(keys[1], False)
+    actual = task_to_run._lookup_cache_is_taken_multi_async(keys).get_result()
+    self.assertEqual([False, True, False], actual)
+
+  def test_timeit_accepted_dimensions_hash(self):
+    # Compares the per poll CPU cost of generating the accepted dimensions
+    # hashes versus using the process cache, for 5, 10 and 15 dimensions.
+    results = []
+    for count in (5, 10, 15):
+      setup = (
+        "import task_to_run\n"
+        "from components import utils\n"
+        "dimensions = {str(k): '01234567890123456789' for k in xrange(%d)}\n"
+        "task_to_run._get_accepted_dimensions_hash(dimensions)\n" % count)
+      statement = (
+        "items = frozenset("
+        "  task_to_run._hash_dimensions(utils.encode_to_json(i))"
+        "  for i in task_to_run._powerset(dimensions))\n"
+        "del items")
+      perf_uncached = timeit.timeit(statement, setup, number=1)
+      statement = (
+        "items = task_to_run._get_accepted_dimensions_hash(dimensions)\n"
+        "del items")
+      perf_cached = timeit.timeit(statement, setup, number=1)
+      results.append((count, perf_uncached, perf_cached))
+      self.assertGreater(perf_uncached, perf_cached)
+    # For reference, numbers locally were:
+    #   5: uncached 0.0006s  cached: 0.00002s
+    #  10: uncached 0.0208s  cached: 0.00002s
+    #  15: uncached 0.9473s  cached: 0.00003s
+    # Enable to get actual numbers on your workstation:
+    #for count, uncached, cached in results:
+    #  print('\n%2d: uncached %.4fs  cached: %.5fs' % (count, uncached, cached))
+
+  def test_get_accepted_dimensions_hash(self):
+    dimensions = {u'OS': [u'Windows', u'Windows-6.1'], u'hostname': u'foo'}
+    expected = frozenset(
+        _hash_dimensions(i) for i in task_to_run._powerset(dimensions))
+    self.assertEqual(6, len(expected))
+    self.assertEqual(
+        expected, task_to_run._get_accepted_dimensions_hash(dimensions))
+    # The order of the values in lists is irrelevant.
+    dimensions_reversed = {
+      u'OS': [u'Windows-6.1', u'Windows'], u'hostname': u'foo',
+    }
+    self.assertEqual(
+        expected,
+        task_to_run._get_accepted_dimensions_hash(dimensions_reversed))
+    self.assertEqual(1, len(task_to_run._accepted_hashes_cache))
+    self.assertEqual(6, task_to_run._accepted_hashes_cache_size)
+
+  def test_get_accepted_dimensions_hash_lru(self):
+    self.mock(task_to_run, '_ACCEPTED_HASHES_CACHE_SIZE', 4)
+    task_to_run._get_accepted_dimensions_hash({u'a': u'1'})
+    task_to_run._get_accepted_dimensions_hash({u'b': u'1'})
+    # Touch 'a' so 'b' is the least recently used.
+    task_to_run._get_accepted_dimensions_hash({u'a': u'1'})
+    task_to_run._get_accepted_dimensions_hash({u'c': u'1'})
+    self.assertEqual(
+        ['{"a":"1"}', '{"c":"1"}'], task_to_run._accepted_hashes_cache.keys())
+    self.assertEqual(4, task_to_run._accepted_hashes_cache_size)
+
+  def test_get_accepted_dimensions_hash_memcache(self):
+    self.mock(task_to_run, '_ACCEPTED_HASHES_MEMCACHE_MIN', 1)
+    dimensions = {u'OS': u'Windows', u'hostname': u'foo'}
+    expected = task_to_run._get_accepted_dimensions_hash(dimensions)
+    # Simulates a cold instance; the value comes from memcache.
+    task_to_run._accepted_hashes_cache.clear()
+    self.mock(task_to_run, '_powerset', lambda _: self.fail())
+    self.assertEqual(
+        expected, task_to_run._get_accepted_dimensions_hash(dimensions))
+
   def test_hash_dimensions(self):
     dimensions = 'this is not json'
     as_hex = hashlib.md5(dimensions).digest()[:4].encode('hex')
@@ -510,6 +604,63 @@ class TaskToRunApiTest(TestCase):
     ]
     self.assertEqual(expected, actual)
 
+  def test_yield_next_available_task_to_dispatch_multi_page(self):
+    # Forces one TaskToRun per page to exercise the pipelined page fetching.
+    self.mock(task_to_run, '_PAGE_SIZE', 1)
+    request_dimensions_1 = {u'OS': u'Windows-3.1.1', u'foo': u'bar'}
+    _gen_new_task_to_run(properties=dict(dimensions=request_dimensions_1))
+    self.mock_now(self.now, 1)
+    request_dimensions_2 = {u'OS': u'Windows-3.0'}
+    _gen_new_task_to_run(properties=dict(dimensions=request_dimensions_2))
+    self.mock_now(self.now, 2)
+    request_dimensions_3 = {u'hostname': u'localhost'}
+    to_run_3 = _gen_new_task_to_run(
+        properties=dict(dimensions=request_dimensions_3))
+    self.mock_now(self.now, 3)
+    _gen_new_task_to_run(properties=dict(dimensions=request_dimensions_1))
+    # The third one is already reaped according to the negative cache.
+    task_to_run.set_lookup_cache(to_run_3.key, False)
+
+    bot_dimensions = {
+      u'OS': u'Windows-3.1.1', u'hostname': u'localhost', u'foo': u'bar',
+    }
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    expected = [
+      {
+        'dimensions_hash': _hash_dimensions(request_dimensions_1),
+        'expiration_ts': self.expiration_ts,
+        'queue_number': '0x000a890b67ba1346',
+      },
+      {
+        'dimensions_hash': _hash_dimensions(request_dimensions_1),
+        'expiration_ts': self.expiration_ts + datetime.timedelta(seconds=3),
+        'queue_number': '0x000a890b67e7da06',
+      },
+    ]
+    self.assertEqual(expected, actual)
+
+  def test_yield_next_available_task_to_dispatch_scan(self):
+    # Forces the scan of the whole queue instead of one query per dimensions
+    # hash.
+    self.mock(task_to_run, '_MAX_INDEXED_QUERIES', 0)
+    request_dimensions_1 = {u'OS': u'Windows-3.1.1', u'foo': u'bar'}
+    _gen_new_task_to_run(properties=dict(dimensions=request_dimensions_1))
+    self.mock_now(self.now, 1)
+    _gen_new_task_to_run(properties=dict(dimensions={u'OS': u'Windows-3.0'}))
+
+    bot_dimensions = {
+      u'OS': u'Windows-3.1.1', u'hostname': u'localhost', u'foo': u'bar',
+    }
+    actual = _yield_next_available_task_to_dispatch(bot_dimensions)
+    expected = [
+      {
+        'dimensions_hash': _hash_dimensions(request_dimensions_1),
+        'expiration_ts': self.expiration_ts,
+        'queue_number': '0x000a890b67ba1346',
+      },
+    ]
+    self.assertEqual(expected, actual)
+
   def test_yield_next_available_task_to_dispatch_clock_skew(self):
     # Asserts that a TaskToRun added later in the DB (with a Key with an higher
     # value) but with a timestamp sooner (for example, time desynchronization
@@ -585,6 +736,86 @@ class TaskToRunApiTest(TestCase):
     self.assertEqual(
         1, len(list(task_to_run.yield_expired_task_to_run())))
 
+  def test_yield_expired_task_to_run_pending_counts(self):
+    to_run = _gen_new_task_to_run(scheduling_expiration_secs=60)
+    _gen_new_task_to_run(scheduling_expiration_secs=120)
+    self.mock_now(self.now, 61)
+    pending_counts = {}
+    self.assertEqual(
+        1, len(list(task_to_run.yield_expired_task_to_run(pending_counts))))
+    # Only the task not expired is counted.
+    self.assertEqual({to_run.key.integer_id(): 1}, pending_counts)
+
+  def test_set_dimensions_hash(self):
+    # A TaskToRun saved before dimensions_hash existed.
+    to_run = _gen_new_task_to_run()
+    to_run.dimensions_hash = None
+    to_run.put()
+    memcache.flush_all()
+
+    # Until it is backfilled, the bots scan the global queue.
+    self.assertEqual(1, len(_yield_next_available_task_to_dispatch({})))
+    unindexed = []
+    self.assertEqual(
+        [], list(task_to_run.yield_expired_task_to_run(None, unindexed)))
+    self.assertEqual([to_run.key], unindexed)
+
+    task_to_run.set_dimensions_hash(unindexed)
+    self.assertEqual(to_run.key.integer_id(), to_run.key.get().dimensions_hash)
+    self.assertEqual(
+        True,
+        memcache.get(
+            task_to_run._INDEXED_MEMCACHE_KEY, namespace='task_to_run'))
+    self.assertEqual(1, len(_yield_next_available_task_to_dispatch({})))
+    unindexed = []
+    list(task_to_run.yield_expired_task_to_run(None, unindexed))
+    self.assertEqual([], unindexed)
+
+  def test_get_pending_count(self):
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    h = _hash_dimensions({u'OS': u'Windows-3.1.1'})
+    other = _hash_dimensions({u'OS': u'Amiga'})
+    # Unknown until the counts are rebuilt.
+    self.assertEqual(None, task_to_run.get_pending_count(bot_dimensions))
+    task_to_run.set_pending_counts({other: 2})
+    self.assertEqual(0, task_to_run.get_pending_count(bot_dimensions))
+    task_to_run.set_pending_counts({h: 3, other: 2})
+    self.assertEqual(3, task_to_run.get_pending_count(bot_dimensions))
+
+  def test_get_pending_count_large(self):
+    self.mock(task_to_run, '_MAX_INDEXED_QUERIES', 1)
+    bot_dimensions = {u'OS': u'Windows-3.1.1', u'hostname': u'localhost'}
+    # The bot accepts too many dimensions hashes, the total is used.
+    task_to_run.set_pending_counts({_hash_dimensions({u'OS': u'Amiga'}): 2})
+    self.assertEqual(2, task_to_run.get_pending_count(bot_dimensions))
+
+  def test_update_pending_counts(self):
+    bot_dimensions = {u'OS': u'Windows-3.1.1'}
+    h = _hash_dimensions(bot_dimensions)
+    task_to_run.set_pending_counts({})
+    task_to_run.update_pending_counts({h: 2})
+    # A new task makes the count unknown for a while, so it can't be hidden by
+    # a concurrent set_pending_counts().
+    self.assertEqual(None, task_to_run.get_pending_count(bot_dimensions))
+    memcache.flush_all()
+    task_to_run.set_pending_counts({h: 2})
+    task_to_run.update_pending_counts({h: -1})
+    self.assertEqual(1, task_to_run.get_pending_count(bot_dimensions))
+    task_to_run.update_pending_counts({h: -2})
+    self.assertEqual(0, task_to_run.get_pending_count(bot_dimensions))
+
+  def test_set_pending_counts(self):
+    bot_dimensions = {u'OS': u'Windows-3.1.1'}
+    h = _hash_dimensions(bot_dimensions)
+    task_to_run.set_pending_counts({h: 2})
+    self.assertEqual(2, task_to_run.get_pending_count(bot_dimensions))
+    # Hashes not pending anymore are reset.
+    task_to_run.set_pending_counts({})
+    self.assertEqual(0, task_to_run.get_pending_count(bot_dimensions))
+    # The counts are not trusted anymore if they are not refreshed.
+    memcache.delete('epoch', namespace='task_to_run_pending')
+    self.assertEqual(None, task_to_run.get_pending_count(bot_dimensions))
+
   def test_is_reapable(self):
     req_dimensions = {u'OS': u'Windows-3.1.1'}
     to_run = _gen_new_task_to_run(properties=dict(dimensions=req_dimensions))
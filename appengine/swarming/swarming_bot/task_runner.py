@@ -24,8 +24,10 @@ import optparse
 import os
 import subprocess
 import sys
+import threading
 import time
 import zipfile
+import zlib
 
 import xsrf_client
 from utils import net
@@ -33,10 +35,20 @@ from utils import on_error
 from utils import subprocess42
 
 
-# Sends a maximum of 100kb of stdout per task_update packet.
+# Sends a task_update packet once 100kb of stdout is buffered. When the task
+# outputs faster than that, the packet size grows with the output rate up to
+# MAX_ADAPTIVE_CHUNK_SIZE so the number of packets stays low.
 MAX_CHUNK_SIZE = 102400
 
 
+# Maximum size of stdout per task_update packet.
+MAX_ADAPTIVE_CHUNK_SIZE = 10*MAX_CHUNK_SIZE
+
+
+# Output smaller than this is sent uncompressed.
+MIN_COMPRESS_SIZE = 1024
+
+
 # Maximum wait between task_update packet when there's no output.
 MAX_PACKET_INTERVAL = 30
 
@@ -152,6 +164,11 @@ def post_update(swarming_server, params, exit_code, stdout, output_chunk_start):
   if stdout:
     # The output_chunk_start is used by the server to make sure that the stdout
     # chunks are processed and saved in the DB in order.
+    if len(stdout) >= MIN_COMPRESS_SIZE:
+      compressed = zlib.compress(stdout)
+      if len(compressed) < len(stdout):
+        stdout = compressed
+        params['output_compression'] = 'zlib'
     params['output'] = base64.b64encode(stdout)
     params['output_chunk_start'] = output_chunk_start
   # TODO(maruel): Support early cancellation.
@@ -164,30 +181,125 @@ def post_update(swarming_server, params, exit_code, stdout, output_chunk_start):
     raise ValueError(resp.get('error'))
 
 
-def should_post_update(stdout, now, last_packet):
+def should_post_update(size, now, last_packet):
   """Returns True if it's time to send a task_update packet via post_update().
 
   Sends a packet when one of this condition is met:
-  - more than MAX_CHUNK_SIZE of stdout is buffered.
+  - more than the packet size of stdout is buffered. The packet size is
+    MAX_CHUNK_SIZE, or larger when the output rate is high.
   - last packet was sent more than MIN_PACKET_INTERNAL seconds ago and there was
     stdout.
   - last packet was sent more than MAX_PACKET_INTERVAL seconds ago.
   """
-  packet_interval = MIN_PACKET_INTERNAL if stdout else MAX_PACKET_INTERVAL
-  return len(stdout) >= MAX_CHUNK_SIZE or (now - last_packet) > packet_interval
+  packet_interval = MIN_PACKET_INTERNAL if size else MAX_PACKET_INTERVAL
+  elapsed = now - last_packet
+  rate = size / max(elapsed, 1.)
+  packet_size = min(
+      max(rate * MIN_PACKET_INTERNAL, MAX_CHUNK_SIZE), MAX_ADAPTIVE_CHUNK_SIZE)
+  return size >= packet_size or elapsed > packet_interval
+
 
+class OutputSender(object):
+  """Sends the stdout of the task in task_update packets from a thread.
 
-def calc_yield_wait(task_details, start, last_io, timed_out, stdout):
+  The child process output is buffered with add(), which never blocks on the
+  network, so the child process's pipe is drained while a HTTP request is in
+  flight.
+  """
+
+  def __init__(self, swarming_server, params, cost_usd_hour, task_start):
+    self._swarming_server = swarming_server
+    self._params = params.copy()
+    self._cost_usd_hour = cost_usd_hour
+    self._task_start = task_start
+    self._lock = threading.Condition()
+    # Output not sent yet, as a list of str, and its size.
+    self._buffer = []
+    self._size = 0
+    # Total number of stdout sent.
+    self._output_chunk_start = 0
+    self._last_packet = monotonic_time()
+    self._stopped = False
+    # Exception info raised in the thread, if any.
+    self._error = None
+    self._thread = threading.Thread(target=self._run, name='OutputSender')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def add(self, data):
+    """Buffers stdout to be sent."""
+    with self._lock:
+      self._buffer.append(data)
+      self._size += len(data)
+      self._lock.notify()
+
+  def check(self):
+    """Raises the exception that happened while sending a packet, if any."""
+    with self._lock:
+      error = self._error
+    if error:
+      raise error[0], error[1], error[2]
+
+  def stop(self):
+    """Stops the thread and returns the output not sent yet.
+
+    Returns:
+      tuple(output not sent, output_chunk_start for it).
+    """
+    with self._lock:
+      self._stopped = True
+      self._lock.notify()
+    self._thread.join()
+    return ''.join(self._buffer), self._output_chunk_start
+
+  def _run(self):
+    while True:
+      with self._lock:
+        while True:
+          if self._stopped:
+            return
+          now = monotonic_time()
+          if should_post_update(self._size, now, self._last_packet):
+            break
+          packet_interval = (
+              MIN_PACKET_INTERNAL if self._size else MAX_PACKET_INTERVAL)
+          self._lock.wait(max(self._last_packet + packet_interval - now, 0.01))
+        # Send at most MAX_ADAPTIVE_CHUNK_SIZE, the rest is kept for the next
+        # packet.
+        buf = ''.join(self._buffer)
+        stdout = buf[:MAX_ADAPTIVE_CHUNK_SIZE]
+        rest = buf[MAX_ADAPTIVE_CHUNK_SIZE:]
+        self._buffer = [rest] if rest else []
+        self._size = len(rest)
+        output_chunk_start = self._output_chunk_start
+        self._output_chunk_start += len(stdout)
+        self._last_packet = now
+      params = self._params.copy()
+      params['cost_usd'] = (
+          self._cost_usd_hour * (now - self._task_start) / 60. / 60.)
+      try:
+        post_update(
+            self._swarming_server, params, None, stdout, output_chunk_start)
+      except Exception:
+        # Keep the output so it is sent with the last packet.
+        with self._lock:
+          self._buffer.insert(0, stdout)
+          self._size += len(stdout)
+          self._output_chunk_start = output_chunk_start
+          self._error = sys.exc_info()
+        return
+
+
+def calc_yield_wait(task_details, start, last_io, timed_out):
   """Calculates the maximum number of seconds to wait in yield_any()."""
   now = monotonic_time()
   if timed_out:
     # Give a |grace_period| seconds delay.
     return max(now - timed_out - task_details.grace_period, 0.)
 
-  packet_interval = MIN_PACKET_INTERNAL if stdout else MAX_PACKET_INTERVAL
   hard_timeout = start + task_details.hard_timeout - now
   io_timeout = last_io + task_details.io_timeout - now
-  out = max(min(min(packet_interval, hard_timeout), io_timeout), 0)
+  out = max(min(hard_timeout, io_timeout), 0)
   logging.debug('calc_yield_wait() = %d', out)
   return out
 
@@ -204,7 +316,7 @@ def run_command(
     Child process exit code.
   """
   # Signal the command is about to be started.
-  last_packet = start = now = monotonic_time()
+  start = now = monotonic_time()
   params = {
     'cost_usd': cost_usd_hour * (now - task_start) / 60. / 60.,
     'id': task_details.bot_id,
@@ -238,31 +350,22 @@ def run_command(
     post_update(swarming_server, params, 1, stdout, 0)
     return 1
 
-  output_chunk_start = 0
-  stdout = ''
+  sender = OutputSender(swarming_server, params, cost_usd_hour, task_start)
   exit_code = None
   had_hard_timeout = False
   had_io_timeout = False
   timed_out = None
   try:
-    calc = lambda: calc_yield_wait(
-        task_details, start, last_io, timed_out, stdout)
-    maxsize = lambda: MAX_CHUNK_SIZE - len(stdout)
+    calc = lambda: calc_yield_wait(task_details, start, last_io, timed_out)
     last_io = monotonic_time()
-    for _, new_data in proc.yield_any(maxsize=maxsize, soft_timeout=calc):
+    for _, new_data in proc.yield_any(
+        maxsize=MAX_CHUNK_SIZE, soft_timeout=calc):
       now = monotonic_time()
       if new_data:
-        stdout += new_data
+        sender.add(new_data)
         last_io = now
-
-      # Post update if necessary.
-      if should_post_update(stdout, now, last_packet):
-        last_packet = monotonic_time()
-        params['cost_usd'] = (
-            cost_usd_hour * (last_packet - task_start) / 60. / 60.)
-        post_update(swarming_server, params, None, stdout, output_chunk_start)
-        output_chunk_start += len(stdout)
-        stdout = ''
+      # Abort if a packet failed to be sent.
+      sender.check()
 
       # Send signal on timeout if necessary. Both are failures, not
       # internal_failures.
@@ -311,16 +414,24 @@ def run_command(
       exit_code = proc.wait()
       logging.info('Waiting for proces exit in finally - done')
 
-    # This is the very last packet for this command.
+    # This is the very last packet for this command. It is sent once the
+    # previous ones were.
+    stdout, output_chunk_start = sender.stop()
     now = monotonic_time()
     params['cost_usd'] = cost_usd_hour * (now - task_start) / 60. / 60.
+    # Each packet has at most MAX_ADAPTIVE_CHUNK_SIZE of stdout, only the last
+    # one completes the command.
+    while len(stdout) > MAX_ADAPTIVE_CHUNK_SIZE:
+      post_update(
+          swarming_server, params, None, stdout[:MAX_ADAPTIVE_CHUNK_SIZE],
+          output_chunk_start)
+      stdout = stdout[MAX_ADAPTIVE_CHUNK_SIZE:]
+      output_chunk_start += MAX_ADAPTIVE_CHUNK_SIZE
     params['duration'] = now - start
     params['io_timeout'] = had_io_timeout
     params['hard_timeout'] = had_hard_timeout
     # At worst, it'll re-throw, which will be caught by bot_main.py.
     post_update(swarming_server, params, exit_code, stdout, output_chunk_start)
-    output_chunk_start += len(stdout)
-    stdout = ''
 
     summary = {
         'exit_code': exit_code,
@@ -330,9 +441,10 @@ def run_command(
     }
     with open(json_file, 'w') as fd:
       json.dump(summary, fd)
+    # Raises if a packet failed to be sent after the process exited.
+    sender.check()
 
   logging.info('run_command() = %s', exit_code)
-  assert not stdout
   return exit_code
 
 
@@ -17,6 +17,7 @@ import tempfile
 import time
 import unittest
 import zipfile
+import zlib
 
 import test_env
 test_env.setup_test_env()
@@ -336,6 +337,8 @@ class TestTaskRunner(TestTaskRunnerBase):
     self.mock(subprocess42, 'Popen', Popen)
 
     def check_final(kwargs):
+      # The output is buffered since the time doesn't progress and it is below
+      # MAX_ADAPTIVE_CHUNK_SIZE.
       self.assertEqual(
           {
             'data': {
@@ -347,8 +350,9 @@ class TestTaskRunner(TestTaskRunnerBase):
               'hard_timeout': False,
               'id': 'localhost',
               'io_timeout': False,
-              'output': base64.b64encode('hi!\n'),
-              'output_chunk_start': 100002*4,
+              'output': base64.b64encode(zlib.compress('hi!\n' * 100003)),
+              'output_chunk_start': 0,
+              'output_compression': 'zlib',
               'task_id': 23,
             },
             'headers': {'X-XSRF-Token': 'token'},
@@ -373,20 +377,6 @@ class TestTaskRunner(TestTaskRunnerBase):
         },
         {},
       ),
-      (
-        'https://localhost:1/swarming/api/v1/bot/task_update/23',
-        {
-          'data': {
-            'cost_usd': 10.,
-            'id': 'localhost',
-            'output': base64.b64encode('hi!\n' * 100002),
-            'output_chunk_start': 0,
-            'task_id': 23,
-          },
-          'headers': {'X-XSRF-Token': 'token'},
-        },
-        {},
-      ),
       (
         'https://localhost:1/swarming/api/v1/bot/task_update/23',
         check_final,
@@ -413,6 +403,130 @@ class TestTaskRunner(TestTaskRunnerBase):
         os.path.join(self.work_dir, 'task_summary.json'))
     self.assertEqual(0, r)
 
+  def test_should_post_update(self):
+    size = task_runner.MAX_CHUNK_SIZE
+    interval = task_runner.MIN_PACKET_INTERNAL
+    self.assertEqual(False, task_runner.should_post_update(0, 10, 0))
+    self.assertEqual(True, task_runner.should_post_update(0, 31, 0))
+    self.assertEqual(False, task_runner.should_post_update(1, 10, 0))
+    self.assertEqual(True, task_runner.should_post_update(1, 11, 0))
+    self.assertEqual(True, task_runner.should_post_update(size, 100, 0))
+    # The packet size grows with the output rate.
+    self.assertEqual(False, task_runner.should_post_update(size, 1, 0))
+    self.assertEqual(
+        True, task_runner.should_post_update(size, interval + 1, 0))
+    self.assertEqual(
+        True,
+        task_runner.should_post_update(
+            task_runner.MAX_ADAPTIVE_CHUNK_SIZE, 0, 0))
+
+  def test_output_sender(self):
+    self.mock(task_runner, 'MAX_ADAPTIVE_CHUNK_SIZE', 10)
+    self.mock(task_runner, 'MAX_CHUNK_SIZE', 10)
+    posted = []
+    def post_update(swarming_server, params, exit_code, stdout, start):
+      self.assertEqual('server', swarming_server)
+      self.assertEqual({'cost_usd': 10., 'task_id': 23}, params)
+      self.assertEqual(None, exit_code)
+      posted.append((start, stdout))
+    self.mock(task_runner, 'post_update', post_update)
+
+    sender = task_runner.OutputSender(
+        'server', {'task_id': 23}, 3600., time.time() - 10)
+    for i in xrange(100):
+      sender.add('%02d' % i)
+    # Wait for the thread to send the output buffered.
+    for _ in xrange(1000):
+      if sum(len(p[1]) for p in posted) >= 190:
+        break
+      time.sleep(0.01)
+    stdout, start = sender.stop()
+    sender.check()
+    posted.append((start, stdout))
+    expected = ''.join('%02d' % i for i in xrange(100))
+    self.assertEqual(expected, ''.join(p[1] for p in posted))
+    self.assertTrue(len(posted) > 1)
+    offset = 0
+    for start, stdout in posted:
+      self.assertEqual(offset, start)
+      offset += len(stdout)
+
+  def test_output_sender_burst(self):
+    # A burst larger than MAX_ADAPTIVE_CHUNK_SIZE is sent in multiple packets.
+    self.mock(task_runner, 'MAX_ADAPTIVE_CHUNK_SIZE', 10)
+    self.mock(task_runner, 'MAX_CHUNK_SIZE', 10)
+    posted = []
+    def post_update(_swarming_server, _params, _exit_code, stdout, start):
+      posted.append((start, stdout))
+    self.mock(task_runner, 'post_update', post_update)
+
+    sender = task_runner.OutputSender(
+        'server', {'task_id': 23}, 3600., time.time() - 10)
+    data = ''.join(chr(ord('a') + i % 26) for i in xrange(35))
+    sender.add(data)
+    for _ in xrange(1000):
+      if sum(len(p[1]) for p in posted) >= 30:
+        break
+      time.sleep(0.01)
+    stdout, start = sender.stop()
+    sender.check()
+    self.assertEqual(
+        [(0, data[:10]), (10, data[10:20]), (20, data[20:30])], posted)
+    self.assertEqual((data[30:], 30), (stdout, start))
+
+  def test_run_command_final_packets(self):
+    # The output left when the command exits is sent in packets of at most
+    # MAX_ADAPTIVE_CHUNK_SIZE, only the last one has the exit code.
+    self.mock(task_runner, 'MAX_ADAPTIVE_CHUNK_SIZE', 10)
+    class Popen(object):
+      def __init__(self2, *_args, **_kwargs):
+        pass
+      @staticmethod
+      def yield_any(maxsize, soft_timeout):
+        # pylint: disable=W0613
+        return []
+      @staticmethod
+      def wait():
+        return 0
+    self.mock(subprocess42, 'Popen', Popen)
+    class OutputSender(object):
+      def __init__(self2, *_args):
+        pass
+      @staticmethod
+      def check():
+        pass
+      @staticmethod
+      def stop():
+        return 'x' * 25, 5
+    self.mock(task_runner, 'OutputSender', OutputSender)
+    posted = []
+    def post_update(_swarming_server, params, exit_code, stdout, start):
+      posted.append((start, stdout, exit_code, 'duration' in params))
+    self.mock(task_runner, 'post_update', post_update)
+
+    task_details = self.get_task_details('print(\'hi\')')
+    self.assertEqual(0, self._run_command(task_details))
+    expected = [
+      (0, '', None, False),
+      (5, 'x' * 10, None, False),
+      (15, 'x' * 10, None, False),
+      (25, 'x' * 5, 0, True),
+    ]
+    self.assertEqual(expected, posted)
+
+  def test_output_sender_error(self):
+    self.mock(task_runner, 'MAX_ADAPTIVE_CHUNK_SIZE', 1)
+    def post_update(*_):
+      raise ValueError('Oops')
+    self.mock(task_runner, 'post_update', post_update)
+    sender = task_runner.OutputSender('server', {}, 3600., time.time())
+    sender.add('hi')
+    sender._thread.join()
+    with self.assertRaises(ValueError):
+      sender.check()
+    # The output is kept for the last packet.
+    self.assertEqual(('hi', 0), sender.stop())
+
   def test_main(self):
     def load_and_run(
         manifest, swarming_server, cost_usd_hour, start, json_file):
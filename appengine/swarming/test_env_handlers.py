@@ -21,6 +21,8 @@ from components import stats_framework
 from test_support import test_case
 
 from server import acl
+from server import bot_code
+from server import bot_management
 from server import stats
 
 
@@ -61,6 +63,9 @@ class AppTestBase(test_case.TestCase):
         [auth.Identity(auth.IDENTITY_BOT, self.source_ip)])
 
     self.mock(stats_framework, 'add_entry', self._parse_line)
+    # Do not leak the instance caches across tests.
+    self.mock(bot_code, '_bot_version_cache', {})
+    self.mock(bot_management, '_bot_settings_cache', {})
 
   def _parse_line(self, line):
     # pylint: disable=W0212
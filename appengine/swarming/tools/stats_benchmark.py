@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Copyright 2015 The Swarming Authors. All rights reserved.
+# Use of this source code is governed by the Apache v2.0 license that can be
+# found in the LICENSE file.
+
+"""Benchmarks stats._post_process() matching the bots to the dimensions
+buckets of a statistics snapshot.
+"""
+
+import json
+import optparse
+import os
+import random
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import test_env
+test_env.setup_test_env()
+
+from components import utils
+from server import stats
+from server import task_to_run
+
+
+# pylint: disable=W0212
+
+
+def gen_bots(count, rand):
+  """Returns a dict of bot_id -> bot dimensions."""
+  bots = {}
+  for i in xrange(count):
+    bot_id = 'bot%d' % i
+    bots[bot_id] = {
+      'cpu': rand.choice([['x86', 'x86-32'], ['x86', 'x86-64']]),
+      'gpu': rand.choice(['none', '1002', '10de']),
+      'id': bot_id,
+      'os': rand.choice(
+          [['Linux', 'Linux-12.04'], ['Linux', 'Linux-14.04'],
+           ['Mac', 'Mac-10.9'], ['Windows', 'Windows-7-SP1']]),
+      'pool': 'pool%d' % rand.randrange(20),
+    }
+  return bots
+
+
+def gen_buckets(count, bots, rand):
+  """Returns a list of json encoded request dimensions."""
+  buckets = set()
+  keys = ('cpu', 'gpu', 'id', 'os', 'pool')
+  bots = bots.values()
+  while len(buckets) < count:
+    # Use the dimensions of an existing bot so the buckets are not all empty.
+    bot = rand.choice(bots)
+    dimensions = {}
+    for key in rand.sample(keys, rand.randint(1, 3)):
+      value = bot[key]
+      dimensions[key] = rand.choice(value) if isinstance(value, list) else value
+    buckets.add(utils.encode_to_json(dimensions))
+  return sorted(buckets)
+
+
+def gen_snapshot(buckets):
+  snapshot = stats._Snapshot()
+  for dimensions_json in buckets:
+    snapshot.get_dimensions(dimensions_json)
+  return snapshot
+
+
+def check(snapshot, bots_active, bots_inactive):
+  """Compares the result with task_to_run.match_dimensions(). It is slow."""
+  for bucket in snapshot.buckets:
+    dimensions = json.loads(bucket.dimensions)
+    expected = sorted(
+        b for b, d in bots_active.iteritems()
+        if task_to_run.match_dimensions(dimensions, d))
+    if expected != bucket.bot_ids:
+      print('Mismatch for %s' % bucket.dimensions)
+      return 1
+    expected = sorted(
+        b for b, d in bots_inactive.iteritems()
+        if task_to_run.match_dimensions(dimensions, d))
+    if expected != bucket.bot_ids_bad:
+      print('Mismatch for %s' % bucket.dimensions)
+      return 1
+  print('Matches task_to_run.match_dimensions()')
+  return 0
+
+
+def main():
+  parser = optparse.OptionParser(description=sys.modules[__name__].__doc__)
+  parser.add_option(
+      '--bots', type='int', default=10000, help='Number of bots: %default')
+  parser.add_option(
+      '--inactive', type='float', default=0.05,
+      help='Ratio of inactive bots: %default')
+  parser.add_option(
+      '--buckets', type='int', default=2000,
+      help='Number of dimensions buckets: %default')
+  parser.add_option(
+      '--seed', type='int', default=0, help='Random seed: %default')
+  parser.add_option(
+      '--check', action='store_true',
+      help='Compares the result with task_to_run.match_dimensions()')
+  options, args = parser.parse_args()
+  if args:
+    parser.error('Unsupported arguments: %s' % args)
+
+  rand = random.Random(options.seed)
+  bots = gen_bots(options.bots, rand)
+  buckets = gen_buckets(options.buckets, bots, rand)
+  bots_active = {}
+  bots_inactive = {}
+  for bot_id, dimensions in bots.iteritems():
+    if rand.random() < options.inactive:
+      bots_inactive[bot_id] = dimensions
+    else:
+      bots_active[bot_id] = dimensions
+
+  snapshot = gen_snapshot(buckets)
+  start = time.time()
+  stats._post_process(snapshot, bots_active, bots_inactive, {})
+  duration = time.time() - start
+  print(
+      '%d bots x %d buckets: %.3fs' % (len(bots), len(buckets), duration))
+  if options.check:
+    return check(snapshot, bots_active, bots_inactive)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -571,18 +571,20 @@ class CompleteState(object):
     If |subdir| is specified, filters to a subdirectory. The resulting .isolated
     file is tainted.
 
-    See isolated_format.file_to_metadata() for more information.
+    See isolated_format.file_to_metadata() for more information. The files are
+    processed in parallel.
     """
-    for infile in sorted(self.saved_state.files):
-      if subdir and not infile.startswith(subdir):
-        self.saved_state.files.pop(infile)
-      else:
-        filepath = os.path.join(self.root_dir, infile)
-        self.saved_state.files[infile] = isolated_format.file_to_metadata(
-            filepath,
-            self.saved_state.files[infile],
-            self.saved_state.read_only,
-            self.saved_state.algo)
+    files = self.saved_state.files
+    if subdir:
+      for infile in files.keys():
+        if not infile.startswith(subdir):
+          files.pop(infile)
+    infiles = {os.path.join(self.root_dir, infile): infile for infile in files}
+    for filepath, metadata in isolated_format.iter_file_to_metadata(
+        ((filepath, files[infile]) for filepath, infile in infiles.iteritems()),
+        self.saved_state.read_only,
+        self.saved_state.algo):
+      files[infiles[filepath]] = metadata
 
   def save_files(self):
     """Saves self.saved_state and creates a .isolated file."""
@@ -4,15 +4,22 @@
 
 """Understands .isolated files and can do local operations on them."""
 
+import atexit
 import hashlib
 import json
 import logging
 import os
 import re
 import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
 
 from utils import file_path
+from utils import lru
+from utils import threading_utils
 from utils import tools
 
 
@@ -24,6 +31,27 @@ ISOLATED_FILE_VERSION = '1.4'
 DISK_FILE_CHUNK = 1024 * 1024
 
 
+# Maximum number of threads used to hash files in parallel. Hashing is mostly
+# disk I/O and hashlib releases the GIL on large buffers.
+HASH_THREADS = max(threading_utils.num_processors(), 4)
+
+
+# Directory of the machine wide hash cache, see HashCache. It can be overridden
+# with the ISOLATED_HASH_CACHE environment variable; an empty value disables the
+# cache.
+HASH_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.isolated_hash_cache')
+
+
+# Maximum number of files remembered by the hash cache.
+HASH_CACHE_MAX_ITEMS = 500000
+
+
+# Files modified less than this number of seconds before being hashed are not
+# put in the hash cache, as they could be modified again without their mtime
+# changing.
+HASH_CACHE_RACY_SECONDS = 2
+
+
 # Sadly, hashlib uses 'sha1' instead of the standard 'sha-1' so explicitly
 # specify the names here.
 SUPPORTED_ALGOS = {
@@ -64,21 +92,273 @@ def is_namespace_with_compression(namespace):
   return namespace.endswith(('-gzip', '-deflate'))
 
 
+# Per thread buffer used by hash_file().
+_hash_buffer = threading.local()
+
+
 def hash_file(filepath, algo):
   """Calculates the hash of a file without reading it all in memory at once.
 
+  The file is read into a per thread buffer that is reused across calls, so no
+  string is allocated per chunk read.
+
   |algo| should be one of hashlib hashing algorithm.
   """
+  buf = getattr(_hash_buffer, 'buf', None)
+  if buf is None:
+    buf = _hash_buffer.buf = bytearray(DISK_FILE_CHUNK)
+  view = memoryview(buf)
   digest = algo()
   with open(filepath, 'rb') as f:
     while True:
-      chunk = f.read(DISK_FILE_CHUNK)
-      if not chunk:
+      size = f.readinto(buf)
+      if not size:
         break
-      digest.update(chunk)
+      digest.update(view[:size])
   return digest.hexdigest()
 
 
+class HashCache(object):
+  """Machine wide cache of file hashes keyed by (device, inode, size, mtime,
+  ctime).
+
+  The state file has a header followed by fixed width records of the key and
+  the binary digest. New entries are appended in a single write, so multiple
+  processes can share the file; a truncated trailing record is ignored and the
+  file is compacted before anything is appended to it. The file is compacted, i.e. atomically replaced with one record per entry in LRU
+  order, when it holds more than twice as many records as there are entries.
+
+  LRU order is only approximate across processes: the hits are not written to
+  the file, they only affect the order of the entries when this process
+  compacts it.
+
+  ctime is part of the key since, unlike mtime, it can't be set back by tools
+  that restore timestamps, e.g. tar or rsync -t, so a file rewritten with the
+  same size and mtime is not returned a stale digest.
+
+  Thread safe.
+  """
+
+  # Magic header of the state file, followed by the digest size.
+  _HEADER = struct.Struct('<8sB')
+  _MAGIC = 'HASHCAC2'
+  # (device, inode, size, mtime in ns, ctime in ns).
+  _KEY = struct.Struct('<QQQqq')
+
+  def __init__(self, state_file, algo, max_items=HASH_CACHE_MAX_ITEMS):
+    self.state_file = state_file
+    self.max_items = max_items
+    self._digest_size = algo().digest_size
+    self._record = struct.Struct(
+        '%s%ds' % (self._KEY.format, self._digest_size))
+    self._lock = threading.Lock()
+    # (device, inode, size, mtime, ctime) -> hex digest. Loaded on first use.
+    self._lru = None
+    # Entries added since the state file was last loaded or saved.
+    self._added = []
+    # Number of records in the state file. None if it must be rewritten.
+    self._records = None
+
+  @staticmethod
+  def key(filestats):
+    """Returns the cache key of a file from its os.stat() result."""
+    # Python 2 has no st_mtime_ns; the float times have sub-microsecond
+    # precision for current dates.
+    return (
+        filestats.st_dev, filestats.st_ino, filestats.st_size,
+        int(round(filestats.st_mtime * 1e9)),
+        int(round(filestats.st_ctime * 1e9)))
+
+  def get(self, filestats):
+    """Returns the hex digest of a file or None if not in the cache."""
+    key = self.key(filestats)
+    with self._lock:
+      self._ensure_loaded()
+      digest = self._lru.get(key)
+      if digest is not None:
+        self._lru.touch(key)
+      return digest
+
+  def add(self, filestats, digest):
+    """Remembers the hex digest of a file.
+
+    Files modified in the last HASH_CACHE_RACY_SECONDS are skipped.
+    """
+    if time.time() - filestats.st_mtime < HASH_CACHE_RACY_SECONDS:
+      return
+    key = self.key(filestats)
+    with self._lock:
+      self._ensure_loaded()
+      if self._lru.get(key) == digest:
+        return
+      self._lru.add(key, digest)
+      self._added.append(key)
+      while len(self._lru) > self.max_items:
+        self._lru.pop_oldest()
+
+  def save(self):
+    """Writes the entries added since the last save to the state file."""
+    with self._lock:
+      if not self._added:
+        return
+      try:
+        if (self._records is None or
+            self._records + len(self._added) > 2 * len(self._lru) + 1024 or
+            not self._append()):
+          self._compact()
+      except (IOError, OSError) as e:
+        logging.warning('Failed to save %s: %s', self.state_file, e)
+      self._added = []
+
+  def _ensure_loaded(self):
+    """Loads the state file if not done yet. A broken file is ignored."""
+    if self._lru is not None:
+      return
+    self._lru = lru.LRUDict()
+    try:
+      with open(self.state_file, 'rb') as f:
+        data = f.read()
+    except IOError:
+      return
+    if (len(data) < self._HEADER.size or
+        self._HEADER.unpack_from(data) != (self._MAGIC, self._digest_size)):
+      logging.warning('Ignoring broken %s', self.state_file)
+      return
+    size = self._record.size
+    end = len(data) - (len(data) - self._HEADER.size) % size
+    for offset in xrange(self._HEADER.size, end, size):
+      record = self._record.unpack_from(data, offset)
+      self._lru.add(record[:5], record[5].encode('hex'))
+    while len(self._lru) > self.max_items:
+      self._lru.pop_oldest()
+    # Appending after a truncated record would misalign all the new records.
+    self._records = (
+        (end - self._HEADER.size) / size if end == len(data) else None)
+
+  def _pack(self, key):
+    return self._record.pack(*(key + (self._lru.get(key).decode('hex'),)))
+
+  def _append(self):
+    """Appends the added entries still in the cache in a single write.
+
+    Returns False if the state file must be compacted instead, since another
+    process left a truncated record at its end.
+    """
+    data = ''.join(self._pack(k) for k in self._added if k in self._lru)
+    fd = os.open(self.state_file, os.O_WRONLY | os.O_APPEND)
+    try:
+      if (os.fstat(fd).st_size - self._HEADER.size) % self._record.size:
+        return False
+      os.write(fd, data)
+    finally:
+      os.close(fd)
+    self._records += len(data) / self._record.size
+    return True
+
+  def _compact(self):
+    """Atomically rewrites the state file with one record per entry."""
+    dirpath = os.path.dirname(self.state_file)
+    if not os.path.isdir(dirpath):
+      os.makedirs(dirpath)
+    data = [self._HEADER.pack(self._MAGIC, self._digest_size)]
+    data.extend(self._pack(key) for key, _ in self._lru.iteritems())
+    handle, tmp = tempfile.mkstemp(dir=dirpath, suffix='.tmp')
+    try:
+      os.write(handle, ''.join(data))
+      os.close(handle)
+      handle = None
+      if sys.platform == 'win32' and os.path.isfile(self.state_file):
+        os.remove(self.state_file)
+      os.rename(tmp, self.state_file)
+    finally:
+      if handle is not None:
+        os.close(handle)
+      if os.path.isfile(tmp):
+        os.remove(tmp)
+    self._records = len(self._lru)
+
+
+# algo -> process wide HashCache, see get_hash_cache().
+_hash_caches = {}
+_hash_caches_lock = threading.Lock()
+
+
+def get_hash_cache(algo):
+  """Returns the process wide HashCache for |algo| or None if disabled.
+
+  The caches are saved when the process exits.
+  """
+  cache_dir = os.environ.get('ISOLATED_HASH_CACHE', HASH_CACHE_DIR)
+  if not cache_dir:
+    return None
+  state_file = os.path.join(
+      cache_dir, '%s.bin' % SUPPORTED_ALGOS_REVERSE.get(algo, algo().name))
+  with _hash_caches_lock:
+    cache = _hash_caches.get(state_file)
+    if not cache:
+      if not _hash_caches:
+        atexit.register(save_hash_caches)
+      cache = _hash_caches[state_file] = HashCache(state_file, algo)
+    return cache
+
+
+def save_hash_caches():
+  """Saves the process wide HashCache instances."""
+  with _hash_caches_lock:
+    caches = _hash_caches.values()
+  for cache in caches:
+    cache.save()
+
+
+def hash_file_cached(filepath, filestats, algo):
+  """Same as hash_file() but reuses the machine wide hash cache.
+
+  |filestats| is the os.stat() result of |filepath|.
+  """
+  cache = get_hash_cache(algo)
+  digest = cache.get(filestats) if cache else None
+  if not digest:
+    digest = hash_file(filepath, algo)
+    if cache:
+      cache.add(filestats, digest)
+  return digest
+
+
+def iter_file_to_metadata(files, read_only, algo):
+  """Runs file_to_metadata() on multiple files in parallel.
+
+  Arguments:
+    files: iterable of (filepath, prevdict). It is consumed as the files are
+           processed, so it can itself be a generator.
+    read_only: see file_to_metadata().
+    algo:      Hashing algorithm used.
+
+  Yields:
+    (filepath, metadata) as soon as each file is processed, in no particular
+    order.
+  """
+  channel = threading_utils.TaskChannel()
+  process = channel.wrap_task(
+      lambda filepath, prevdict:
+          (filepath, file_to_metadata(filepath, prevdict, read_only, algo)))
+  with threading_utils.ThreadPool(1, HASH_THREADS, 0, 'hash') as pool:
+    pending = 0
+    for filepath, prevdict in files:
+      pool.add_task(0, process, filepath, prevdict)
+      pending += 1
+      # Yield what is already done, not to wait for |files| to be exhausted.
+      while True:
+        try:
+          result = channel.pull(timeout=0)
+        except threading_utils.TaskChannel.Timeout:
+          break
+        pending -= 1
+        yield result
+    for _ in xrange(pending):
+      yield channel.pull()
+  save_hash_caches()
+
+
 class IsolatedFile(object):
   """Represents a single parsed .isolated file."""
 
@@ -317,7 +597,8 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
   Arguments:
     filepath: File to act on.
     prevdict: the previous dictionary. It is used to retrieve the cached sha-1
-              to skip recalculating the hash. Optional.
+              to skip recalculating the hash. Optional. The machine wide
+              HashCache is consulted otherwise.
     read_only: If 1 or 2, the file mode is manipulated. In practice, only save
                one of 4 modes: 0755 (rwx), 0644 (rw), 0555 (rx), 0444 (r). On
                windows, mode is not set since all files are 'executable' by
@@ -371,7 +652,7 @@ def file_to_metadata(filepath, prevdict, read_only, algo):
       # Reuse the previous hash if available.
       out['h'] = prevdict.get('h')
     if not out.get('h'):
-      out['h'] = hash_file(filepath, algo)
+      out['h'] = hash_file_cached(filepath, filestats, algo)
   else:
     # If the timestamp wasn't updated, carry on the link destination.
     if prevdict.get('t') == out['t']:
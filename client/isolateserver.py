@@ -80,6 +80,22 @@ ALREADY_COMPRESSED_TYPES = [
 NET_IO_FILE_CHUNK = 16 * 1024
 
 
+# Maximum size of an item fetched through the staged pipeline of
+# Storage.async_fetch(), where it is buffered in memory between the download,
+# decompression and write steps. Larger items are streamed by a single thread.
+MAX_STAGED_FETCH_SIZE = 1024 * 1024
+
+
+# Maximum number of items in flight in the staged fetch pipeline. Downloads
+# wait when decompression or writes to the cache can't keep up.
+MAX_STAGED_FETCHES = 64
+
+
+# Files larger than this are fetched last by IsolatedBundle, after the files
+# referenced by the command and the smaller files.
+LARGE_FILE_SIZE = 16 * 1024 * 1024
+
+
 # Read timeout in seconds for downloads from isolate storage. If there's no
 # response from the server within this timeout whole download will be aborted.
 DOWNLOAD_READ_TIMEOUT = 60
@@ -321,6 +337,24 @@ class BufferItem(Item):
     return [self.buffer]
 
 
+class _StageChannel(object):
+  """TaskChannel look-alike for a stage of a pipeline.
+
+  Passes the result of a task to the next stage and its exception to the final
+  TaskChannel.
+  """
+
+  def __init__(self, channel, next_stage):
+    self._channel = channel
+    self._next_stage = next_stage
+
+  def send_result(self, result):
+    self._next_stage(result)
+
+  def send_exception(self, exc_info=None):
+    self._channel.send_exception(exc_info)
+
+
 class Storage(object):
   """Efficiently downloads or uploads large set of files via StorageApi.
 
@@ -341,6 +375,8 @@ class Storage(object):
     self._hash_algo = isolated_format.get_hash_algo(storage_api.namespace)
     self._cpu_thread_pool = None
     self._net_thread_pool = None
+    self._disk_thread_pool = None
+    self._staged_fetches = threading.BoundedSemaphore(MAX_STAGED_FETCHES)
     self._aborted = False
     self._prev_sig_handlers = {}
 
@@ -383,17 +419,31 @@ class Storage(object):
       self._net_thread_pool = threading_utils.IOAutoRetryThreadPool()
     return self._net_thread_pool
 
+  @property
+  def disk_thread_pool(self):
+    """ThreadPool for disk-bound tasks like writing fetched items to a cache."""
+    if self._disk_thread_pool is None:
+      self._disk_thread_pool = threading_utils.ThreadPool(2, 8, 0, 'disk')
+    return self._disk_thread_pool
+
   def close(self):
     """Waits for all pending tasks to finish."""
     logging.info('Waiting for all threads to die...')
-    if self._cpu_thread_pool:
-      self._cpu_thread_pool.join()
-      self._cpu_thread_pool.close()
-      self._cpu_thread_pool = None
-    if self._net_thread_pool:
-      self._net_thread_pool.join()
-      self._net_thread_pool.close()
-      self._net_thread_pool = None
+    pools = (
+        self._cpu_thread_pool, self._net_thread_pool, self._disk_thread_pool)
+    # Uploads flow from the cpu pool to the net pool, fetches from the net pool
+    # to the cpu pool and then the disk pool. Let all of them drain before
+    # closing any.
+    for pool in pools[:2] + pools:
+      if pool:
+        pool.join()
+    for pool in pools:
+      if pool:
+        pool.close()
+    self._cpu_thread_pool = None
+    self._net_thread_pool = None
+    self._disk_thread_pool = None
+    net.log_stats()
     logging.info('Done.')
 
   def abort(self):
@@ -427,36 +477,43 @@ class Storage(object):
     It figures out what items are missing from the server and uploads only them.
 
     Arguments:
-      items: list of Item instances that represents data to upload.
+      items: list of Item instances that represents data to upload. It can also
+             be a generator, in which case the existence checks and the uploads
+             start while it is still producing items.
 
     Returns:
       List of items that were uploaded. All other items are already there.
     """
-    logging.info('upload_items(items=%d)', len(items))
-
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
-
     # For each digest keep only first Item that matches it. All other items
     # are just indistinguishable copies from the point of view of isolate
     # server (it doesn't care about paths at all, only content and digests).
     seen = {}
-    duplicates = 0
-    for item in items:
-      if seen.setdefault(item.digest, item) is not item:
-        duplicates += 1
-    items = seen.values()
-    if duplicates:
-      logging.info('Skipped %d files with duplicated content', duplicates)
+    duplicates = []
+    def unique_items():
+      for item in items:
+        # Ensure the digest is calculated.
+        item.prepare(self._hash_algo)
+        if item.digest in seen:
+          duplicates.append(item)
+        else:
+          seen[item.digest] = item
+          yield item
+    if isinstance(items, list):
+      logging.info('upload_items(items=%d)', len(items))
+      unique = list(unique_items())
+    else:
+      unique = unique_items()
 
     # Enqueue all upload tasks.
     missing = set()
     uploaded = []
     channel = threading_utils.TaskChannel()
-    for missing_item, push_state in self.get_missing_items(items):
+    for missing_item, push_state in self.get_missing_items(unique):
       missing.add(missing_item)
       self.async_push(channel, missing_item, push_state)
+    items = seen.values()
+    if duplicates:
+      logging.info('Skipped %d files with duplicated content', len(duplicates))
 
     # No need to spawn deadlock detector thread if there's nothing to upload.
     if missing:
@@ -585,6 +642,13 @@ class Storage(object):
   def async_fetch(self, channel, priority, digest, size, sink):
     """Starts asynchronous fetch from the server in a parallel thread.
 
+    Items of known size up to MAX_STAGED_FETCH_SIZE are pipelined: a net thread
+    downloads them, a cpu thread decompresses and verifies them and a disk
+    thread passes them to |sink|, so each stage moves on to the next item right
+    away. At most MAX_STAGED_FETCHES items are in flight, downloads wait when
+    the later stages can't keep up. Larger items are streamed through all the
+    steps by a single net thread to bound the memory use.
+
     Arguments:
       channel: TaskChannel that receives back |digest| when download ends.
       priority: thread pool task priority for the fetch.
@@ -592,6 +656,10 @@ class Storage(object):
       size: expected size of the item (after decompression).
       sink: function that will be called as sink(generator).
     """
+    if size != UNKNOWN_FILE_SIZE and size <= MAX_STAGED_FETCH_SIZE:
+      self._async_fetch_staged(channel, priority, digest, size, sink, 0)
+      return
+
     def fetch():
       try:
         # Prepare reading pipeline.
@@ -607,17 +675,72 @@ class Storage(object):
         raise
       return digest
 
-    # Don't bother with zip_thread_pool for decompression. Decompression is
-    # really fast and most probably IO bound anyway.
     self.net_thread_pool.add_task_with_channel(channel, priority, fetch)
 
+  def _async_fetch_staged(self, channel, priority, digest, size, sink, retry):
+    """Runs a fetch through the download, decompress and write stages.
+
+    A corrupted download is fetched again, up to the same number of retries as
+    the net thread pool does on network errors.
+    """
+    def download():
+      # Wait for room in the pipeline. It is released once the item is passed
+      # to |sink| or a stage fails.
+      self._staged_fetches.acquire()
+      try:
+        return list(self._storage_api.fetch(digest))
+      except Exception as err:
+        self._staged_fetches.release()
+        logging.error('Failed to fetch %s: %s', digest, err)
+        raise
+
+    def decompress(chunks):
+      try:
+        if self._use_zip:
+          chunks = zip_decompress(chunks, isolated_format.DISK_FILE_CHUNK)
+        # Run |chunks| through verifier that will assert their size.
+        content = list(FetchStreamVerifier(chunks, size).run())
+      except Exception as err:
+        self._staged_fetches.release()
+        if (isinstance(err, IOError) and
+            retry < threading_utils.IOAutoRetryThreadPool.RETRIES):
+          logging.warning('Failed to fetch %s: %s, retrying', digest, err)
+          self._async_fetch_staged(
+              channel, priority, digest, size, sink, retry + 1)
+        else:
+          logging.error('Failed to fetch %s: %s', digest, err)
+          channel.send_exception()
+        return
+      self.disk_thread_pool.add_task(priority, write, content)
+
+    def write(content):
+      try:
+        sink(content)
+      except Exception as err:
+        logging.error('Failed to fetch %s: %s', digest, err)
+        channel.send_exception()
+        return
+      finally:
+        self._staged_fetches.release()
+      channel.send_result(digest)
+
+    self.net_thread_pool.add_task_with_channel(
+        _StageChannel(
+            channel,
+            lambda chunks: self.cpu_thread_pool.add_task(
+                priority, decompress, chunks)),
+        priority,
+        download)
+
   def get_missing_items(self, items):
     """Yields items that are missing from the server.
 
     Issues multiple parallel queries via StorageApi's 'contains' method.
 
     Arguments:
-      items: a list of Item objects to check.
+      items: a list of Item objects to check. It can also be a generator, in
+             which case the checks are started as soon as a batch is filled
+             and the missing items are yielded while it is still consumed.
 
     Yields:
       For each missing item it yields a pair (item, push_state), where:
@@ -630,20 +753,28 @@ class Storage(object):
     channel = threading_utils.TaskChannel()
     pending = 0
 
-    # Ensure all digests are calculated.
-    for item in items:
-      item.prepare(self._hash_algo)
-
     def contains(batch):
       if self._aborted:
         raise Aborted()
+      # Ensure all digests are calculated.
+      for item in batch:
+        item.prepare(self._hash_algo)
       return self._storage_api.contains(batch)
 
-    # Enqueue all requests.
+    # Enqueue all requests. Yield the results already in while |items| is
+    # being consumed.
     for batch in batch_items_for_check(items):
       self.net_thread_pool.add_task_with_channel(
           channel, threading_utils.PRIORITY_HIGH, contains, batch)
       pending += 1
+      while True:
+        try:
+          result = channel.pull(timeout=0)
+        except threading_utils.TaskChannel.Timeout:
+          break
+        pending -= 1
+        for missing_item, push_state in result.iteritems():
+          yield missing_item, push_state
 
     # Yield results as they come in.
     for _ in xrange(pending):
@@ -658,7 +789,9 @@ def batch_items_for_check(items):
   to StorageApi's 'contains' method.
 
   Arguments:
-    items: a list of Item objects.
+    items: a list of Item objects, checked from the largest to the smallest.
+           It can also be a generator, in which case the items are batched in
+           the order they are produced.
 
   Yields:
     Batches of items to query for existence in a single operation,
@@ -667,7 +800,9 @@ def batch_items_for_check(items):
   batch_count = 0
   batch_size_limit = ITEMS_PER_CONTAINS_QUERIES[0]
   next_queries = []
-  for item in sorted(items, key=lambda x: x.size, reverse=True):
+  if isinstance(items, list):
+    items = sorted(items, key=lambda x: x.size, reverse=True)
+  for item in items:
     next_queries.append(item)
     if len(next_queries) == batch_size_limit:
       yield next_queries
@@ -685,15 +820,31 @@ class FetchQueue(object):
   It manages multiple concurrent fetch operations. Acts as a bridge between
   Storage and LocalCache so that Storage and LocalCache don't depend on each
   other at all.
+
+  Can also map the items to files once they are in the cache. The files are
+  hardlinked by the same task that writes the item to the cache, or by a task
+  in the storage's disk thread pool if the item is already there.
   """
 
   def __init__(self, storage, cache):
     self.storage = storage
     self.cache = cache
     self._channel = threading_utils.TaskChannel()
-    self._pending = set()
+    # digest -> number of results expected from the channel, for each fetch or
+    # mapping in progress.
+    self._pending = {}
     self._accessed = set()
     self._fetched = cache.cached_set()
+    # Digests passed to map_files() and not yet mapped.
+    self._mapping = set()
+    # Digests mapped and not yet returned by wait_mapped().
+    self._mapped = []
+    # Protects |_written| and |_links| that are used by the writer threads.
+    self._lock = threading.Lock()
+    # Digests written to the cache by a fetch still in |_pending|.
+    self._written = set()
+    # digest -> list of (path, file_mode) to map once the item is written.
+    self._links = {}
 
   def add(
       self,
@@ -727,10 +878,27 @@ class FetchQueue(object):
     #   this run! If not, abort early.
 
     # Start fetching.
-    self._pending.add(digest)
+    self._pending[digest] = 1
     self.storage.async_fetch(
         self._channel, priority, digest, size,
-        functools.partial(self.cache.write, digest))
+        functools.partial(self._write, digest))
+
+  def map_files(self, digest, files):
+    """Starts asynchronous mapping of item |digest| to |files|.
+
+    |files| is a list of (path, file_mode) pairs. The item must have been
+    passed to add() before. Use wait_mapped() to wait for the mapping.
+    """
+    self._mapping.add(digest)
+    with self._lock:
+      if digest in self._pending and digest not in self._written:
+        # The task writing it to the cache will hardlink the files too.
+        self._links.setdefault(digest, []).extend(files)
+        return
+    self._pending[digest] = self._pending.get(digest, 0) + 1
+    self.storage.disk_thread_pool.add_task(
+        threading_utils.PRIORITY_MED,
+        self._channel.wrap_task(self._link), digest, files)
 
   def wait(self, digests):
     """Starts a loop that waits for at least one of |digests| to be retrieved.
@@ -739,7 +907,7 @@ class FetchQueue(object):
     """
     # Flush any already fetched items.
     for digest in digests:
-      if digest in self._fetched:
+      if digest in self._fetched and digest not in self._pending:
         return digest
 
     # Ensure all requested items are being fetched now.
@@ -748,15 +916,22 @@ class FetchQueue(object):
 
     # Wait for some requested item to finish fetching.
     while self._pending:
-      digest = self._channel.pull()
-      self._pending.remove(digest)
-      self._fetched.add(digest)
-      if digest in digests:
+      digest = self._pull()
+      if digest in digests and digest not in self._pending:
         return digest
 
     # Should never reach this point due to assert above.
     raise RuntimeError('Impossible state')
 
+  def wait_mapped(self):
+    """Waits for some item passed to map_files() to be mapped.
+
+    Returns its digest or None if there is no item left to map.
+    """
+    while not self._mapped and self._mapping:
+      self._pull()
+    return self._mapped.pop() if self._mapped else None
+
   def inject_local_file(self, path, algo):
     """Adds local file to the cache as if it was fetched from storage."""
     with open(path, 'rb') as f:
@@ -775,6 +950,40 @@ class FetchQueue(object):
     """True if all accessed items are in cache."""
     return self._accessed.issubset(self.cache.cached_set())
 
+  def _pull(self):
+    """Waits for a fetch or a mapping to finish and returns its digest."""
+    digest = self._channel.pull()
+    self._pending[digest] -= 1
+    if not self._pending[digest]:
+      del self._pending[digest]
+      self._fetched.add(digest)
+      if digest in self._mapping:
+        self._mapping.remove(digest)
+        self._mapped.append(digest)
+      with self._lock:
+        self._written.discard(digest)
+    return digest
+
+  def _write(self, digest, content):
+    """Writes fetched item to the cache and maps the files waiting for it."""
+    self.cache.write(digest, content)
+    with self._lock:
+      self._written.add(digest)
+      files = self._links.pop(digest, None)
+    if files:
+      self._link(digest, files)
+
+  def _link(self, digest, files):
+    """Hardlinks cached item |digest| to |files|."""
+    for path, file_mode in files:
+      try:
+        self.cache.hardlink(digest, path, file_mode)
+      except (IOError, OSError) as e:
+        # Do not let Storage retry the fetch on local errors.
+        raise isolated_format.MappingError(
+            'Failed to map %s to %s: %s' % (digest, path, e))
+    return digest
+
 
 class FetchStreamVerifier(object):
   """Verifies that fetched file is valid before passing it to the LocalCache."""
@@ -1337,9 +1546,11 @@ class CachePolicies(object):
 class DiskCache(LocalCache):
   """Stateful LRU cache in a flat hash table in a directory.
 
-  Saves its state as json file.
+  Saves its state as a compact append-only binary file. The json state file
+  used previously is migrated on load.
   """
-  STATE_FILE = 'state.json'
+  STATE_FILE = 'state.bin'
+  LEGACY_STATE_FILE = 'state.json'
 
   def __init__(self, cache_dir, policies, hash_algo):
     """
@@ -1353,6 +1564,8 @@ class DiskCache(LocalCache):
     self.policies = policies
     self.hash_algo = hash_algo
     self.state_file = os.path.join(cache_dir, self.STATE_FILE)
+    self.legacy_state_file = os.path.join(cache_dir, self.LEGACY_STATE_FILE)
+    self.digest_size = hash_algo().digest_size
 
     # All protected methods (starting with '_') except _path should be called
     # with this lock locked.
@@ -1382,7 +1595,7 @@ class DiskCache(LocalCache):
         logging.info(
             '%5d (%8dkb) current',
             len(self._lru),
-            sum(self._lru.itervalues()) / 1024)
+            self._lru.total_size / 1024)
         logging.info(
             '%5d (%8dkb) removed',
             len(self._removed), sum(self._removed) / 1024)
@@ -1462,7 +1675,7 @@ class DiskCache(LocalCache):
       os.chmod(dest, file_mode & 0500)
 
   def _load(self):
-    """Loads state of the cache from json file."""
+    """Loads state of the cache from the state file."""
     self._lock.assert_locked()
 
     if not os.path.isdir(self.cache_dir):
@@ -1476,17 +1689,24 @@ class DiskCache(LocalCache):
     # Load state of the cache.
     if os.path.isfile(self.state_file):
       try:
-        self._lru = lru.LRUDict.load(self.state_file)
+        self._lru = lru.LRUDict.load_binary(self.state_file, self.digest_size)
       except ValueError as err:
         logging.error('Failed to load cache state: %s' % (err,))
         # Don't want to keep broken state file.
         file_path.try_remove(self.state_file)
+    elif os.path.isfile(self.legacy_state_file):
+      # Migrate from the json state file. The binary state file is written
+      # in full by the _trim() call below.
+      try:
+        self._lru = lru.LRUDict.load(self.legacy_state_file)
+      except ValueError as err:
+        logging.error('Failed to load legacy cache state: %s' % (err,))
 
     # Ensure that all files listed in the state still exist and add new ones.
     previous = self._lru.keys_set()
     unknown = []
     for filename in os.listdir(self.cache_dir):
-      if filename == self.STATE_FILE:
+      if filename in (self.STATE_FILE, self.LEGACY_STATE_FILE):
         continue
       if filename in previous:
         previous.remove(filename)
@@ -1503,7 +1723,7 @@ class DiskCache(LocalCache):
         else:
           file_path.try_remove(p)
         continue
-      # File that's not referenced in 'state.json'.
+      # File that's not referenced in the state file.
       # TODO(vadimsh): Verify its SHA1 matches file name.
       logging.warning('Adding unknown file %s to cache', filename)
       unknown.append(filename)
@@ -1520,6 +1740,10 @@ class DiskCache(LocalCache):
         self._lru.pop(filename)
     self._trim()
 
+    # The state is now saved in the binary state file.
+    if os.path.isfile(self.legacy_state_file):
+      file_path.try_remove(self.legacy_state_file)
+
   def _save(self):
     """Saves the LRU ordering."""
     self._lock.assert_locked()
@@ -1530,7 +1754,7 @@ class DiskCache(LocalCache):
         file_path.set_read_only(d, False)
     if os.path.isfile(self.state_file):
       file_path.set_read_only(self.state_file, False)
-    self._lru.save(self.state_file)
+    self._lru.save_binary(self.state_file, self.digest_size)
 
   def _trim(self):
     """Trims anything we don't know, make sure enough free space exists."""
@@ -1538,16 +1762,17 @@ class DiskCache(LocalCache):
 
     # Ensure maximum cache size.
     if self.policies.max_cache_size:
-      total_size = sum(self._lru.itervalues())
-      while total_size > self.policies.max_cache_size:
-        total_size -= self._remove_lru_file()
+      while self._lru.total_size > self.policies.max_cache_size:
+        self._remove_lru_file()
 
     # Ensure maximum number of items in the cache.
     if self.policies.max_items and len(self._lru) > self.policies.max_items:
       for _ in xrange(len(self._lru) - self.policies.max_items):
         self._remove_lru_file()
 
-    # Ensure enough free space.
+    # Ensure enough free space. Querying the free space is slow so it is
+    # estimated from the size of the evicted files, then verified. The estimate
+    # can be too optimistic when an evicted file is still hardlinked elsewhere.
     self._free_disk = file_path.get_free_space(self.cache_dir)
     trimmed_due_to_space = False
     while (
@@ -1555,10 +1780,11 @@ class DiskCache(LocalCache):
         self._lru and
         self._free_disk < self.policies.min_free_space):
       trimmed_due_to_space = True
-      self._remove_lru_file()
+      while self._lru and self._free_disk < self.policies.min_free_space:
+        self._free_disk += self._remove_lru_file()
       self._free_disk = file_path.get_free_space(self.cache_dir)
     if trimmed_due_to_space:
-      total_usage = sum(self._lru.itervalues())
+      total_usage = self._lru.total_size
       usage_percent = 0.
       if total_usage:
         usage_percent = 100. * self.policies.max_cache_size / float(total_usage)
@@ -1621,6 +1847,9 @@ class IsolatedBundle(object):
     self.relative_cwd = None
     # The main .isolated file, a IsolatedFile instance.
     self.root = None
+    # Arguments of the command as paths relative to the root, the ones that are
+    # in |files| are needed to start it.
+    self.command_files = set()
 
   def fetch(self, fetch_queue, root_isolated_hash, algo):
     """Fetches the .isolated and all the included .isolated.
@@ -1642,7 +1871,9 @@ class IsolatedBundle(object):
 
     As a side effect this method starts asynchronous fetch of all data files
     by adding them to |fetch_queue|. It doesn't wait for data files to finish
-    fetching though.
+    fetching though. The files referenced by the command are fetched first,
+    then the other files from the smallest to the largest, see
+    _get_fetch_priority().
     """
     self.root = isolated_format.IsolatedFile(root_isolated_hash, algo)
 
@@ -1685,16 +1916,15 @@ class IsolatedBundle(object):
           if not node.is_loaded:
             break
           # Not visited and loaded -> process it and continue the traversal.
+          # Extract 'command' and other bundle properties first, so its files
+          # can be prioritized.
+          self._update_self(node)
           self._start_fetching_files(node, fetch_queue)
           processed.add(node)
 
     # All *.isolated files should be processed by now and only them.
     all_isolateds = set(isolated_format.walk_includes(self.root))
     assert all_isolateds == processed, (all_isolateds, processed)
-
-    # Extract 'command' and other bundle properties.
-    for node in isolated_format.walk_includes(self.root):
-      self._update_self(node)
     self.relative_cwd = self.relative_cwd or ''
 
   def _start_fetching_files(self, isolated, fetch_queue):
@@ -1703,16 +1933,35 @@ class IsolatedBundle(object):
     Modifies self.files.
     """
     logging.debug('fetch_files(%s)', isolated.obj_hash)
+    to_fetch = []
     for filepath, properties in isolated.data.get('files', {}).iteritems():
       # Root isolated has priority on the files being mapped. In particular,
       # overridden files must not be fetched.
       if filepath not in self.files:
         self.files[filepath] = properties
         if 'h' in properties:
-          # Preemptively request files.
-          logging.debug('fetching %s', filepath)
-          fetch_queue.add(
-              properties['h'], properties['s'], threading_utils.PRIORITY_MED)
+          to_fetch.append((filepath, properties))
+    # Tasks in the same priority are run in the order they were added.
+    to_fetch.sort(key=lambda (_, properties): properties['s'])
+    for filepath, properties in to_fetch:
+      # Preemptively request files.
+      logging.debug('fetching %s', filepath)
+      fetch_queue.add(
+          properties['h'], properties['s'],
+          self._get_fetch_priority(filepath, properties))
+
+  def _get_fetch_priority(self, filepath, properties):
+    """Returns the priority to fetch a file at.
+
+    The files referenced by the command, like the executable, are needed first.
+    Large data files are often needed last, if ever. Only the command known so
+    far is considered, it is normally defined by the root .isolated file.
+    """
+    if filepath in self.command_files:
+      return threading_utils.PRIORITY_HIGH
+    if properties['s'] > LARGE_FILE_SIZE:
+      return threading_utils.PRIORITY_LOW
+    return threading_utils.PRIORITY_MED
 
   def _update_self(self, node):
     """Extracts bundle global parameters from loaded *.isolated file.
@@ -1732,6 +1981,9 @@ class IsolatedBundle(object):
     if (self.relative_cwd is None and
         node.data.get('relative_cwd') is not None):
       self.relative_cwd = node.data['relative_cwd']
+    self.command_files = set(
+        os.path.normpath(os.path.join(self.relative_cwd or '', arg))
+        for arg in self.command)
 
 
 def set_storage_api_class(cls):
@@ -1808,7 +2060,9 @@ def upload_tree(base_url, infiles, namespace):
     storage.upload_items(items)
 
 
-def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
+def fetch_isolated(
+    isolated_hash, storage, cache, outdir, require_command,
+    on_command_mapped=None):
   """Aggressively downloads the .isolated file(s), then download all the files.
 
   Arguments:
@@ -1817,6 +2071,9 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
     cache: LocalCache class that knows how to store and map files locally.
     outdir: Output directory to map file tree to.
     require_command: Ensure *.isolated specifies a command to run.
+    on_command_mapped: optional function called with the IsolatedBundle once
+        the files referenced by its command are mapped, while the other files
+        are still being mapped.
 
   Returns:
     IsolatedBundle object that holds details about loaded *.isolated file.
@@ -1860,11 +2117,28 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
       if not os.path.isdir(cwd):
         os.makedirs(cwd)
 
-      # Multimap: digest -> list of pairs (path, props).
+      # Map the files as soon as their item is in the cache. The hardlinks are
+      # done by the threads writing to the cache, the main thread only waits
+      # and reports progress.
       remaining = {}
+      sizes = {}
+      remaining_files = 0
+      remaining_size = 0
       for filepath, props in bundle.files.iteritems():
         if 'h' in props:
-          remaining.setdefault(props['h'], []).append((filepath, props))
+          remaining.setdefault(props['h'], []).append(
+              (os.path.join(outdir, filepath), props.get('m')))
+          sizes[props['h']] = props['s']
+          remaining_files += 1
+          remaining_size += props['s']
+      for digest, files in remaining.iteritems():
+        fetch_queue.map_files(digest, files)
+      # Items needed to start the command.
+      required = set(
+          bundle.files[f]['h'] for f in bundle.command_files
+          if 'h' in bundle.files.get(f, {}))
+      if on_command_mapped and not required:
+        on_command_mapped(bundle)
 
       # Now block on the remaining files to be downloaded and mapped.
       logging.info('Retrieving remaining files (%d of them)...',
@@ -1874,18 +2148,21 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
         while remaining:
           detector.ping()
 
-          # Wait for any item to finish fetching to cache.
-          digest = fetch_queue.wait(remaining)
-
-          # Link corresponding files to a fetched item in cache.
-          for filepath, props in remaining.pop(digest):
-            cache.hardlink(
-                digest, os.path.join(outdir, filepath), props.get('m'))
+          # Wait for any item to be fetched to cache and mapped.
+          digest = fetch_queue.wait_mapped()
+          files = remaining.pop(digest)
+          remaining_files -= len(files)
+          remaining_size -= len(files) * sizes[digest]
+          if on_command_mapped and digest in required:
+            required.remove(digest)
+            if not required:
+              on_command_mapped(bundle)
 
           # Report progress.
           duration = time.time() - last_update
           if duration > DELAY_BETWEEN_UPDATES_IN_SECS:
-            msg = '%d files remaining...' % len(remaining)
+            msg = '%d files (%.1fmb) remaining...' % (
+                remaining_files, remaining_size / 1024. / 1024)
             print msg
             logging.info(msg)
             last_update = time.time()
@@ -1899,25 +2176,32 @@ def fetch_isolated(isolated_hash, storage, cache, outdir, require_command):
 
 def directory_to_metadata(root, algo, blacklist):
   """Returns the FileItem list and .isolated metadata for a directory."""
+  metadata = {}
+  items = list(iter_directory_to_metadata(root, algo, blacklist, metadata))
+  return items, metadata
+
+
+def iter_directory_to_metadata(root, algo, blacklist, metadata):
+  """Yields the FileItem of the files in a directory as they are hashed.
+
+  The files are hashed in parallel. |metadata| is filled with the .isolated
+  metadata of each file and is complete once the generator is exhausted.
+  """
   root = file_path.get_native_path_case(root)
   paths = isolated_format.expand_directory_and_symlink(
       root, '.' + os.path.sep, blacklist, sys.platform != 'win32')
-  metadata = {
-    relpath: isolated_format.file_to_metadata(
-        os.path.join(root, relpath), {}, 0, algo)
-    for relpath in paths
-  }
-  for v in metadata.itervalues():
-    v.pop('t')
-  items = [
-      FileItem(
-          path=os.path.join(root, relpath),
+  relpaths = {os.path.join(root, relpath): relpath for relpath in paths}
+  for filepath, meta in isolated_format.iter_file_to_metadata(
+      ((filepath, {}) for filepath in relpaths), 0, algo):
+    meta.pop('t')
+    relpath = relpaths[filepath]
+    metadata[relpath] = meta
+    if 'h' in meta:
+      yield FileItem(
+          path=filepath,
           digest=meta['h'],
           size=meta['s'],
           high_priority=relpath.endswith('.isolated'))
-      for relpath, meta in metadata.iteritems() if 'h' in meta
-  ]
-  return items, metadata
 
 
 def archive_files_to_storage(storage, files, blacklist):
@@ -1935,22 +2219,25 @@ def archive_files_to_storage(storage, files, blacklist):
 
   results = []
   # The temporary directory is only created as needed.
-  tempdir = None
-  try:
-    # TODO(maruel): Yield the files to a worker thread.
-    items_to_upload = []
+  tempdir = []
+
+  def items_to_upload():
+    """Yields the items as they are hashed, so the uploads start right away."""
     for f in files:
       try:
         filepath = os.path.abspath(f)
         if os.path.isdir(filepath):
           # Uploading a whole directory.
-          items, metadata = directory_to_metadata(
-              filepath, storage.hash_algo, blacklist)
+          metadata = {}
+          for item in iter_directory_to_metadata(
+              filepath, storage.hash_algo, blacklist, metadata):
+            yield item
 
           # Create the .isolated file.
           if not tempdir:
-            tempdir = tempfile.mkdtemp(prefix=u'isolateserver')
-          handle, isolated = tempfile.mkstemp(dir=tempdir, suffix=u'.isolated')
+            tempdir.append(tempfile.mkdtemp(prefix=u'isolateserver'))
+          handle, isolated = tempfile.mkstemp(
+              dir=tempdir[0], suffix=u'.isolated')
           os.close(handle)
           data = {
               'algo':
@@ -1960,35 +2247,36 @@ def archive_files_to_storage(storage, files, blacklist):
           }
           isolated_format.save_isolated(isolated, data)
           h = isolated_format.hash_file(isolated, storage.hash_algo)
-          items_to_upload.extend(items)
-          items_to_upload.append(
-              FileItem(
-                  path=isolated,
-                  digest=h,
-                  size=os.stat(isolated).st_size,
-                  high_priority=True))
+          yield FileItem(
+              path=isolated,
+              digest=h,
+              size=os.stat(isolated).st_size,
+              high_priority=True)
           results.append((h, f))
 
         elif os.path.isfile(filepath):
-          h = isolated_format.hash_file(filepath, storage.hash_algo)
-          items_to_upload.append(
-            FileItem(
-                path=filepath,
-                digest=h,
-                size=os.stat(filepath).st_size,
-                high_priority=f.endswith('.isolated')))
+          filestats = os.stat(filepath)
+          h = isolated_format.hash_file_cached(
+              filepath, filestats, storage.hash_algo)
+          yield FileItem(
+              path=filepath,
+              digest=h,
+              size=filestats.st_size,
+              high_priority=f.endswith('.isolated'))
           results.append((h, f))
         else:
           raise Error('%s is neither a file or directory.' % f)
       except OSError:
         raise Error('Failed to process %s.' % f)
+
+  try:
     # Technically we would care about which files were uploaded but we don't
     # much in practice.
-    _uploaded_files = storage.upload_items(items_to_upload)
+    _uploaded_files = storage.upload_items(items_to_upload())
     return results
   finally:
-    if tempdir and os.path.isdir(tempdir):
-      file_path.rmtree(tempdir)
+    if tempdir and os.path.isdir(tempdir[0]):
+      file_path.rmtree(tempdir[0])
 
 
 def archive(out, namespace, files, blacklist):
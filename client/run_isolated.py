@@ -21,6 +21,7 @@ import optparse
 import os
 import sys
 import tempfile
+import threading
 
 from third_party.depot_tools import fix_encoding
 
@@ -28,6 +29,7 @@ from utils import file_path
 from utils import logging_utils
 from utils import on_error
 from utils import subprocess42
+from utils import threading_utils
 from utils import tools
 from utils import zip_package
 
@@ -130,7 +132,47 @@ def process_command(command, out_dir):
   return filtered
 
 
-def run_tha_test(isolated_hash, storage, cache, leak_temp_dir, extra_args):
+def fetch_isolated_early(isolated_hash, storage, cache, outdir):
+  """Maps the isolated tree in a background thread.
+
+  Returns the IsolatedBundle as soon as the files referenced by its command are
+  mapped, along with a function that waits for the other files to be mapped.
+  Both raise the exceptions of isolateserver.fetch_isolated().
+  """
+  channel = threading_utils.TaskChannel()
+  def fetch():
+    try:
+      isolateserver.fetch_isolated(
+          isolated_hash=isolated_hash,
+          storage=storage,
+          cache=cache,
+          outdir=outdir,
+          require_command=True,
+          on_command_mapped=channel.send_result)
+    except Exception:
+      channel.send_exception()
+      return
+    channel.send_result(None)
+
+  thread = threading.Thread(target=fetch, name='fetch_isolated')
+  thread.daemon = True
+  thread.start()
+  bundle = channel.pull()
+
+  waited = []
+  def wait():
+    if not waited:
+      waited.append(True)
+      try:
+        channel.pull()
+      finally:
+        thread.join()
+  return bundle, wait
+
+
+def run_tha_test(
+    isolated_hash, storage, cache, leak_temp_dir, extra_args,
+    start_early=False):
   """Downloads the dependencies in the cache, hardlinks them into a temporary
   directory and runs the executable from there.
 
@@ -151,24 +193,34 @@ def run_tha_test(isolated_hash, storage, cache, leak_temp_dir, extra_args):
                    for later examination.
     extra_args: optional arguments to add to the command stated in the .isolate
                 file.
+    start_early: if true, the command is started as soon as the files it
+                 references are mapped, while the other files are still being
+                 mapped.
   """
   tmp_root = os.path.dirname(cache.cache_dir) if cache.cache_dir else None
   run_dir = make_temp_dir(u'run_tha_test', tmp_root)
   out_dir = unicode(make_temp_dir(u'isolated_out', tmp_root))
   result = 0
+  # Waits for the rest of the tree to be mapped when starting early.
+  wait_mapped = None
   try:
     try:
-      bundle = isolateserver.fetch_isolated(
-          isolated_hash=isolated_hash,
-          storage=storage,
-          cache=cache,
-          outdir=run_dir,
-          require_command=True)
+      if start_early:
+        bundle, wait_mapped = fetch_isolated_early(
+            isolated_hash, storage, cache, run_dir)
+      else:
+        bundle = isolateserver.fetch_isolated(
+            isolated_hash=isolated_hash,
+            storage=storage,
+            cache=cache,
+            outdir=run_dir,
+            require_command=True)
     except isolated_format.IsolatedError:
       on_error.report(None)
       return 1
 
-    change_tree_read_only(run_dir, bundle.read_only)
+    if not wait_mapped:
+      change_tree_read_only(run_dir, bundle.read_only)
     cwd = os.path.normpath(os.path.join(run_dir, bundle.relative_cwd))
     command = bundle.command + extra_args
 
@@ -187,8 +239,15 @@ def run_tha_test(isolated_hash, storage, cache, leak_temp_dir, extra_args):
     with tools.Profiler('RunTest'):
       try:
         with subprocess42.Popen_with_handler(command, cwd=cwd, env=env) as p:
+          if wait_mapped:
+            # The process is killed if the rest of the tree fails to map.
+            wait_mapped()
+            change_tree_read_only(run_dir, bundle.read_only)
           p.communicate()
           result = p.returncode
+      except (isolated_format.IsolatedError, isolated_format.MappingError):
+        on_error.report(None)
+        result = 1
       except OSError:
         on_error.report('Failed to run %s; cwd=%s' % (command, cwd))
         result = 1
@@ -197,6 +256,12 @@ def run_tha_test(isolated_hash, storage, cache, leak_temp_dir, extra_args):
         result, hex(0xffffffff & result))
   finally:
     try:
+      if wait_mapped:
+        # Do not delete the tree while it's being mapped.
+        try:
+          wait_mapped()
+        except (isolated_format.IsolatedError, isolated_format.MappingError):
+          result = result or 1
       if leak_temp_dir:
         logging.warning('Deliberately leaking %s for later examination',
                         run_dir)
@@ -304,6 +369,13 @@ def main(args):
           '[default: %default]')
   parser.add_option_group(debug_group)
 
+  parser.add_option(
+      '--start-early',
+      action='store_true',
+      help='Start the command as soon as the files it references are mapped, '
+           'while the other files are still being mapped. The command must not '
+           'need the other files right away.')
+
   auth.add_auth_options(parser)
   options, args = parser.parse_args(args)
   if not options.isolated:
@@ -317,7 +389,8 @@ def main(args):
     # Hashing schemes used by |storage| and |cache| MUST match.
     assert storage.hash_algo == cache.hash_algo
     return run_tha_test(
-        options.isolated, storage, cache, options.leak_temp_dir, args)
+        options.isolated, storage, cache, options.leak_temp_dir, args,
+        options.start_early)
 
 
 if __name__ == '__main__':
@@ -227,6 +227,10 @@ def isolated_handle_options(options, args):
 ### Triggering.
 
 
+# Maximum number of tasks to trigger in a single request.
+MAX_TRIGGER_TASKS = 100
+
+
 TaskRequest = collections.namedtuple(
     'TaskRequest',
     [
@@ -311,6 +315,32 @@ def swarming_trigger(swarming, raw_request, xsrf_token):
   return result
 
 
+def swarming_trigger_many(
+    swarming, raw_requests, xsrf_token, error_codes=None):
+  """Triggers many requests on the Swarming server in a single call.
+
+  It's the low-level function. error_codes is an optional list the HTTP status
+  codes of the errors are appended to.
+
+  Returns:
+    List of the same items as returned by swarming_trigger(), in the same order
+    as raw_requests. None in case of failure, in which case no task was
+    triggered.
+  """
+  logging.info('Triggering %d tasks', len(raw_requests))
+
+  headers = {'X-XSRF-Token': xsrf_token}
+  result = net.url_read_json(
+      swarming + '/swarming/api/v1/client/requests',
+      data={'requests': raw_requests},
+      headers=headers,
+      error_codes=error_codes)
+  if not result or len(result.get('tasks') or []) != len(raw_requests):
+    logging.warning('Failed to trigger %d tasks at once', len(raw_requests))
+    return None
+  return result['tasks']
+
+
 def setup_googletest(env, shards, index):
   """Sets googletest specific environment variables."""
   if shards > 1:
@@ -323,6 +353,10 @@ def setup_googletest(env, shards, index):
 def trigger_task_shards(swarming, task_request, shards):
   """Triggers one or many subtasks of a sharded task.
 
+  The shards are triggered by batches of MAX_TRIGGER_TASKS when the server
+  supports it, falling back to one request per shard if it returns HTTP 404 or
+  405.
+
   Returns:
     Dict with task details, returned to caller as part of --dump-json output.
     None in case of failure.
@@ -339,12 +373,33 @@ def trigger_task_shards(swarming, task_request, shards):
   xsrf_token = swarming_handshake(swarming)
   if not xsrf_token:
     return None
+
+  def iter_triggered():
+    """Yields the triggered tasks in order, stops at the first failure."""
+    start = 0
+    if len(requests) > 1:
+      while start < len(requests):
+        batch = requests[start:start+MAX_TRIGGER_TASKS]
+        error_codes = []
+        results = swarming_trigger_many(
+            swarming, batch, xsrf_token, error_codes)
+        if not results:
+          if start or error_codes[-1:] not in ([404], [405]):
+            return
+          # An older server without the batch API, fallback below.
+          break
+        for task in results:
+          yield task
+        start += len(batch)
+    for request in requests[start:]:
+      task = swarming_trigger(swarming, request, xsrf_token)
+      if not task:
+        return
+      yield task
+
   tasks = {}
   priority_warning = False
-  for index, request in enumerate(requests):
-    task = swarming_trigger(swarming, request, xsrf_token)
-    if not task:
-      break
+  for index, (request, task) in enumerate(zip(requests, iter_triggered())):
     logging.info('Request result: %s', task)
     if (not priority_warning and
         task['request']['priority'] != task_request.priority):
@@ -375,6 +430,19 @@ def trigger_task_shards(swarming, task_request, shards):
 # How often to print status updates to stdout in 'collect'.
 STATUS_UPDATE_INTERVAL = 15 * 60.
 
+# Number of seconds the server is asked to block when waiting for tasks. It must
+# be lower than net.URL_READ_TIMEOUT.
+LONG_POLL_TIMEOUT = 30.
+
+# Maximum number of tasks to wait for in a single request.
+MAX_WAIT_TASKS = 1000
+
+# Number of consecutive failed requests to wait for tasks before giving up.
+MAX_WAIT_ERRORS = 10
+
+# Maximum number of outputs of completed tasks fetched in parallel.
+MAX_FETCH_THREADS = 64
+
 
 class State(object):
   """States in which a task can be.
@@ -585,6 +653,35 @@ def now():
   return time.time()
 
 
+def fetch_outputs(output_url, outputs, offsets):
+  """Fetches the output of a task not already in outputs, page by page.
+
+  Only the output after offsets is fetched, so polling a running task only
+  transfers the new output. outputs and offsets are lists updated in place.
+
+  Returns False if fetching failed.
+  """
+  while True:
+    url = output_url
+    if offsets:
+      url += '?offsets=' + ','.join(str(i) for i in offsets)
+    out = net.url_read_json(url)
+    if not out:
+      return False
+    if 'next_offsets' not in out:
+      # Old server that always returns the whole output.
+      outputs[:] = out.get('outputs', [])
+      return True
+    for i, output in enumerate(out.get('outputs', [])):
+      if i == len(outputs):
+        outputs.append(output)
+      elif output:
+        outputs[i] = (outputs[i] or '') + output
+    offsets[:] = out['next_offsets']
+    if not out.get('more'):
+      return True
+
+
 def retrieve_results(
     base_url, shard_index, task_id, timeout, should_stop, output_collector):
   """Retrieves results for a single task ID.
@@ -600,6 +697,9 @@ def retrieve_results(
   started = now()
   deadline = started + timeout if timeout else None
   attempt = 0
+  # Output fetched so far while the task was running.
+  outputs = []
+  offsets = []
 
   while not should_stop.is_set():
     attempt += 1
@@ -629,16 +729,33 @@ def retrieve_results(
     result = net.url_read_json(result_url, retry_50x=False)
     if not result:
       continue
-    if result['state'] in State.STATES_NOT_RUNNING:
-      out = net.url_read_json(output_url)
-      result['outputs'] = (out or {}).get('outputs', [])
-      if not result['outputs']:
-        logging.error('No output found for task %s', task_id)
-      # Record the result, try to fetch attached output files (if any).
-      if output_collector:
-        # TODO(vadimsh): Respect |should_stop| and |deadline| when fetching.
-        output_collector.process_shard_result(shard_index, result)
-      return result
+    if result['state'] == State.RUNNING:
+      # Only fetch the new output.
+      fetch_outputs(output_url, outputs, offsets)
+    elif result['state'] in State.STATES_NOT_RUNNING:
+      return complete_result(
+          base_url, shard_index, task_id, result, output_collector, outputs,
+          offsets)
+
+
+def complete_result(
+    base_url, shard_index, task_id, result, output_collector, outputs,
+    offsets):
+  """Fetches the output of a task not running anymore and returns its result.
+
+  outputs and offsets are the output already fetched, if any.
+  """
+  output_url = '%s/swarming/api/v1/client/task/%s/output/all' % (
+      base_url, task_id)
+  fetch_outputs(output_url, outputs, offsets)
+  result['outputs'] = outputs
+  if not result['outputs']:
+    logging.error('No output found for task %s', task_id)
+  # Record the result, try to fetch attached output files (if any).
+  if output_collector:
+    # TODO(vadimsh): Respect |should_stop| and |deadline| when fetching.
+    output_collector.process_shard_result(shard_index, result)
+  return result
 
 
 def yield_results(
@@ -650,9 +767,13 @@ def yield_results(
   Timed out shards are NOT yielded at all. Caller can compare number of yielded
   shards with len(task_keys) to verify all shards completed.
 
+  Waits for all the shards with a single connection by long-polling the server,
+  while the outputs of the completed shards are fetched in parallel. Falls back
+  to yield_results_polling() if the server doesn't support it, i.e. returns HTTP
+  404 or 405. Gives up after MAX_WAIT_ERRORS consecutive failures.
+
   max_threads is optional and is used to limit the number of parallel fetches
-  done. Since in general the number of task_keys is in the range <=10, it's not
-  worth normally to limit the number threads. Mostly used for testing purposes.
+  done.
 
   output_collector is an optional instance of TaskOutputCollector that will be
   used to fetch files produced by a task from isolate server to the local disk.
@@ -661,6 +782,133 @@ def yield_results(
     (index, result). In particular, 'result' is defined as the
     GetRunnerResults() function in services/swarming/server/test_runner.py.
   """
+  wait_url = '%s/swarming/api/v1/client/tasks/wait' % swarm_base_url
+  shards = {}
+  for shard_index, task_id in enumerate(task_ids):
+    shards.setdefault(task_id, shard_index)
+  started = now()
+  deadline = started + timeout if timeout else None
+  next_status = started + STATUS_UPDATE_INTERVAL
+  # Set once the server answered, so it supports long-polling.
+  supported = False
+  errors = 0
+
+  number_threads = max(
+      1, min(max_threads or MAX_FETCH_THREADS, MAX_FETCH_THREADS,
+             len(task_ids)))
+  results_channel = threading_utils.TaskChannel()
+  # Number of outputs being fetched in the thread pool.
+  fetching = 0
+
+  with threading_utils.ThreadPool(0, number_threads, 0) as pool:
+    while shards or fetching:
+      # Yields the shards whose output was fetched. Only blocks once all the
+      # shards completed.
+      while fetching:
+        try:
+          shard_index, result = results_channel.pull(
+              timeout=0 if shards else STATUS_UPDATE_INTERVAL)
+        except threading_utils.TaskChannel.Timeout:
+          if shards:
+            break
+          continue
+        except Exception:
+          logging.exception('Unexpected exception in complete_result')
+          shard_index, result = None, None
+        fetching -= 1
+        if result:
+          yield shard_index, result
+      if not shards:
+        break
+
+      current_time = now()
+      if deadline and current_time >= deadline:
+        logging.error('yield_results(%s) timed out', swarm_base_url)
+        # Still yield the outputs being fetched.
+        shards.clear()
+        continue
+      if print_status_updates and current_time >= next_status:
+        next_status = current_time + STATUS_UPDATE_INTERVAL
+        print(
+            'Waiting for results from the following shards: %s' %
+            ', '.join(str(i) for i in sorted(shards.itervalues())))
+        sys.stdout.flush()
+
+      # Only the last batch blocks, the others are merely checked.
+      ids = sorted(shards, key=shards.get)
+      batches = [
+        ids[i:i+MAX_WAIT_TASKS] for i in xrange(0, len(ids), MAX_WAIT_TASKS)
+      ]
+      results = {}
+      failed = False
+      error_codes = []
+      for i, batch in enumerate(batches):
+        wait = 0.
+        if i == len(batches) - 1 and not results:
+          wait = LONG_POLL_TIMEOUT
+          if deadline:
+            wait = max(0., min(wait, deadline - current_time))
+        data = net.url_read_json(
+            wait_url, data={'task_ids': batch, 'timeout': wait},
+            retry_50x=False, error_codes=error_codes)
+        if data is None:
+          failed = True
+          break
+        results.update(data.get('results') or {})
+
+      if failed:
+        if (not supported and not fetching and error_codes and
+            error_codes[-1] in (404, 405)):
+          logging.info('Long-polling is not supported, polling each task')
+          for item in yield_results_polling(
+              swarm_base_url, task_ids, timeout, max_threads,
+              print_status_updates, output_collector):
+            yield item
+          return
+        errors += 1
+        if errors >= MAX_WAIT_ERRORS:
+          logging.error(
+              'yield_results(%s) failed %d times in a row, last HTTP error: %s',
+              swarm_base_url, errors,
+              error_codes[-1] if error_codes else 'none')
+          shards.clear()
+          continue
+        # Do not spin too fast on transient errors, back off exponentially.
+        delay = min(15., 2.**(errors - 1))
+        if deadline:
+          delay = min(delay, max(0., deadline - now()))
+        time.sleep(delay)
+        continue
+      supported = True
+      errors = 0
+
+      for task_id, result in sorted(results.iteritems()):
+        shard_index = shards.pop(task_id, None)
+        if shard_index is None:
+          continue
+        if not result:
+          logging.error('Failed to retrieve the results for %s', task_id)
+          continue
+        # Fetch the outputs in parallel.
+        task_fn = lambda *args: (args[1], complete_result(*args))
+        pool.add_task(
+            0, results_channel.wrap_task(task_fn), swarm_base_url, shard_index,
+            task_id, result, output_collector, [], [])
+        fetching += 1
+
+
+def yield_results_polling(
+    swarm_base_url, task_ids, timeout, max_threads, print_status_updates,
+    output_collector):
+  """Yields swarming task results by polling each task in its own thread.
+
+  Used with servers that don't support long-polling. See yield_results() for
+  the arguments.
+
+  max_threads is optional and is used to limit the number of parallel fetches
+  done. Since in general the number of task_keys is in the range <=10, it's not
+  worth normally to limit the number threads. Mostly used for testing purposes.
+  """
   number_threads = (
       min(max_threads, len(task_ids)) if max_threads else len(task_ids))
   should_stop = threading.Event()
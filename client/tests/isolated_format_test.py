@@ -10,6 +10,7 @@ import os
 import shutil
 import sys
 import tempfile
+import time
 import unittest
 
 # net_utils adjusts sys.path.
@@ -239,6 +240,176 @@ class TestIsolated(auto_stub.TestCase):
     self.assertEqual([('foo', data, True)], calls)
 
 
+class HashTest(auto_stub.TestCase):
+  def setUp(self):
+    super(HashTest, self).setUp()
+    self.tempdir = tempfile.mkdtemp(prefix=u'isolated_format')
+    self.cache_dir = os.path.join(self.tempdir, 'hash_cache')
+    self.mock(os, 'environ', dict(os.environ))
+    os.environ['ISOLATED_HASH_CACHE'] = self.cache_dir
+    self.mock(isolated_format, '_hash_caches', {})
+
+  def tearDown(self):
+    try:
+      shutil.rmtree(self.tempdir)
+    finally:
+      super(HashTest, self).tearDown()
+
+  def write(self, name, content, age=60):
+    """Writes a file last modified |age| seconds ago."""
+    path = os.path.join(self.tempdir, name)
+    with open(path, 'wb') as f:
+      f.write(content)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+  def new_cache(self, **kwargs):
+    return isolated_format.HashCache(
+        os.path.join(self.cache_dir, 'sha-1.bin'), hashlib.sha1, **kwargs)
+
+  def test_hash_file(self):
+    # Spans multiple chunks, the last one is partial.
+    content = 'x' * (isolated_format.DISK_FILE_CHUNK + 3)
+    for c in ('', 'a', content):
+      path = self.write('file', c)
+      self.assertEqual(
+          hashlib.sha1(c).hexdigest(),
+          isolated_format.hash_file(path, hashlib.sha1))
+
+  def test_iter_file_to_metadata(self):
+    files = {
+      self.write('file%d' % i, 'content %d' % i): 'content %d' % i
+      for i in xrange(20)
+    }
+    actual = dict(
+        isolated_format.iter_file_to_metadata(
+            ((path, {}) for path in files), None, hashlib.sha1))
+    self.assertEqual(sorted(files), sorted(actual))
+    for path, content in files.iteritems():
+      self.assertEqual(hashlib.sha1(content).hexdigest(), actual[path]['h'])
+      self.assertEqual(len(content), actual[path]['s'])
+
+  def test_iter_file_to_metadata_missing(self):
+    path = os.path.join(self.tempdir, 'missing')
+    with self.assertRaises(isolated_format.MappingError):
+      list(isolated_format.iter_file_to_metadata(
+          [(path, {})], None, hashlib.sha1))
+
+  def test_hash_cache(self):
+    path = self.write('file', 'content')
+    digest = hashlib.sha1('content').hexdigest()
+    cache = self.new_cache()
+    self.assertEqual(None, cache.get(os.stat(path)))
+    cache.add(os.stat(path), digest)
+    self.assertEqual(digest, cache.get(os.stat(path)))
+    cache.save()
+
+    # Another process sees it, and stops seeing it once the file is modified.
+    cache = self.new_cache()
+    self.assertEqual(digest, cache.get(os.stat(path)))
+    self.write('file', 'content', age=30)
+    self.assertEqual(None, cache.get(os.stat(path)))
+
+  def test_hash_cache_racy(self):
+    # A file just modified is not cached.
+    path = self.write('file', 'content', age=0)
+    cache = self.new_cache()
+    cache.add(os.stat(path), hashlib.sha1('content').hexdigest())
+    self.assertEqual(None, cache.get(os.stat(path)))
+
+  def test_hash_cache_append_and_compact(self):
+    paths = [self.write('file%d' % i, str(i)) for i in xrange(5)]
+    for i, path in enumerate(paths):
+      cache = self.new_cache(max_items=3)
+      cache.add(os.stat(path), hashlib.sha1(str(i)).hexdigest())
+      cache.save()
+    cache = self.new_cache(max_items=3)
+    self.assertEqual(
+        [None, None] + [hashlib.sha1(str(i)).hexdigest() for i in xrange(2, 5)],
+        [cache.get(os.stat(p)) for p in paths])
+    # Entries are appended until there are too many records.
+    record_size = 8 * 5 + 20
+    size = os.stat(cache.state_file).st_size
+    self.assertEqual(9 + 5 * record_size, size)
+
+    # A truncated trailing record is ignored.
+    with open(cache.state_file, 'ab') as f:
+      f.write('x' * 10)
+    cache = self.new_cache(max_items=3)
+    self.assertEqual(
+        hashlib.sha1('4').hexdigest(), cache.get(os.stat(paths[4])))
+
+    # It is compacted before anything is appended to it.
+    path = self.write('file5', '5')
+    cache.add(os.stat(path), hashlib.sha1('5').hexdigest())
+    cache.save()
+    self.assertEqual(
+        9 + 3 * record_size, os.stat(cache.state_file).st_size)
+    self.assertEqual(
+        hashlib.sha1('5').hexdigest(), self.new_cache().get(os.stat(path)))
+
+  def test_hash_cache_append_truncated(self):
+    # Another process left a truncated record after this one loaded the file.
+    paths = [self.write('file%d' % i, str(i)) for i in xrange(2)]
+    cache = self.new_cache()
+    cache.add(os.stat(paths[0]), hashlib.sha1('0').hexdigest())
+    cache.save()
+    with open(cache.state_file, 'ab') as f:
+      f.write('x' * 10)
+    cache.add(os.stat(paths[1]), hashlib.sha1('1').hexdigest())
+    cache.save()
+    cache = self.new_cache()
+    self.assertEqual(
+        [hashlib.sha1(str(i)).hexdigest() for i in xrange(2)],
+        [cache.get(os.stat(p)) for p in paths])
+
+  def test_hash_cache_mtime_restored(self):
+    # A file rewritten with the same size and its mtime restored is not a hit,
+    # since its ctime changed.
+    path = self.write('file', 'content')
+    mtime = os.stat(path).st_mtime
+    cache = self.new_cache()
+    cache.add(os.stat(path), hashlib.sha1('content').hexdigest())
+    time.sleep(0.01)
+    with open(path, 'wb') as f:
+      f.write('CONTENT')
+    os.utime(path, (mtime, mtime))
+    self.assertEqual(None, cache.get(os.stat(path)))
+
+  def test_hash_cache_broken(self):
+    os.mkdir(self.cache_dir)
+    cache = self.new_cache()
+    with open(cache.state_file, 'wb') as f:
+      f.write('garbage')
+    path = self.write('file', 'content')
+    cache.add(os.stat(path), hashlib.sha1('content').hexdigest())
+    cache.save()
+    # The broken file is replaced.
+    self.assertEqual(
+        hashlib.sha1('content').hexdigest(),
+        self.new_cache().get(os.stat(path)))
+
+  def test_file_to_metadata_hash_cache(self):
+    path = self.write('file', 'content')
+    calls = []
+    def hash_file(filepath, algo):
+      calls.append(filepath)
+      return hashlib.sha1('content').hexdigest()
+    self.mock(isolated_format, 'hash_file', hash_file)
+    expected = hashlib.sha1('content').hexdigest()
+    for _ in xrange(2):
+      out = isolated_format.file_to_metadata(path, {}, None, hashlib.sha1)
+      self.assertEqual(expected, out['h'])
+    self.assertEqual([path], calls)
+    isolated_format.save_hash_caches()
+    self.assertTrue(os.path.isfile(os.path.join(self.cache_dir, 'sha-1.bin')))
+
+  def test_hash_cache_disabled(self):
+    os.environ['ISOLATED_HASH_CACHE'] = ''
+    self.assertEqual(None, isolated_format.get_hash_cache(hashlib.sha1))
+
+
 if __name__ == '__main__':
   if '-v' in sys.argv:
     unittest.TestCase.maxDiff = None
@@ -272,6 +272,40 @@ class StorageTest(TestCase):
         self.assertEqual(
             [expected_push] * attempts, storage_api.push_calls)
 
+  def test_async_fetch_staged(self):
+    fetches = []
+    def fetch(digest, offset=0):
+      fetches.append(digest)
+      if len(fetches) == 1:
+        # The first download is corrupted, it's fetched again.
+        return ['Corrupted']
+      return [zlib.compress('1234567')]
+
+    storage_api = MockedStorageApi({}, namespace='default-gzip')
+    self.mock(storage_api, 'fetch', fetch)
+    storage = isolateserver.Storage(storage_api)
+    channel = threading_utils.TaskChannel()
+    written = []
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, 'digest', 7,
+        lambda content: written.append(''.join(content)))
+    self.assertEqual('digest', channel.pull())
+    self.assertEqual(['digest', 'digest'], fetches)
+    self.assertEqual(['1234567'], written)
+    storage.close()
+
+  def test_async_fetch_staged_bad_size(self):
+    storage_api = MockedStorageApi({}, namespace='default-gzip')
+    self.mock(
+        storage_api, 'fetch', lambda *_: [zlib.compress('1234567')])
+    storage = isolateserver.Storage(storage_api)
+    channel = threading_utils.TaskChannel()
+    storage.async_fetch(
+        channel, threading_utils.PRIORITY_MED, 'digest', 6, lambda _: None)
+    with self.assertRaises(IOError):
+      channel.pull()
+    storage.close()
+
   def test_upload_tree(self):
     files = {
       '/a': {
@@ -691,6 +725,16 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
   def test_upload_items(self):
     self.run_upload_items_test('default')
 
+  def test_upload_items_generator(self):
+    # Items are checked and uploaded while they are produced.
+    storage = isolateserver.get_storage(self.server.url, 'default')
+    items = [
+        isolateserver.BufferItem('generated item %d' % i) for i in xrange(100)
+    ]
+    uploaded = storage.upload_items(i for i in items + items[:10])
+    self.assertEqual(set(items), set(uploaded))
+    self.assertFalse(dict(storage.get_missing_items(iter(items))))
+
   def test_upload_items_gzip(self):
     self.run_upload_items_test('default-gzip')
 
@@ -765,6 +809,84 @@ class IsolateServerStorageSmokeTest(unittest.TestCase):
       self.assertEqual(expected, self.server.contents)
 
 
+class FetchQueueTest(TestCase):
+  def test_map_files(self):
+    cached = isolateserver_mock.hash_content('cached')
+    fetched = isolateserver_mock.hash_content('fetched')
+    contents = {cached: 'cached', fetched: 'fetched'}
+    storage_api = MockedStorageApi({})
+    self.mock(storage_api, 'fetch', lambda digest, *_: [contents[digest]])
+    storage = isolateserver.Storage(storage_api)
+    cache = isolateserver.MemoryCache()
+    cache.write(cached, ['cached'])
+    queue = isolateserver.FetchQueue(storage, cache)
+    queue.add(cached, 6)
+    queue.add(fetched, 7)
+
+    files = {}
+    for digest in (cached, fetched):
+      files[digest] = [
+        (os.path.join(self.tempdir, '%s_%d' % (digest, i)), None)
+        for i in xrange(2)
+      ]
+      queue.map_files(digest, files[digest])
+    self.assertEqual(
+        set([cached, fetched]),
+        set([queue.wait_mapped(), queue.wait_mapped()]))
+    self.assertEqual(None, queue.wait_mapped())
+    self.assertEqual(0, queue.pending_count)
+    storage.close()
+
+    for digest, paths in files.iteritems():
+      for path, _ in paths:
+        with open(path, 'rb') as f:
+          self.assertEqual(contents[digest], f.read())
+
+
+class IsolatedBundleTest(TestCase):
+  def test_fetch_priority(self):
+    h = isolateserver_mock.hash_content
+    isolated = {
+      'command': ['../bin/run', 'arg'],
+      'files': {
+        os.path.join('bin', 'run'): {'h': h('run'), 's': 2048},
+        'large': {'h': h('large'), 's': isolateserver.LARGE_FILE_SIZE + 1},
+        'medium': {'h': h('medium'), 's': 1024},
+        'small': {'h': h('small'), 's': 1},
+      },
+      'relative_cwd': 'a',
+      'version': isolated_format.ISOLATED_FILE_VERSION,
+    }
+    isolated_data = json.dumps(isolated)
+    isolated_hash = h(isolated_data)
+
+    class FetchQueueFake(object):
+      def __init__(self):
+        self.added = []
+        self.cache = isolateserver.MemoryCache()
+        self.cache.write(isolated_hash, [isolated_data])
+
+      def add(self, digest, _size=None, priority=None):
+        self.added.append((digest, priority))
+
+      @staticmethod
+      def wait(_digests):
+        return isolated_hash
+
+    fetch_queue = FetchQueueFake()
+    bundle = isolateserver.IsolatedBundle()
+    bundle.fetch(fetch_queue, isolated_hash, hashlib.sha1)
+    expected = [
+      (isolated_hash, threading_utils.PRIORITY_HIGH),
+      (h('small'), threading_utils.PRIORITY_MED),
+      (h('medium'), threading_utils.PRIORITY_MED),
+      (h('run'), threading_utils.PRIORITY_HIGH),
+      (h('large'), threading_utils.PRIORITY_LOW),
+    ]
+    self.assertEqual(expected, fetch_queue.added)
+    self.assertIn(os.path.join('bin', 'run'), bundle.command_files)
+
+
 class IsolateServerDownloadTest(TestCase):
 
   def _url_read_json(self, url, **kwargs):
@@ -906,10 +1028,78 @@ def get_storage(_isolate_server, namespace):
     @staticmethod
     def upload_items(items):
       # Always returns the second item as not present.
-      return [items[1]]
+      return [list(items)[1]]
   return StorageFake()
 
 
+class DiskCacheTest(TestCase):
+  def setUp(self):
+    super(DiskCacheTest, self).setUp()
+    self._algo = isolated_format.get_hash_algo('default-gzip')
+    self._policies = isolateserver.CachePolicies(0, 0, 0)
+
+  def _write(self, cache_dir, content):
+    digest = self._algo(content).hexdigest()
+    with open(os.path.join(cache_dir, digest), 'wb') as f:
+      f.write(content)
+    return digest
+
+  def test_migrate_legacy_state(self):
+    cache_dir = os.path.join(self.tempdir, u'cache')
+    os.mkdir(cache_dir)
+    old = self._write(cache_dir, 'old')
+    new = self._write(cache_dir, 'newer')
+    with open(os.path.join(cache_dir, u'state.json'), 'wb') as f:
+      json.dump([[old, 3], [new, 5]], f)
+
+    with isolateserver.DiskCache(cache_dir, self._policies, self._algo) as c:
+      self.assertEqual(set([old, new]), c.cached_set())
+    self.assertEqual(
+        [u'state.bin'], [i for i in os.listdir(cache_dir) if len(i) != 40])
+
+    # The order and sizes are preserved.
+    with isolateserver.DiskCache(cache_dir, self._policies, self._algo) as c:
+      self.assertEqual([(old, 3), (new, 5)], list(c._lru.iteritems()))
+
+  def test_state_append(self):
+    cache_dir = os.path.join(self.tempdir, u'cache')
+    with isolateserver.DiskCache(cache_dir, self._policies, self._algo) as c:
+      c.write(self._algo('a').hexdigest(), ['a'])
+      c.write(self._algo('b').hexdigest(), ['b'])
+    state_file = os.path.join(cache_dir, u'state.bin')
+    size = os.path.getsize(state_file)
+
+    with isolateserver.DiskCache(cache_dir, self._policies, self._algo) as c:
+      self.assertTrue(c.touch(self._algo('a').hexdigest(), 1))
+    # A single record was appended.
+    self.assertEqual(size + 1 + 20 + 8, os.path.getsize(state_file))
+    with isolateserver.DiskCache(cache_dir, self._policies, self._algo) as c:
+      self.assertEqual(
+          [self._algo('b').hexdigest(), self._algo('a').hexdigest()],
+          [k for k, _ in c._lru.iteritems()])
+
+
+  def test_trim_min_free_space(self):
+    cache_dir = os.path.join(self.tempdir, u'cache')
+    with isolateserver.DiskCache(cache_dir, self._policies, self._algo) as c:
+      for i in xrange(10):
+        c.write(self._algo(str(i)).hexdigest(), [str(i) * 10])
+
+    # Free space is 5 bytes short, only one file of 10 bytes needs to be
+    # evicted and the free space is only queried twice.
+    calls = []
+    def get_free_space(_path):
+      calls.append(_path)
+      return 95 + 10 * (10 - len(os.listdir(cache_dir)) + 1)
+    self.mock(file_path, 'get_free_space', get_free_space)
+    policies = isolateserver.CachePolicies(0, 100, 0)
+    with isolateserver.DiskCache(cache_dir, policies, self._algo) as c:
+      self.assertEqual(9, len(c.cached_set()))
+      self.assertEqual(90, c._lru.total_size)
+      self.assertEqual(2, len(calls))
+      self.assertNotIn(self._algo('0').hexdigest(), c.cached_set())
+
+
 class TestArchive(TestCase):
   @staticmethod
   def get_isolateserver_prog():
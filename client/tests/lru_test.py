@@ -141,6 +141,28 @@ class LRUDictTest(unittest.TestCase):
     lru_dict.add(4, 4)
     self.assert_order(lru_dict, data + [4])
 
+  def test_total_size(self):
+    lru_dict = lru.LRUDict()
+    self.assertEqual(0, lru_dict.total_size)
+    lru_dict.add('a', 1)
+    lru_dict.add('b', 2)
+    lru_dict.batch_insert_oldest([('c', 4), ('d', 8)])
+    self.assertEqual(15, lru_dict.total_size)
+    # Replacing a value.
+    lru_dict.add('a', 16)
+    self.assertEqual(30, lru_dict.total_size)
+    lru_dict.batch_insert_oldest([('b', 32)])
+    self.assertEqual(60, lru_dict.total_size)
+    self.assertEqual(('b', 32), lru_dict.pop_oldest())
+    self.assertEqual(8, lru_dict.pop('d'))
+    self.assertEqual(20, lru_dict.total_size)
+    self.assertEqual(sum(lru_dict.itervalues()), lru_dict.total_size)
+    self.assertEqual([('c', 4), ('a', 16)], list(lru_dict.iteritems()))
+
+  def test_pop_oldest_empty(self):
+    with self.assertRaises(KeyError):
+      lru.LRUDict().pop_oldest()
+
   def test_load_save(self):
     def save_and_load(lru_dict):
       handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
@@ -183,6 +205,102 @@ class LRUDictTest(unittest.TestCase):
     lru_dict = save_and_load(lru_dict)
     self.assert_order(lru_dict, [5, 6] + data + [4])
 
+  def test_load_save_binary(self):
+    handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
+    os.close(handle)
+    keys = ['%02x' % i for i in xrange(4)]
+    try:
+      # Initial save writes the whole state.
+      lru_dict = lru.LRUDict()
+      for i, key in enumerate(keys):
+        lru_dict.add(key, i)
+      self.assertTrue(lru_dict.save_binary(tmp_name, 1))
+      self.assertFalse(lru_dict.save_binary(tmp_name, 1))
+      size = os.path.getsize(tmp_name)
+
+      # Modifications are appended as one 10 bytes record each.
+      lru_dict = lru.LRUDict.load_binary(tmp_name, 1)
+      lru_dict.touch(keys[0])
+      lru_dict.pop(keys[2])
+      lru_dict.add('ff', 255)
+      self.assertTrue(lru_dict.save_binary(tmp_name, 1))
+      self.assertEqual(size + 30, os.path.getsize(tmp_name))
+
+      lru_dict = lru.LRUDict.load_binary(tmp_name, 1)
+      self.assertEqual(255, lru_dict.get('ff'))
+      self.assert_order(lru_dict, [keys[1], keys[3], keys[0], 'ff'])
+
+      # A truncated trailing record is ignored.
+      with open(tmp_name, 'ab') as f:
+        f.write('A\x01')
+      lru_dict = lru.LRUDict.load_binary(tmp_name, 1)
+      self.assert_order(lru_dict, [keys[1], keys[3], keys[0], 'ff'])
+
+      # The file is compacted on the next save instead of appending after the
+      # truncated record.
+      lru_dict = lru.LRUDict.load_binary(tmp_name, 1)
+      lru_dict.add('fe', 254)
+      self.assertTrue(lru_dict.save_binary(tmp_name, 1))
+      self.assertEqual(9 + 5 * 10, os.path.getsize(tmp_name))
+      lru_dict = lru.LRUDict.load_binary(tmp_name, 1)
+      self.assertEqual(254, lru_dict.get('fe'))
+      self.assert_order(lru_dict, [keys[1], keys[3], keys[0], 'ff', 'fe'])
+    finally:
+      os.unlink(tmp_name)
+
+  def test_save_binary_compaction(self):
+    handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
+    os.close(handle)
+    try:
+      os.chmod(tmp_name, 0604)
+      lru_dict = lru.LRUDict()
+      lru_dict.add('00', 0)
+      lru_dict.add('01', 1)
+      lru_dict.save_binary(tmp_name, 1)
+      # Enough touches to trigger a compaction.
+      for _ in xrange(1100):
+        lru_dict.touch('00')
+      lru_dict.save_binary(tmp_name, 1)
+      self.assertEqual(9 + 2 * 10, os.path.getsize(tmp_name))
+      # Prepending items forces a compaction.
+      lru_dict.batch_insert_oldest([('02', 2)])
+      lru_dict.save_binary(tmp_name, 1)
+      self.assertEqual(9 + 3 * 10, os.path.getsize(tmp_name))
+      lru_dict = lru.LRUDict.load_binary(tmp_name, 1)
+      self.assert_order(lru_dict, ['02', '01', '00'])
+      if sys.platform != 'win32':
+        # The rewritten file keeps its mode.
+        self.assertEqual(0604, os.stat(tmp_name).st_mode & 0777)
+    finally:
+      os.unlink(tmp_name)
+
+  def test_corrupted_binary_state_file(self):
+    def load_from_state(data, key_size=1):
+      handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
+      os.close(handle)
+      try:
+        with open(tmp_name, 'wb') as f:
+          f.write(data)
+        return lru.LRUDict.load_binary(tmp_name, key_size)
+      finally:
+        os.unlink(tmp_name)
+
+    header = 'LRUDICT1\x01'
+    record = 'A\x01' + '\x00' * 8
+    self.assertEqual(1, len(load_from_state(header + record)))
+    # No header.
+    with self.assertRaises(ValueError):
+      load_from_state('')
+    # Bad magic.
+    with self.assertRaises(ValueError):
+      load_from_state('LRUDICT0\x01' + record)
+    # Different key size.
+    with self.assertRaises(ValueError):
+      load_from_state(header + record, 20)
+    # Unknown record type.
+    with self.assertRaises(ValueError):
+      load_from_state(header + 'X' + record[1:])
+
   def test_corrupted_state_file(self):
     def load_from_state(state_text):
       handle, tmp_name = tempfile.mkstemp(prefix=u'lru_test')
@@ -210,6 +210,16 @@ class HttpServiceTest(RetryLoopMockedTest):
     self.assertEqual(1, len(count))
     self.assertAttempts(1, net.URL_OPEN_TIMEOUT)
 
+  def test_request_HTTP_error_codes(self):
+    def mock_perform_request(_request):
+      raise net.HttpError(405)
+
+    service = self.mocked_http_service(perform_request=mock_perform_request)
+    error_codes = []
+    self.assertEqual(
+        service.request('/', data={}, error_codes=error_codes), None)
+    self.assertEqual([405], error_codes)
+
   def test_request_HTTP_error_retry_404(self):
     response = 'data'
     attempts = []
@@ -357,6 +367,40 @@ class TestNetFunctions(auto_stub.TestCase):
     for value, expected in data:
       self.assertEqual(expected, net.fix_url(value))
 
+  def test_http_stats(self):
+    stats = net.HttpStats()
+    for duration in (0.001, 0.01, 0.2, 0.2, 100.):
+      stats.add_request(duration)
+    expected = {
+      'latency': [
+        (0.01, 2), (0.05, 0), (0.1, 0), (0.5, 2), (1., 0), (5., 0), (30., 0),
+        ('inf', 1),
+      ],
+      'requests': 5,
+    }
+    self.assertEqual(expected, stats.snapshot())
+
+  def test_get_engine(self):
+    class Engine(object):
+      pass
+    self.mock(net, '_request_engine', None)
+    engine = net.get_engine(Engine)
+    self.assertIsInstance(engine, Engine)
+    self.assertIs(engine, net.get_engine(Engine))
+
+
+  def test_counting_http_adapter_evicted(self):
+    adapter = net._CountingHTTPAdapter(pool_connections=1)
+    pool = adapter.get_connection('http://localhost:1/')
+    pool.num_connections = 2
+    pool.num_requests = 5
+    # The first pool is evicted, its counters are kept but not the pool.
+    other = adapter.get_connection('http://localhost:2/')
+    other.num_connections = 1
+    other.num_requests = 1
+    self.assertEqual((3, 6), adapter.get_counts())
+    self.assertEqual(set([other]), adapter._pools)
+
 
 if __name__ == '__main__':
   logging.basicConfig(
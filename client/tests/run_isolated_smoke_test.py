@@ -239,7 +239,7 @@ class RunIsolatedTest(unittest.TestCase):
     # different names and ensure both are created.
     isolated_hash = self._store('repeated_files.isolated')
     expected = [
-      'state.json',
+      'state.bin',
       isolated_hash,
       self._store('file1.txt'),
       self._store('repeated_files.py'),
@@ -254,7 +254,7 @@ class RunIsolatedTest(unittest.TestCase):
 
   def test_fail_empty_isolated(self):
     isolated_hash = self._store_isolated({})
-    expected = ['state.json', isolated_hash]
+    expected = ['state.bin', isolated_hash]
     out, err, returncode = self._run(self._cmd_args(isolated_hash))
     self.assertEqual('', out)
     self.assertIn('No command to run\n', err)
@@ -269,7 +269,7 @@ class RunIsolatedTest(unittest.TestCase):
     # as file2.txt.
     isolated_hash = self._store('check_files.isolated')
     expected = [
-      'state.json',
+      'state.bin',
       isolated_hash,
       self._store('check_files.py'),
       self._store('file1.txt'),
@@ -297,7 +297,7 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertEqual(0, returncode)
     expected = {
       '.': (040707, 040707, 040777),
-      'state.json': (0100606, 0100606, 0100666),
+      'state.bin': (0100606, 0100606, 0100666),
       # The reason for 0100666 on Windows is that the file node had to be
       # modified to delete the hardlinked node. The read only bit is reset on
       # load.
@@ -321,7 +321,7 @@ class RunIsolatedTest(unittest.TestCase):
     self.assertEqual(0, returncode)
     expected = {
       '.': (040700, 040700, 040777),
-      'state.json': (0100600, 0100600, 0100666),
+      'state.bin': (0100600, 0100600, 0100666),
       file1_hash: (0100400, 0100400, 0100666),
       isolated_hash: (0100400, 0100400, 0100444),
     }
@@ -41,9 +41,17 @@ def json_dumps(data):
   return json.dumps(data, sort_keys=True, separators=(',', ':'))
 
 
+class ThreadPoolFake(object):
+  """Runs the tasks synchronously."""
+  @staticmethod
+  def add_task(_priority, func, *args, **kwargs):
+    func(*args, **kwargs)
+
+
 class StorageFake(object):
   def __init__(self, files):
     self._files = files.copy()
+    self.disk_thread_pool = ThreadPoolFake()
 
   def __enter__(self, *_):
     return self
@@ -168,7 +176,7 @@ class RunIsolatedTest(RunIsolatedTestBase):
           ],
         self.popen_calls)
 
-  def _run_tha_test(self, isolated_hash, files):
+  def _run_tha_test(self, isolated_hash, files, start_early=False):
     make_tree_call = []
     def add(i, _):
       make_tree_call.append(i)
@@ -181,7 +189,8 @@ class RunIsolatedTest(RunIsolatedTestBase):
         StorageFake(files),
         isolateserver.MemoryCache(),
         False,
-        [])
+        [],
+        start_early)
     self.assertEqual(0, ret)
     return make_tree_call
 
@@ -311,6 +320,34 @@ class RunIsolatedTest(RunIsolatedTestBase):
         self.popen_calls)
 
 
+  def test_start_early(self):
+    files = {
+      os.path.join('out', 'some.exe'): 'executable',
+      'data': 'data',
+    }
+    isolated = json_dumps({
+        'command': ['../out/some.exe', 'arg'],
+        'files': {
+          k: {'h': isolateserver_mock.hash_content(v), 's': len(v)}
+          for k, v in files.iteritems()
+        },
+        'relative_cwd': 'some',
+    })
+    isolated_hash = isolateserver_mock.hash_content(isolated)
+    contents = {isolateserver_mock.hash_content(v): v for v in files.values()}
+    contents[isolated_hash] = isolated
+    popen = subprocess42.Popen
+    mapped = []
+    def popen_mock(args, **kwargs):
+      mapped.append(os.path.isfile(self.temp_join(u'out', u'some.exe')))
+      return popen(args, **kwargs)
+    self.mock(subprocess42, 'Popen', popen_mock)
+    _ = self._run_tha_test(isolated_hash, contents, start_early=True)
+    self.assertEqual([True], mapped)
+    self.assertEqual(
+        [([self.temp_join(u'out', u'some.exe'), 'arg'], {'detached': True})],
+        self.popen_calls)
+
 class RunIsolatedTestRun(RunIsolatedTestBase):
   def test_output(self):
     # Starts a full isolate server mock and have run_tha_test() uploads results
@@ -127,6 +127,20 @@ def gen_request_response(request, **kwargs):
   return out
 
 
+def gen_trigger_many_request(requests, response, error_code=None):
+  """Returns an expected request to the bulk trigger endpoint."""
+  def check(kwargs):
+    assert kwargs['data'] == {'requests': requests}, kwargs
+    assert kwargs['headers'] == {'X-XSRF-Token': 'Token'}, kwargs
+    if error_code:
+      kwargs['error_codes'].append(error_code)
+  return (
+    'https://localhost:1/swarming/api/v1/client/requests',
+    check,
+    response,
+  )
+
+
 def gen_result_response(**kwargs):
   out = {
     "abandoned_ts": None,
@@ -300,16 +314,8 @@ class TestSwarmingTrigger(NetTestCase):
             {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
             {'server_version': 'v1', 'xsrf_token': 'Token'},
           ),
-          (
-            'https://localhost:1/swarming/api/v1/client/request',
-            {'data': request_1, 'headers': {'X-XSRF-Token': 'Token'}},
-            result_1,
-          ),
-          (
-            'https://localhost:1/swarming/api/v1/client/request',
-            {'data': request_2, 'headers': {'X-XSRF-Token': 'Token'}},
-            result_2,
-          ),
+          gen_trigger_many_request(
+              [request_1, request_2], {'tasks': [result_1, result_2]}),
         ])
 
     tasks = swarming.trigger_task_shards(
@@ -330,6 +336,155 @@ class TestSwarmingTrigger(NetTestCase):
     }
     self.assertEqual(expected, tasks)
 
+  def test_trigger_task_shards_batches(self):
+    self.mock(swarming, 'MAX_TRIGGER_TASKS', 2)
+    task_request = swarming.TaskRequest(
+        command=['a', 'b'],
+        data=[],
+        dimensions={'foo': 'bar', 'os': 'Mac'},
+        env={},
+        expiration=60*60,
+        hard_timeout=60,
+        idempotent=False,
+        io_timeout=60,
+        name=TEST_NAME,
+        priority=101,
+        tags=['taga', 'tagb'],
+        user='joe@localhost',
+        verbose=False)
+
+    requests = []
+    results = []
+    for index in xrange(3):
+      request = swarming.task_request_to_raw_request(task_request)
+      request['name'] = u'unit_tests:%d:3' % index
+      request['properties']['env'] = {
+        'GTEST_SHARD_INDEX': str(index), 'GTEST_TOTAL_SHARDS': '3',
+      }
+      requests.append(request)
+      results.append(gen_request_response(request, task_id='12%d00' % index))
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/swarming/api/v1/client/handshake',
+            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {'server_version': 'v1', 'xsrf_token': 'Token'},
+          ),
+          gen_trigger_many_request(requests[:2], {'tasks': results[:2]}),
+          gen_trigger_many_request(requests[2:], {'tasks': results[2:]}),
+        ])
+
+    tasks = swarming.trigger_task_shards(
+        swarming='https://localhost:1',
+        task_request=task_request,
+        shards=3)
+    expected = {
+      u'unit_tests:%d:3' % index: {
+        'shard_index': index,
+        'task_id': '12%d00' % index,
+        'view_url': 'https://localhost:1/user/task/12%d00' % index,
+      }
+      for index in xrange(3)
+    }
+    self.assertEqual(expected, tasks)
+
+  def test_trigger_task_shards_fallback(self):
+    # The server doesn't support the batch API, one request per shard is used.
+    task_request = swarming.TaskRequest(
+        command=['a', 'b'],
+        data=[],
+        dimensions={'foo': 'bar', 'os': 'Mac'},
+        env={},
+        expiration=60*60,
+        hard_timeout=60,
+        idempotent=False,
+        io_timeout=60,
+        name=TEST_NAME,
+        priority=101,
+        tags=['taga', 'tagb'],
+        user='joe@localhost',
+        verbose=False)
+
+    request_1 = swarming.task_request_to_raw_request(task_request)
+    request_1['name'] = u'unit_tests:0:2'
+    request_1['properties']['env'] = {
+      'GTEST_SHARD_INDEX': '0', 'GTEST_TOTAL_SHARDS': '2',
+    }
+    result_1 = gen_request_response(request_1)
+
+    request_2 = swarming.task_request_to_raw_request(task_request)
+    request_2['name'] = u'unit_tests:1:2'
+    request_2['properties']['env'] = {
+      'GTEST_SHARD_INDEX': '1', 'GTEST_TOTAL_SHARDS': '2',
+    }
+    result_2 = gen_request_response(request_2, task_id='12400')
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/swarming/api/v1/client/handshake',
+            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {'server_version': 'v1', 'xsrf_token': 'Token'},
+          ),
+          gen_trigger_many_request([request_1, request_2], None, 405),
+          (
+            'https://localhost:1/swarming/api/v1/client/request',
+            {'data': request_1, 'headers': {'X-XSRF-Token': 'Token'}},
+            result_1,
+          ),
+          (
+            'https://localhost:1/swarming/api/v1/client/request',
+            {'data': request_2, 'headers': {'X-XSRF-Token': 'Token'}},
+            result_2,
+          ),
+        ])
+
+    tasks = swarming.trigger_task_shards(
+        swarming='https://localhost:1',
+        task_request=task_request,
+        shards=2)
+    self.assertEqual(
+        ['12300', '12400'], sorted(t['task_id'] for t in tasks.itervalues()))
+
+  def test_trigger_task_shards_error(self):
+    # A server error doesn't fall back to one request per shard.
+    task_request = swarming.TaskRequest(
+        command=['a', 'b'],
+        data=[],
+        dimensions={'foo': 'bar', 'os': 'Mac'},
+        env={},
+        expiration=60*60,
+        hard_timeout=60,
+        idempotent=False,
+        io_timeout=60,
+        name=TEST_NAME,
+        priority=101,
+        tags=['taga', 'tagb'],
+        user='joe@localhost',
+        verbose=False)
+    requests = [
+      swarming.task_request_to_raw_request(
+          task_request._replace(
+              env=swarming.setup_googletest({}, 2, i),
+              name='%s:%d:2' % (TEST_NAME, i)))
+      for i in xrange(2)
+    ]
+    self.expected_requests(
+        [
+          (
+            'https://localhost:1/swarming/api/v1/client/handshake',
+            {'data': {}, 'headers': {'X-XSRF-Token-Request': '1'}},
+            {'server_version': 'v1', 'xsrf_token': 'Token'},
+          ),
+          gen_trigger_many_request(requests, None, 500),
+        ])
+    self.mock(swarming, 'swarming_trigger', lambda *_: self.fail())
+    self.assertEqual(
+        None,
+        swarming.trigger_task_shards(
+            swarming='https://localhost:1',
+            task_request=task_request,
+            shards=2))
+
   def test_trigger_task_shards_priority_override(self):
     task_request = swarming.TaskRequest(
         command=['a', 'b'],
@@ -422,10 +577,31 @@ class TestSwarmingTrigger(NetTestCase):
     self._check_output('Archiving: %s\n' % isolated, '')
 
 
+def gen_wait_request(task_ids, results, error_code=None):
+  """Returns an expected request to the tasks/wait long-poll endpoint."""
+  def check(kwargs):
+    if task_ids is not None:
+      assert kwargs['data']['task_ids'] == task_ids, kwargs
+    assert 0 <= kwargs['data']['timeout'] <= swarming.LONG_POLL_TIMEOUT, kwargs
+    assert kwargs['retry_50x'] is False, kwargs
+    if error_code:
+      kwargs['error_codes'].append(error_code)
+  return (
+    'https://host:9001/swarming/api/v1/client/tasks/wait',
+    check,
+    None if results is None else {'results': results},
+  )
+
+
+# Server that doesn't support long-polling.
+WAIT_UNSUPPORTED = gen_wait_request(None, None, 405)
+
+
 class TestSwarmingCollection(NetTestCase):
   def test_success(self):
     self.expected_requests(
         [
+          WAIT_UNSUPPORTED,
           (
             'https://host:9001/swarming/api/v1/client/task/10100',
             {'retry_50x': False},
@@ -441,9 +617,48 @@ class TestSwarmingCollection(NetTestCase):
     actual = get_results(['10100'])
     self.assertEqual(expected, actual)
 
+  def test_running_incremental(self):
+    # Only the new output is fetched while the task runs, page by page.
+    self.expected_requests(
+        [
+          WAIT_UNSUPPORTED,
+          (
+            'https://host:9001/swarming/api/v1/client/task/10100',
+            {'retry_50x': False},
+            gen_result_response(state=swarming.State.RUNNING),
+          ),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10100/output/all',
+            {},
+            {'more': False, 'next_offsets': [4], 'outputs': ['Ran ']},
+          ),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10100',
+            {'retry_50x': False},
+            gen_result_response(),
+          ),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10100/output/all'
+              '?offsets=4',
+            {},
+            {'more': True, 'next_offsets': [7], 'outputs': ['stu']},
+          ),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10100/output/all'
+              '?offsets=7',
+            {},
+            {'more': False, 'next_offsets': [10], 'outputs': ['ff\n']},
+          ),
+        ])
+    self.mock(swarming, 'now', lambda: 0)
+    expected = [gen_yielded_data(0, outputs=[OUTPUT])]
+    actual = get_results(['10100'])
+    self.assertEqual(expected, actual)
+
   def test_failure(self):
     self.expected_requests(
         [
+          WAIT_UNSUPPORTED,
           (
             'https://host:9001/swarming/api/v1/client/task/10100',
             {'retry_50x': False},
@@ -477,7 +692,7 @@ class TestSwarmingCollection(NetTestCase):
     # The actual number of requests here depends on 'now' progressing to 10
     # seconds. It's called once per loop. Loop makes 9 iterations.
     self.expected_requests(
-        9 * [
+        [WAIT_UNSUPPORTED] + 9 * [
           (
             'https://host:9001/swarming/api/v1/client/task/10100',
             {'retry_50x': False},
@@ -486,11 +701,15 @@ class TestSwarmingCollection(NetTestCase):
         ])
     actual = get_results(['10100'])
     self.assertEqual([], actual)
+    # The main thread only waited on the long-poll endpoint.
+    main = now.pop(threading.current_thread())
+    self.assertEqual(range(2, 10), main)
     self.assertTrue(all(not v for v in now.itervalues()), now)
 
   def test_many_shards(self):
     self.expected_requests(
         [
+          WAIT_UNSUPPORTED,
           (
             'https://host:9001/swarming/api/v1/client/task/10100',
             {'retry_50x': False},
@@ -534,6 +753,7 @@ class TestSwarmingCollection(NetTestCase):
     # Three shards, one failed. All results are passed to output collector.
     self.expected_requests(
         [
+          WAIT_UNSUPPORTED,
           (
             'https://host:9001/swarming/api/v1/client/task/10100',
             {'retry_50x': False},
@@ -585,6 +805,141 @@ class TestSwarmingCollection(NetTestCase):
     ]
     self.assertEqual(sorted(expected), sorted(output_collector.results))
 
+  def test_wait(self):
+    self.expected_requests(
+        [
+          gen_wait_request(['10100'], {'10100': gen_result_response()}),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10100/output/all',
+            {},
+            {'more': False, 'next_offsets': [10], 'outputs': [OUTPUT]},
+          ),
+        ])
+    expected = [gen_yielded_data(0, outputs=[OUTPUT])]
+    actual = get_results(['10100'])
+    self.assertEqual(expected, actual)
+
+  def test_wait_transient_error(self):
+    # A transient error doesn't fall back to polling each task.
+    self.expected_requests(
+        [
+          gen_wait_request(['10100'], None, 500),
+          gen_wait_request(['10100'], {'10100': gen_result_response()}),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10100/output/all',
+            {},
+            {'more': False, 'next_offsets': [10], 'outputs': [OUTPUT]},
+          ),
+        ])
+    expected = [gen_yielded_data(0, outputs=[OUTPUT])]
+    actual = get_results(['10100'])
+    self.assertEqual(expected, actual)
+
+  def test_wait_errors(self):
+    # Persistent errors are retried with an exponential back off, then the
+    # shards are given up.
+    self.mock(logging, 'error', lambda *_: None)
+    self.mock(swarming, 'MAX_WAIT_ERRORS', 3)
+    delays = []
+    self.mock(time, 'sleep', delays.append)
+    self.expected_requests(
+        [
+          gen_wait_request(['10100'], None, 500),
+          gen_wait_request(['10100'], None, 403),
+          gen_wait_request(['10100'], None, 503),
+        ])
+    self.assertEqual([], get_results(['10100']))
+    self.assertEqual([1., 2.], delays)
+
+  def test_wait_many_shards(self):
+    # All the shards are waited for with a single connection.
+    self.mock(logging, 'error', lambda *_: None)
+    self.expected_requests(
+        [
+          gen_wait_request(
+              ['10100', '10200', '10300', '10400'],
+              {'10200': gen_result_response()}),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10200/output/all',
+            {},
+            {'outputs': [SHARD_OUTPUT_2]},
+          ),
+          gen_wait_request(['10100', '10300', '10400'], {}),
+          gen_wait_request(
+              ['10100', '10300', '10400'],
+              {
+                '10100': gen_result_response(),
+                '10300': gen_result_response(exit_codes=[0, 1]),
+                '10400': None,
+              }),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10100/output/all',
+            {},
+            {'outputs': [SHARD_OUTPUT_1]},
+          ),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10300/output/all',
+            {},
+            {'outputs': [SHARD_OUTPUT_3]},
+          ),
+        ])
+    expected = [
+      gen_yielded_data(0, outputs=[SHARD_OUTPUT_1]),
+      gen_yielded_data(1, outputs=[SHARD_OUTPUT_2]),
+      gen_yielded_data(2, outputs=[SHARD_OUTPUT_3], exit_codes=[0, 1]),
+    ]
+    # The outputs are fetched in parallel so they may be yielded in any order.
+    actual = get_results(['10100', '10200', '10300', '10400'])
+    self.assertEqual(expected, sorted(actual))
+
+  def test_wait_batches(self):
+    # Only the last batch blocks.
+    self.mock(swarming, 'MAX_WAIT_TASKS', 2)
+    timeouts = []
+    def check(task_ids):
+      def fn(kwargs):
+        self.assertEqual(task_ids, kwargs['data']['task_ids'])
+        timeouts.append(kwargs['data']['timeout'])
+      return fn
+    url = 'https://host:9001/swarming/api/v1/client/tasks/wait'
+    self.expected_requests(
+        [
+          (url, check(['10100', '10200']), {'results': {}}),
+          (
+            url, check(['10300']),
+            {'results': {'10300': gen_result_response()}},
+          ),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10300/output/all',
+            {},
+            {'outputs': [SHARD_OUTPUT_3]},
+          ),
+          (
+            url, check(['10100', '10200']),
+            {
+              'results': {
+                '10100': gen_result_response(),
+                '10200': gen_result_response(),
+              },
+            },
+          ),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10100/output/all',
+            {},
+            {'outputs': [SHARD_OUTPUT_1]},
+          ),
+          (
+            'https://host:9001/swarming/api/v1/client/task/10200/output/all',
+            {},
+            {'outputs': [SHARD_OUTPUT_2]},
+          ),
+        ])
+    actual = get_results(['10100', '10200', '10300'])
+    self.assertEqual([0, 1, 2], sorted(i[0] for i in actual))
+    self.assertEqual(0, timeouts[0])
+    self.assertTrue(timeouts[1])
+    self.assertTrue(timeouts[2])
+
   def test_collect_nothing(self):
     self.mock(swarming, 'yield_results', lambda *_: [])
     self.assertEqual(
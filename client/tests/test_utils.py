@@ -69,4 +69,6 @@ def main():
     unittest.TestCase.maxDiff = None
   # Use an unusual umask.
   os.umask(0070)
+  # Do not use the machine wide hash cache.
+  os.environ['ISOLATED_HASH_CACHE'] = ''
   unittest.main()
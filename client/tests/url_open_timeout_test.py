@@ -161,6 +161,30 @@ class UrlOpenTimeoutTest(auto_stub.TestCase):
       with self.assertRaises(net.TimeoutError):
         stream.read()
 
+  def test_urlopen_reuses_connections(self):
+    # Connections are pooled process wide and reused by concurrent requests.
+    self.mock(net, '_http_services', {})
+    self.mock(net, '_request_engine', None)
+    self.mock(net, '_stats', net.HttpStats())
+    concurrency = 64
+    def fetch():
+      self.assertEqual(
+          SleepingHandler.full_response,
+          self.call('sleep_before_response', 0.01, read_timeout=5).read())
+    for _ in xrange(3):
+      threads = [threading.Thread(target=fetch) for _ in xrange(concurrency)]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+    stats = net.get_stats()
+    self.assertEqual(3 * concurrency, stats['requests'])
+    self.assertEqual(
+        3 * concurrency, sum(count for _, count in stats['latency']))
+    self.assertLessEqual(stats['opened'], 2 * concurrency)
+    self.assertEqual(3 * concurrency, stats['opened'] + stats['reused'])
+    self.assertGreaterEqual(stats['reused'], concurrency)
+
 
 if __name__ == '__main__':
   VERBOSE = '-v' in sys.argv
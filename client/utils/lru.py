@@ -4,37 +4,75 @@
 
 """Defines a dictionary that can evict least recently used items."""
 
-import collections
+import ctypes
 import json
+import numbers
+import os
+import struct
+import sys
+
+
+# Magic header of the binary state file.
+_BINARY_MAGIC = 'LRUDICT1'
+# Header: magic and size in bytes of the keys once decoded from hex.
+_BINARY_HEADER = struct.Struct('<8sB')
+# Record types of the binary state file. Each record is followed by the key
+# decoded from hex and the value as an unsigned 64 bits integer.
+_RECORD_ADD = 'A'
+_RECORD_DELETE = 'D'
+
+# Indexes in a linked list node.
+_PREV, _NEXT, _KEY, _VALUE = range(4)
 
 
 class LRUDict(object):
   """Dictionary that can evict least recently used items.
 
-  Implemented as a wrapper around OrderedDict object. An OrderedDict stores
-  (key, value) pairs in order they are inserted and can effectively pop oldest
-  items.
+  Implemented as a dict of key -> node of a circular doubly linked list. The
+  list stores (key, value) pairs from the oldest to the newest and permits
+  adding, touching and removing items at both ends in O(1).
 
-  Can also store its state as *.json file on disk.
+  Keeps the running sum of the values that are numbers, e.g. the sizes of the
+  items, so it doesn't need to be recomputed.
+
+  Can also store its state as *.json file on disk, or as a compact append-only
+  binary file when the keys are fixed size hex strings and the values are
+  non-negative integers.
   """
 
   def __init__(self):
-    # Ordered key -> value mapping, newest items at the bottom.
-    self._items = collections.OrderedDict()
+    # key -> [prev, next, key, value] node.
+    self._map = {}
+    # Sentinel of the linked list. _root[_NEXT] is the oldest item and
+    # _root[_PREV] is the newest.
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None]
+    # Sum of the values that are numbers.
+    self._total = 0
     # True if was modified after loading.
     self._dirty = True
+    # List of (record type, key) modifications since the binary state file was
+    # last loaded or saved. None if the state file must be fully rewritten.
+    self._journal = None
+    # Number of records in the binary state file.
+    self._journal_records = 0
 
   def __nonzero__(self):
     """False if dict is empty."""
-    return bool(self._items)
+    return bool(self._map)
 
   def __len__(self):
     """Number of items in the dict."""
-    return len(self._items)
+    return len(self._map)
 
   def __contains__(self, key):
     """True if |key| is in the dict."""
-    return key in self._items
+    return key in self._map
+
+  @property
+  def total_size(self):
+    """Sum of the values that are numbers, e.g. the sizes of the items."""
+    return self._total
 
   @classmethod
   def load(cls, state_file):
@@ -74,61 +112,138 @@ class LRUDict(object):
       return False
 
     with open(state_file, 'wb') as f:
-      json.dump(self._items.items(), f, separators=(',',':'))
+      json.dump(list(self.iteritems()), f, separators=(',',':'))
 
     self._dirty = False
     return True
 
-  def add(self, key, value):
-    """Adds or replaces a |value| for |key|, marks it as most recently used."""
-    self._items.pop(key, None)
-    self._items[key] = value
-    self._dirty = True
+  @classmethod
+  def load_binary(cls, state_file, key_size):
+    """Loads state previously saved with save_binary().
 
-  def batch_insert_oldest(self, items):
-    """Prepends list of |items| to the dict, marks them as least recently used.
+    Records are replayed in order. A truncated trailing record, for example due
+    to a crash while appending, is ignored and the next save_binary() compacts
+    the file so new records are not appended after it.
 
-    |items| is a list of (key, value) pairs to add.
+    Raises ValueError if state file is corrupted.
+    """
+    try:
+      with open(state_file, 'rb') as f:
+        data = f.read()
+    except IOError as e:
+      raise ValueError('Broken state file %s: %s' % (state_file, e))
+
+    if len(data) < _BINARY_HEADER.size:
+      raise ValueError('Broken state file %s, no header' % state_file)
+    magic, actual_key_size = _BINARY_HEADER.unpack_from(data)
+    if magic != _BINARY_MAGIC or actual_key_size != key_size:
+      raise ValueError('Broken state file %s, bad header' % state_file)
 
-    It's a very slow operation that completely rebuilds the dictionary.
+    record = _binary_record(key_size)
+    lru = cls()
+    end = len(data) - (len(data) - _BINARY_HEADER.size) % record.size
+    for offset in xrange(_BINARY_HEADER.size, end, record.size):
+      kind, key, value = record.unpack_from(data, offset)
+      key = key.encode('hex')
+      if kind == _RECORD_ADD:
+        lru._set(key, value, False)
+      elif kind == _RECORD_DELETE:
+        if key in lru._map:
+          lru._unlink(key)
+      else:
+        raise ValueError(
+            'Broken state file %s, unknown record at %d' % (state_file, offset))
+
+    # Appending after a truncated record would misalign all the records that
+    # follow, so force a compaction instead.
+    lru._journal = [] if end == len(data) else None
+    lru._journal_records = (end - _BINARY_HEADER.size) / record.size
+    # Now state from the file corresponds to state in the memory.
+    lru._dirty = False
+    return lru
+
+  def save_binary(self, state_file, key_size):
+    """Saves cache state to a binary file if it was modified.
+
+    The modifications since the last load or save are appended to the file. It
+    is compacted, i.e. atomically replaced with one record per item, when it
+    contains more than twice as many records as there are items.
     """
-    new_items = collections.OrderedDict()
+    if not self._dirty and self._journal is not None:
+      return False
 
-    # Insert |items| first, so they became oldest.
-    for key, value in items:
-      new_items[key] = value
+    record = _binary_record(key_size)
+    records = self._journal_records + len(self._journal or [])
+    if self._journal is None or records > 2 * len(self._map) + 1024:
+      # Compact.
+      data = [_BINARY_HEADER.pack(_BINARY_MAGIC, key_size)]
+      data.extend(
+          record.pack(_RECORD_ADD, key.decode('hex'), value)
+          for key, value in self.iteritems())
+      _write_atomic(state_file, ''.join(data))
+      self._journal_records = len(self._map)
+    else:
+      data = []
+      for kind, key in self._journal:
+        # The value of an item is the one at save time, as only the final
+        # state matters.
+        value = self.get(key, 0) if kind == _RECORD_ADD else 0
+        data.append(record.pack(kind, key.decode('hex'), value))
+      with open(state_file, 'ab') as f:
+        f.write(''.join(data))
+      self._journal_records = records
+
+    self._journal = []
+    self._dirty = False
+    return True
 
-    # Insert the rest, be careful not to override keys from |items|.
-    for key, value in self._items.iteritems():
-      if key not in new_items:
-        new_items[key] = value
+  def add(self, key, value):
+    """Adds or replaces a |value| for |key|, marks it as most recently used."""
+    self._set(key, value, False)
+    self._log(_RECORD_ADD, key)
 
-    self._items = new_items
+  def batch_insert_oldest(self, items):
+    """Prepends list of |items| to the dict, marks them as least recently used.
+
+    |items| is a list of (key, value) pairs to add. items[0] becomes the oldest.
+    """
+    for key, value in reversed(items):
+      self._set(key, value, True)
     self._dirty = True
+    # The binary state file cannot prepend items.
+    self._journal = None
 
   def keys_set(self):
     """Set of keys of items in this dict."""
-    return set(self._items)
+    return set(self._map)
 
   def get(self, key, default=None):
     """Returns value for |key| or |default| if not found."""
-    return self._items.get(key, default)
+    node = self._map.get(key)
+    return node[_VALUE] if node else default
 
   def touch(self, key):
     """Marks |key| as most recently used.
 
     Raises KeyError if |key| is not in the dict.
     """
-    self._items[key] = self._items.pop(key)
-    self._dirty = True
+    node = self._map[key]
+    # Unlink and relink as the newest.
+    node[_PREV][_NEXT] = node[_NEXT]
+    node[_NEXT][_PREV] = node[_PREV]
+    last = self._root[_PREV]
+    node[_PREV] = last
+    node[_NEXT] = self._root
+    last[_NEXT] = self._root[_PREV] = node
+    self._log(_RECORD_ADD, key)
 
   def pop(self, key):
     """Removes item from the dict, returns its value.
 
     Raises KeyError if |key| is not in the dict.
     """
-    value = self._items.pop(key)
-    self._dirty = True
+    value = self._unlink(key)
+    self._log(_RECORD_DELETE, key)
     return value
 
   def pop_oldest(self):
@@ -136,10 +251,81 @@ class LRUDict(object):
 
     Raises KeyError if dict is empty.
     """
-    pair = self._items.popitem(last=False)
-    self._dirty = True
-    return pair
+    if not self._map:
+      raise KeyError('dictionary is empty')
+    key = self._root[_NEXT][_KEY]
+    value = self._unlink(key)
+    self._log(_RECORD_DELETE, key)
+    return key, value
+
+  def iteritems(self):
+    """Iterator over stored (key, value) pairs from the oldest to the newest."""
+    node = self._root[_NEXT]
+    while node is not self._root:
+      yield node[_KEY], node[_VALUE]
+      node = node[_NEXT]
 
   def itervalues(self):
     """Iterator over stored values in arbitrary order."""
-    return self._items.itervalues()
+    return (node[_VALUE] for node in self._map.itervalues())
+
+  def _set(self, key, value, oldest):
+    """Adds or replaces |key| as the newest item, or the oldest if |oldest|."""
+    if key in self._map:
+      self._unlink(key)
+    if oldest:
+      prev = self._root
+      nxt = self._root[_NEXT]
+    else:
+      prev = self._root[_PREV]
+      nxt = self._root
+    node = [prev, nxt, key, value]
+    prev[_NEXT] = nxt[_PREV] = self._map[key] = node
+    if isinstance(value, numbers.Number):
+      self._total += value
+
+  def _unlink(self, key):
+    """Removes |key| from the linked list and the map, returns its value."""
+    node = self._map.pop(key)
+    node[_PREV][_NEXT] = node[_NEXT]
+    node[_NEXT][_PREV] = node[_PREV]
+    value = node[_VALUE]
+    if isinstance(value, numbers.Number):
+      self._total -= value
+    return value
+
+  def _log(self, kind, key):
+    """Marks the dict as modified and records the modification."""
+    self._dirty = True
+    if self._journal is not None:
+      self._journal.append((kind, key))
+
+
+def _write_atomic(path, data):
+  """Replaces the content of |path| with |data| via a temporary file.
+
+  The temporary file is created like open() would, then gets the mode of |path|
+  if it exists, so the replaced file keeps its mode. On Windows, MoveFileExW()
+  replaces the file atomically.
+  """
+  tmp = '%s.%d.tmp' % (path, os.getpid())
+  try:
+    with open(tmp, 'wb') as f:
+      f.write(data)
+    if os.path.isfile(path):
+      os.chmod(tmp, os.stat(path).st_mode & 07777)
+    if sys.platform == 'win32':
+      # MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH
+      if not ctypes.windll.kernel32.MoveFileExW(
+          unicode(tmp), unicode(path), 0x1 | 0x8):
+        raise ctypes.WinError()
+    else:
+      os.rename(tmp, path)
+  finally:
+    if os.path.isfile(tmp):
+      os.remove(tmp)
+
+
+def _binary_record(key_size):
+  """Returns the struct.Struct of a binary state file record."""
+  return struct.Struct('<c%dsQ' % key_size)
@@ -4,6 +4,7 @@
 
 """Classes and functions for generic network communication over HTTP."""
 
+import bisect
 import cookielib
 import cStringIO as StringIO
 import datetime
@@ -27,6 +28,7 @@ from third_party.requests import adapters
 from third_party.requests import structures
 
 from utils import oauth
+from utils import threading_utils
 from utils import tools
 
 
@@ -69,6 +71,19 @@ CONTENT_ENCODERS = {
 }
 
 
+# Maximum number of idle keep-alive connections kept per host. Sized so that
+# all the workers of a few IOAutoRetryThreadPool hitting the same host can each
+# reuse a connection instead of opening a new one.
+POOL_MAXSIZE = 4 * threading_utils.IOAutoRetryThreadPool.MAX_WORKERS
+
+# Maximum number of hosts for which connection pools are kept.
+POOL_MAX_HOSTS = 16
+
+# Upper bounds in seconds of the request latency histogram buckets. The last
+# bucket is unbounded.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1., 5., 30.)
+
+
 # Google Storage URL regular expression.
 GS_STORAGE_HOST_URL_RE = re.compile(r'https://.*\.storage\.googleapis\.com')
 
@@ -89,6 +104,11 @@ _auth_config = None
 # Default is RequestsLibEngine.
 _request_engine_cls = None
 
+# Instance of the engine class shared by all the cached HttpService, so that
+# connections are pooled process wide.
+_request_engine = None
+_request_engine_lock = threading.Lock()
+
 
 class NetError(IOError):
   """Generic network related error."""
@@ -133,6 +153,31 @@ def get_engine_class():
   return _request_engine_cls or RequestsLibEngine
 
 
+def get_stats():
+  """Returns a dict with the process wide HTTP metrics.
+
+  Includes the number of requests, the number of connections opened and reused
+  by the shared engine and the request latency histogram.
+  """
+  with _request_engine_lock:
+    engine = _request_engine
+  stats = _stats.snapshot()
+  connections = getattr(engine, 'connection_stats', None)
+  stats.update(
+      connections() if connections else {'opened': None, 'reused': None})
+  return stats
+
+
+def log_stats():
+  """Logs the process wide HTTP metrics, see get_stats()."""
+  stats = get_stats()
+  logging.info(
+      'HTTP: %d requests, %s connections opened, %s reused, latency %s',
+      stats['requests'], stats['opened'], stats['reused'],
+      ' '.join(
+          '%s:%d' % (bound, count) for bound, count in stats['latency']))
+
+
 def url_open(url, **kwargs):  # pylint: disable=W0621
   """Attempts to open the given url multiple times.
 
@@ -245,7 +290,7 @@ def get_http_service(urlhost, allow_cached=True):
       authenticator = OAuthAuthenticator(urlhost, conf)
     return HttpService(
         urlhost,
-        engine=engine_cls(),
+        engine=engine_cls() if not allow_cached else get_engine(engine_cls),
         authenticator=authenticator)
 
   # Ensure consistency in url naming.
@@ -261,6 +306,15 @@ def get_http_service(urlhost, allow_cached=True):
     return service
 
 
+def get_engine(engine_cls):
+  """Returns the engine instance shared by the cached HttpService instances."""
+  global _request_engine
+  with _request_engine_lock:
+    if type(_request_engine) is not engine_cls:
+      _request_engine = engine_cls()
+    return _request_engine
+
+
 def set_oauth_config(config):
   """Defines what OAuth configuration to use for authentication.
 
@@ -290,6 +344,37 @@ def get_case_insensitive_dict(original):
   return normalized
 
 
+class HttpStats(object):
+  """Thread safe accumulator of HTTP request metrics."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._requests = 0
+    self._latency = [0] * (len(LATENCY_BUCKETS) + 1)
+
+  def add_request(self, duration):
+    """Records a request that took |duration| seconds to get a response."""
+    index = bisect.bisect_left(LATENCY_BUCKETS, duration)
+    with self._lock:
+      self._requests += 1
+      self._latency[index] += 1
+
+  def snapshot(self):
+    """Returns the metrics as a dict.
+
+    'latency' is a list of (upper bound, count), the last bound is 'inf'.
+    """
+    with self._lock:
+      return {
+        'requests': self._requests,
+        'latency': zip(LATENCY_BUCKETS + ('inf',), self._latency),
+      }
+
+
+# Metrics of all the requests done by HttpService.
+_stats = HttpStats()
+
+
 class HttpService(object):
   """Base class for a class that provides an API to HTTP based service:
     - Provides 'request' method.
@@ -366,7 +451,8 @@ class HttpService(object):
       stream=True,
       method=None,
       headers=None,
-      follow_redirects=True):
+      follow_redirects=True,
+      error_codes=None):
     """Attempts to open the given url multiple times.
 
     |urlpath| is relative to the server root, i.e. '/some/request?param=1'.
@@ -402,6 +488,9 @@ class HttpService(object):
     operation so once you pass non-None |read_timeout| be prepared to handle
     these exceptions in subsequent reads from the stream.
 
+    If |error_codes| is a list, the HTTP status code of each error response is
+    appended to it, so the caller can tell why the request failed.
+
     Returns a file-like object, where the response may be read from, or None
     if it was unable to connect. If |stream| is False will read whole response
     into memory buffer before returning file-like object that reads from this
@@ -449,7 +538,11 @@ class HttpService(object):
             headers, read_timeout, stream, follow_redirects)
         if self.authenticator:
           self.authenticator.authorize(request)
-        response = self.engine.perform_request(request)
+        start = time.time()
+        try:
+          response = self.engine.perform_request(request)
+        finally:
+          _stats.add_request(time.time() - start)
         response._timeout_exc_classes = self.engine.timeout_exception_classes()
         logging.debug('Request %s succeeded', request.get_full_url())
         return response
@@ -463,6 +556,8 @@ class HttpService(object):
 
       except HttpError as e:
         last_error = e
+        if error_codes is not None:
+          error_codes.append(e.code)
 
         # Access denied -> authenticate.
         if e.code in (401, 403):
@@ -697,13 +792,28 @@ class RequestsLibEngine(object):
     # Configure session.
     self.session.trust_env = False
     self.session.verify = tools.get_cacerts_bundle()
-    # Configure connection pools.
+    # Configure connection pools. Idle connections are checked for liveness
+    # when taken out of the pool and transparently replaced if the server
+    # closed them.
+    self._adapters = []
     for protocol in ('https://', 'http://'):
-      self.session.mount(protocol, adapters.HTTPAdapter(
-          pool_connections=64,
-          pool_maxsize=64,
+      adapter = _CountingHTTPAdapter(
+          pool_connections=POOL_MAX_HOSTS,
+          pool_maxsize=POOL_MAXSIZE,
           max_retries=0,
-          pool_block=False))
+          pool_block=False)
+      self._adapters.append(adapter)
+      self.session.mount(protocol, adapter)
+
+  def connection_stats(self):
+    """Returns a dict with the number of connections opened and reused."""
+    opened = 0
+    requests_done = 0
+    for adapter in self._adapters:
+      num_connections, num_requests = adapter.get_counts()
+      opened += num_connections
+      requests_done += num_requests
+    return {'opened': opened, 'reused': max(0, requests_done - opened)}
 
   def perform_request(self, request):
     """Sends a HttpRequest to the server and reads back the response.
@@ -740,6 +850,46 @@ class RequestsLibEngine(object):
       raise ConnectionError(e)
 
 
+class _CountingHTTPAdapter(adapters.HTTPAdapter):
+  """HTTPAdapter that keeps track of the connections of its connection pools.
+
+  When the pool manager evicts a pool, its counters are added to the totals and
+  the pool is dropped, so its sockets are not kept alive.
+  """
+
+  def __init__(self, *args, **kwargs):
+    self._pools_lock = threading.Lock()
+    self._pools = set()
+    self._num_connections = 0
+    self._num_requests = 0
+    super(_CountingHTTPAdapter, self).__init__(*args, **kwargs)
+
+  def get_connection(self, url, proxies=None):
+    pool = super(_CountingHTTPAdapter, self).get_connection(url, proxies)
+    with self._pools_lock:
+      for manager in [self.poolmanager] + self.proxy_manager.values():
+        # Replaces the default dispose function, which only closes the pool.
+        manager.pools.dispose_func = self._dispose_pool
+      self._pools.add(pool)
+    return pool
+
+  def get_counts(self):
+    """Returns the number of connections opened and of requests done."""
+    with self._pools_lock:
+      return (
+          self._num_connections + sum(p.num_connections for p in self._pools),
+          self._num_requests + sum(p.num_requests for p in self._pools))
+
+  def _dispose_pool(self, pool):
+    """Called when the pool manager evicts a pool."""
+    with self._pools_lock:
+      if pool in self._pools:
+        self._pools.remove(pool)
+        self._num_connections += pool.num_connections
+        self._num_requests += pool.num_requests
+    pool.close()
+
+
 class OAuthAuthenticator(Authenticator):
   """Uses OAuth Authorization header to authenticate requests."""
 